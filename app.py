@@ -1,9 +1,9 @@
 import os
 import json
-import http.client
-import ssl
+import threading
 import uuid
 import io
+import tempfile
 import wave
 from datetime import datetime, timedelta
 
@@ -24,22 +24,27 @@ def get_beijing_time():
         return datetime.now(TZ_BEIJING)
     else:
         return datetime.utcnow() + timedelta(hours=8)
-from flask import Flask, render_template, request, Response, stream_with_context, jsonify
+from flask import Flask, Request, render_template, request, Response, stream_with_context, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
+import click
 import boto3
 from botocore.config import Config
 from http import HTTPStatus
 
 # 导入集中配置
 from config import (
-    DASHSCOPE_API_KEY, DASHSCOPE_HOST, DASHSCOPE_CHAT_PATH,
+    DASHSCOPE_API_KEY, DASHSCOPE_CHAT_PATH,
     MODEL_TEXT, MODEL_VISION, MAX_TOKENS,
     R2_ACCOUNT_ID, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME,
     R2_PUBLIC_URL, check_r2_configured, get_r2_endpoint,
-    DAILY_LIMIT, MAX_FILE_SIZE, is_allowed_file,
-    HTTP_TIMEOUT_CHAT, HTTP_TIMEOUT_GENERAL,
+    DAILY_LIMIT, MAX_FILE_SIZE, MAX_IMAGE_UPLOAD_SIZE, UPLOAD_SPOOL_MEMORY, is_allowed_file,
+    HTTP_TIMEOUT_CHAT, HTTP_TIMEOUT_GENERAL, RAG_TIME_BUDGET_MS,
     SYSTEM_PROMPT
 )
 
+# DashScope 共享连接池
+from dashscope_client import post_stream, ping as dashscope_ping, get_pool_stats as get_dashscope_pool_stats
+
 # 导入结构化日志
 from logger import log_info, log_debug, log_warning, log_error, log_api_request, log_rag_search
 
@@ -57,31 +62,115 @@ from database import (
     init_db, get_or_create_user, create_session, get_user_sessions,
     get_session_messages, delete_session, update_session_title, add_message,
     get_session, create_knowledge_base, get_user_knowledge_bases,
-    delete_knowledge_base, add_document, get_documents
+    delete_knowledge_base, get_documents, get_ingestion_job
 )
 
 # RAG 模块导入
-from embedding import get_embedding
-from knowledge_base import (
-    process_document, add_document_chunks, delete_document_vectors,
-    delete_knowledge_base_vectors
+from embedding import (
+    get_embedding_backend, get_query_batcher_stats, get_rate_limiter_stats
+)
+from embedding_cache import get_embedding_cache_stats
+from knowledge_base import delete_document_vectors, delete_knowledge_base_vectors
+from ingestion import submit_document, recover_ingestion_jobs, job_status
+from retrieval import (
+    search_rag_sources, fit_kb_context, get_query_embedding_cache_stats, get_rag_result_cache_stats
 )
-from retrieval import search_knowledge_bases, search_history_sessions
+from retrieval_executor import (
+    RetrievalBudget, record_budget, get_retrieval_executor_stats, get_rag_budget_stats
+)
+
+class SizeLimitedSpooledFile(tempfile.SpooledTemporaryFile):
+    """写入量超过 limit 字节时抛出 413 的 SpooledTemporaryFile"""
+
+    def __init__(self, limit: int, max_size: int):
+        super().__init__(max_size=max_size, mode="w+b")
+        self.limit = limit
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        if self.written > self.limit:
+            raise RequestEntityTooLarge(f"文件大小超过限制（最大 {self.limit / (1024 * 1024):.1f}MB）")
+        return super().write(data)
+
+
+# 接收时限制文件大小的上传接口
+SIZE_LIMITED_UPLOAD_ENDPOINTS = {"upload_file", "upload_document"}
+
+
+class UploadRequest(Request):
+    """
+    上传文件边接收边写入 SpooledTemporaryFile（UPLOAD_SPOOL_MEMORY 以内留在内存，超过后转存磁盘），
+    上传接口的文件超过大小限制时在接收过程中立即返回 413，不必先收完整个文件
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint not in SIZE_LIMITED_UPLOAD_ENDPOINTS:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        # 图片压缩后才检查 MAX_FILE_SIZE，接收时按压缩前的上限
+        is_image = self.endpoint == "upload_file" and (content_type or "").startswith("image/")
+        limit = MAX_IMAGE_UPLOAD_SIZE if is_image else MAX_FILE_SIZE
+        return SizeLimitedSpooledFile(limit, UPLOAD_SPOOL_MEMORY)
+
+
+def file_size(f) -> int:
+    """文件对象的大小（不读取内容，保持当前读写位置）"""
+    position = f.tell()
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(position)
+    return size
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_file_too_large(e):
+    return jsonify({'error': e.description}), 413
+
+from database import USE_POSTGRES, get_db_pool_stats, init_vector_db
 
-# 初始化数据库
-init_db()
+_app_initialized = False
+_app_init_lock = threading.Lock()
 
-# 初始化连接池（PostgreSQL 模式）
-from database import USE_POSTGRES
-if USE_POSTGRES:
-    from database import init_connection_pool
-    init_connection_pool(min_conn=2, max_conn=20)
 
-# 初始化向量数据库（PostgreSQL 模式）
-from database import init_vector_db
-init_vector_db()
+def init_app():
+    """
+    启动初始化：建表、连接池、向量表，并恢复未完成的文档入库任务（每个进程只执行一次）
+
+    不在导入时执行：PDF 解析进程池的子进程会以 __mp_main__ 重新导入 `python app.py` 的主模块，
+    导入时初始化会让每个子进程都重复建表并恢复（重复执行）入库任务。
+    由 `python app.py`、gunicorn.conf.py 的 post_worker_init 调用，其他启动方式在首个请求前执行。
+    """
+    global _app_initialized
+    with _app_init_lock:
+        if _app_initialized:
+            return
+        # 初始化数据库
+        init_db()
+
+        # 初始化连接池（PostgreSQL 模式）
+        if USE_POSTGRES:
+            from database import init_connection_pool
+            init_connection_pool(min_conn=2, max_conn=20)
+
+        # 初始化向量数据库（PostgreSQL 模式）
+        init_vector_db()
+
+        # 恢复上次进程退出时未完成的文档入库任务
+        try:
+            recover_ingestion_jobs()
+        except Exception as e:
+            print(f"[入库] 恢复未完成任务失败: {e}")
+        _app_initialized = True
+
+
+@app.before_request
+def ensure_app_initialized():
+    if not _app_initialized:
+        init_app()
 
 
 # 应用关闭时清理资源
@@ -95,6 +184,8 @@ import atexit
 
 def cleanup_resources():
     """应用退出时关闭连接池"""
+    from dashscope_client import close_pool as close_dashscope_pool
+    close_dashscope_pool()
     if USE_POSTGRES:
         from database import close_pool
         close_pool()
@@ -152,8 +243,8 @@ def get_r2_client():
         region_name="auto"
     )
 
-def upload_to_r2(file_data, filename, content_type):
-    """Upload file to R2 and return public URL."""
+def upload_to_r2(file_obj, filename, content_type):
+    """Upload file object to R2 (streamed, multipart for large files) and return public URL."""
     s3 = get_r2_client()
     if not s3 or not R2_BUCKET_NAME:
         return None, "R2 not configured"
@@ -163,11 +254,11 @@ def upload_to_r2(file_data, filename, content_type):
         ext = filename.split('.')[-1] if '.' in filename else ''
         unique_name = f"{get_beijing_time().strftime('%Y%m%d')}/{uuid.uuid4().hex[:8]}.{ext}" if ext else f"{get_beijing_time().strftime('%Y%m%d')}/{uuid.uuid4().hex[:8]}"
         
-        s3.put_object(
-            Bucket=R2_BUCKET_NAME,
-            Key=unique_name,
-            Body=file_data,
-            ContentType=content_type
+        s3.upload_fileobj(
+            file_obj,
+            R2_BUCKET_NAME,
+            unique_name,
+            ExtraArgs={"ContentType": content_type}
         )
         
         # Return public URL using R2.dev domain
@@ -180,29 +271,21 @@ def upload_to_r2(file_data, filename, content_type):
 
 
 def call_dashscope_stream(messages):
-    """Use http.client to call DashScope API with streaming."""
+    """Call DashScope API with streaming over the shared connection pool."""
     # 根据消息内容自动选择模型
     model = select_model(messages)
     print(f"Using model: {model}")
     
-    payload = json.dumps({
+    payload = {
         "model": model,
         "messages": messages,
         "stream": True,
         "temperature": 0.8,
         "max_tokens": MAX_TOKENS,
-    })  # ensure_ascii=True by default, pure ASCII body
+    }  # json.dumps ensure_ascii=True by default, pure ASCII body
 
-    ctx = ssl.create_default_context()
-    conn = http.client.HTTPSConnection(DASHSCOPE_HOST, context=ctx, timeout=HTTP_TIMEOUT_CHAT)
-
-    headers = {
-        "Authorization": "Bearer " + DASHSCOPE_API_KEY,
-        "Content-Type": "application/json",
-    }
-
-    conn.request("POST", DASHSCOPE_CHAT_PATH, body=payload.encode("utf-8"), headers=headers)
-    resp = conn.getresponse()
+    # 通过共享连接池发送；返回的 conn 是连接租约，close() 时归还连接池
+    conn, resp = post_stream(DASHSCOPE_CHAT_PATH, payload, timeout=HTTP_TIMEOUT_CHAT)
 
     if resp.status != 200:
         err = resp.read().decode("utf-8", errors="replace")
@@ -274,27 +357,31 @@ def chat():
             try:
                 log_rag_search(last_user_msg, kb_ids, 0)
                 
-                # 知识库检索
-                kb_results = []
+                # 知识库检索与历史会话检索并发执行；检索受总时间预算约束，
+                # 预算耗尽时带着已就绪的上下文直接开始生成（首字延迟优先于偶尔缺少的参考片段）
+                budget = RetrievalBudget(RAG_TIME_BUDGET_MS) if RAG_TIME_BUDGET_MS > 0 else None
+                kb_results, history_results = search_rag_sources(
+                    last_user_msg, kb_ids, visitor_id, kb_top_k=5, history_top_k=3, budget=budget
+                )
+                if budget is not None:
+                    record_budget(budget, kb_results=len(kb_results), history_results=len(history_results))
                 if kb_ids:
-                    kb_results = search_knowledge_bases(kb_ids, last_user_msg, top_k=5)
                     log_info(f"[RAG] 知识库检索结果: {len(kb_results)} 条", type="rag_results", source="knowledge_base", count=len(kb_results))
-                
-                # 历史会话检索
-                history_results = []
                 if visitor_id:
-                    history_results = search_history_sessions(visitor_id, last_user_msg, top_k=3)
                     log_info(f"[RAG] 历史会话检索结果: {len(history_results)} 条", type="rag_results", source="history", count=len(history_results))
                 
                 # 构建上下文
                 context_parts = []
+                context_tokens = 0
                 if kb_results:
                     context_parts.append("=== 知识库参考 ===")
-                    for i, r in enumerate(kb_results[:3], 1):
+                    # 按 token 预算放入片段（块的 token 数在入库时已记录）
+                    for i, (r, text, tokens) in enumerate(fit_kb_context(kb_results[:3]), 1):
                         source = r.get("metadata", {}).get("filename", "未知")
                         context_parts.append(f"[{i}] 来源：{source}")
-                        context_parts.append(f"内容：{r['text'][:300]}...")
+                        context_parts.append(f"内容：{text}" + ("..." if text is not r["text"] else ""))
                         context_parts.append("")
+                        context_tokens += tokens
                 
                 if history_results:
                     context_parts.append("=== 历史对话参考 ===")
@@ -305,7 +392,7 @@ def chat():
                 
                 if context_parts:
                     rag_context = "\n".join(context_parts)
-                    print(f"[RAG] 上下文构建完成，长度: {len(rag_context)}")
+                    print(f"[RAG] 上下文构建完成，长度: {len(rag_context)}，知识库片段 {context_tokens} tokens")
             except Exception as e:
                 print(f"[RAG] 检索失败: {e}")
 
@@ -473,14 +560,28 @@ def get_visitor_remaining(visitor_id):
 def check():
     configured = bool(DASHSCOPE_API_KEY)
     r2_configured = check_r2_configured()
+    result = {
+        "configured": configured,
+        "model_text": MODEL_TEXT,
+        "model_vision": MODEL_VISION,
+        "r2_configured": r2_configured,
+        "daily_limit": DAILY_LIMIT,
+    }
+    # ?probe=1 时通过连接池探测 DashScope 连通性
+    if configured and request.args.get("probe"):
+        result["dashscope"] = dashscope_ping(timeout=HTTP_TIMEOUT_GENERAL)
+    result["dashscope_pool"] = get_dashscope_pool_stats()
+    result["db_pool"] = get_db_pool_stats()
+    result["embedding_backend"] = get_embedding_backend().model
+    result["embedding_cache"] = get_embedding_cache_stats()
+    result["query_embedding_batcher"] = get_query_batcher_stats()
+    result["query_embedding_cache"] = get_query_embedding_cache_stats()
+    result["rag_result_cache"] = get_rag_result_cache_stats()
+    result["retrieval_executor"] = get_retrieval_executor_stats()
+    result["rag_budget"] = get_rag_budget_stats()
+    result["embedding_rate_limiter"] = get_rate_limiter_stats()
     return Response(
-        json.dumps({
-            "configured": configured,
-            "model_text": MODEL_TEXT,
-            "model_vision": MODEL_VISION,
-            "r2_configured": r2_configured,
-            "daily_limit": DAILY_LIMIT
-        }).encode("ascii"),
+        json.dumps(result).encode("ascii"),
         content_type="application/json",
     )
 
@@ -534,49 +635,45 @@ def increment_usage():
     )
 
 
-def extract_pdf_text(file_data):
-    """Extract text content from PDF file."""
+def extract_pdf_text(pdf_file):
+    """Extract text content from PDF file (binary file object or bytes)."""
+    max_length = 15000  # 约 5000 汉字
     try:
         import io
+        from extraction import PdfPages
         
-        # 尝试导入 PyPDF2 或 pypdf
         try:
-            from PyPDF2 import PdfReader
+            if isinstance(pdf_file, (bytes, bytearray)):
+                pdf_file = io.BytesIO(pdf_file)
+            pages = PdfPages(pdf_file)
         except ImportError:
-            try:
-                from pypdf import PdfReader
-            except ImportError:
-                return {
-                    "text": "",
-                    "pages": 0,
-                    "success": False,
-                    "error": "PDF 库未安装，请运行: pip install PyPDF2"
-                }
-        
-        pdf_file = io.BytesIO(file_data)
-        reader = PdfReader(pdf_file)
+            return {
+                "text": "",
+                "pages": 0,
+                "success": False,
+                "error": "PDF 库未安装，请运行: pip install pypdf"
+            }
         
         text_content = []
-        total_pages = len(reader.pages)
+        total_pages = len(pages)
+        joined_length = -2  # "\n\n".join 后的长度
         
         print(f"PDF 总页数: {total_pages}")
         
-        for i, page in enumerate(reader.pages):
-            try:
-                page_text = page.extract_text()
-                if page_text and page_text.strip():
-                    text_content.append(f"--- 第 {i+1} 页 ---\n{page_text}")
-                    print(f"第 {i+1} 页提取成功，长度: {len(page_text)}")
-                else:
-                    print(f"第 {i+1} 页无文本内容（可能是扫描件或图片）")
-            except Exception as e:
-                print(f"提取第 {i+1} 页失败: {e}")
-                continue
+        for i, page_text in pages:
+            if page_text.strip():
+                text_content.append(f"--- 第 {i+1} 页 ---\n{page_text}")
+                joined_length += len(text_content[-1]) + 2
+                print(f"第 {i+1} 页提取成功，长度: {len(page_text)}")
+            else:
+                print(f"第 {i+1} 页无文本内容（可能是扫描件或图片）")
+            # 已超过展示上限（结果必然被截断），后续页不再解析
+            if joined_length > max_length:
+                break
         
         full_text = "\n\n".join(text_content)
         
         # 如果内容太长，截断并提示
-        max_length = 15000  # 约 5000 汉字
         if len(full_text) > max_length:
             full_text = full_text[:max_length] + "\n\n... (内容已截断，仅显示前 15000 字符)"
         
@@ -632,21 +729,22 @@ def upload_file():
             content_type="application/json"
         )
     
-    # Read file data
-    file_data = file.read()
-    original_size = len(file_data)
+    # 上传内容已在接收时写入临时文件，后续各步骤直接使用文件对象
+    upload = file.stream
+    original_size = file_size(upload)
     
     # 检查是否为图片，如果是则压缩
     is_image = file.content_type and file.content_type.startswith('image/')
     if is_image:
-        file_data = compress_image(file_data, file.filename)
-        compressed_size = len(file_data)
+        upload = compress_image(upload, file.filename)
+        compressed_size = file_size(upload)
         if original_size != compressed_size:
             log_info(f"图片压缩: {original_size} -> {compressed_size} bytes", 
                     type="image_compress", original_size=original_size, compressed_size=compressed_size)
     
     # 检查文件大小
-    if len(file_data) > MAX_FILE_SIZE:
+    size = file_size(upload)
+    if size > MAX_FILE_SIZE:
         max_size_mb = MAX_FILE_SIZE / (1024 * 1024)
         return Response(
             json.dumps({"error": f"文件大小超过限制（最大 {max_size_mb:.1f}MB）"}).encode("utf-8"),
@@ -657,7 +755,8 @@ def upload_file():
     content_type = file.content_type or "application/octet-stream"
     
     # Upload to R2
-    url, error = upload_to_r2(file_data, file.filename, content_type)
+    upload.seek(0)
+    url, error = upload_to_r2(upload, file.filename, content_type)
     
     if error:
         return Response(
@@ -669,12 +768,13 @@ def upload_file():
     # 如果是 PDF，提取文本内容
     pdf_content = None
     if file.filename.lower().endswith('.pdf'):
-        pdf_content = extract_pdf_text(file_data)
+        upload.seek(0)
+        pdf_content = extract_pdf_text(upload)
     
     response_data = {
         "url": url,
         "filename": file.filename,
-        "size": len(file_data)
+        "size": size
     }
     
     if pdf_content:
@@ -851,25 +951,29 @@ def convert_to_wav(audio_data):
     return wav_buffer.getvalue()
 
 
-def compress_image(image_data: bytes, filename: str, max_size: int = 1920, quality: int = 85) -> bytes:
+def compress_image(image_file, filename: str, max_size: int = 1920, quality: int = 85):
     """
     压缩图片
     
     Args:
-        image_data: 原始图片数据
+        image_file: 原始图片（可 seek 的二进制文件对象）
         filename: 文件名（用于判断格式）
         max_size: 最大边长（像素）
         quality: JPEG 压缩质量（1-95）
     
     Returns:
-        压缩后的图片数据
+        压缩后的图片（BytesIO）；未压缩或压缩后反而更大时返回原文件对象
     """
     try:
         from PIL import Image
         import io
         
-        # 从 bytes 加载图片
-        img = Image.open(io.BytesIO(image_data))
+        original_size = file_size(image_file)
+        image_file.seek(0)
+        img = Image.open(image_file)
+        
+        # JPEG 解码时直接按 1/2、1/4、1/8 缩小到不小于目标尺寸，不解出全尺寸位图
+        img.draft('RGB', (max_size, max_size))
         
         # 转换为 RGB（处理 PNG 透明通道等）
         if img.mode in ('RGBA', 'P'):
@@ -899,20 +1003,22 @@ def compress_image(image_data: bytes, filename: str, max_size: int = 1920, quali
             # 默认 JPEG
             img.save(output, format='JPEG', quality=quality, optimize=True)
         
-        compressed_data = output.getvalue()
-        
         # 如果压缩后反而更大，返回原图
-        if len(compressed_data) >= len(image_data):
-            return image_data
+        if output.tell() >= original_size:
+            image_file.seek(0)
+            return image_file
         
-        return compressed_data
+        output.seek(0)
+        return output
         
     except ImportError:
         log_warning("PIL 未安装，跳过图片压缩", type="image_compress_skip")
-        return image_data
+        image_file.seek(0)
+        return image_file
     except Exception as e:
         log_error(f"图片压缩失败: {e}", type="image_compress_error")
-        return image_data
+        image_file.seek(0)
+        return image_file
 
 
 # ========== 会话管理 API ==========
@@ -1072,7 +1178,7 @@ def delete_kb(kb_id):
 
 @app.route("/api/knowledge-bases/<kb_id>/documents", methods=["POST"])
 def upload_document(kb_id):
-    """上传文档到知识库"""
+    """上传文档到知识库（文件落盘后立即返回任务 ID，解析/嵌入/写入在后台执行）"""
     user_id = request.form.get('visitor_id')
     if not user_id:
         return jsonify({'error': 'Missing visitor_id'}), 400
@@ -1089,50 +1195,25 @@ def upload_document(kb_id):
         return jsonify({'error': f"不支持的文件类型。允许的类型: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
     
     try:
-        # 保存临时文件前先检查大小
-        file_data = file.read()
-        if len(file_data) > MAX_FILE_SIZE:
-            max_size_mb = MAX_FILE_SIZE / (1024 * 1024)
-            return jsonify({'error': f"文件大小超过限制（最大 {max_size_mb:.1f}MB）"}), 413
-        
-        # 重置文件指针
-        file.seek(0)
-        # 保存临时文件
-        import tempfile
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
-            file.save(tmp.name)
-            tmp_path = tmp.name
-        
-        # 处理文档
+        # 文件大小已在接收时检查（超过 MAX_FILE_SIZE 直接返回 413）；
+        # 保存到暂存目录（从接收时写入的临时文件分块复制）并登记入库任务
         content_type = file.content_type or 'application/octet-stream'
-        chunks = process_document(tmp_path, file.filename, content_type)
+        job = submit_document(kb_id, file.filename, content_type, file.save)
         
-        # 生成嵌入
-        if chunks:
-            embeddings = []
-            for chunk in chunks:
-                emb = get_embedding(chunk['text'])
-                embeddings.append(emb)
-            
-            # 存储到向量数据库
-            doc_id = f"doc_{uuid.uuid4().hex[:8]}"
-            add_document_chunks(kb_id, doc_id, chunks, embeddings)
-            
-            # 记录到数据库
-            add_document(kb_id, doc_id, file.filename, content_type, len(chunks))
-        
-        # 清理临时文件
-        os.unlink(tmp_path)
-        
-        return jsonify({
-            'success': True,
-            'doc_id': doc_id,
-            'chunk_count': len(chunks)
-        })
+        return jsonify({'success': True, **job}), 202
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route("/api/ingestion-jobs/<job_id>", methods=["GET"])
+def get_ingestion_job_status(job_id):
+    """查询文档入库任务的状态与进度"""
+    job = get_ingestion_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status(job))
+
+
 @app.route("/api/knowledge-bases/<kb_id>/documents", methods=["GET"])
 def list_documents(kb_id):
     """获取知识库的文档列表"""
@@ -1207,24 +1288,42 @@ def rag_search():
             'history_results': []
         }
         
-        # 知识库检索
-        if kb_ids:
-            kb_results = search_knowledge_bases(kb_ids, query, top_k=5)
-            results['knowledge_base_results'] = kb_results
-        
-        # 历史会话检索
-        if user_id:
-            history_results = search_history_sessions(user_id, query, top_k=3)
-            results['history_results'] = history_results
+        # 知识库检索与历史会话检索并发执行
+        kb_results, history_results = search_rag_sources(
+            query, kb_ids, user_id, kb_top_k=5, history_top_k=3
+        )
+        results['knowledge_base_results'] = kb_results
+        results['history_results'] = history_results
         
         return jsonify(results)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.cli.command("reindex-vectors")
+@click.option("--rebuild", is_flag=True, help="即使索引已是最新也强制重建")
+def reindex_vectors_command(rebuild):
+    """创建或重建 document_chunks 向量索引（PostgreSQL）"""
+    from database import ensure_vector_index
+    result = ensure_vector_index(rebuild=rebuild)
+    click.echo(json.dumps(result, ensure_ascii=False))
+
+
+@app.cli.command("backfill-tsv")
+@click.option("--batch-size", default=500, show_default=True, help="每批处理的行数")
+def backfill_tsv_command(batch_size):
+    """为已有文档块补齐关键词检索列 content_tsv（PostgreSQL）"""
+    if not USE_POSTGRES:
+        click.echo("SQLite 模式无需补齐")
+        return
+    from knowledge_base import backfill_content_tsv
+    click.echo(f"补齐完成: {backfill_content_tsv(batch_size)} 行")
+
+
 if __name__ == "__main__":
     import sys
 
+    init_app()
     port = int(os.getenv("PORT", "5002"))
     use_ssl = "--ssl" in sys.argv
     if use_ssl:
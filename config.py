@@ -26,10 +26,71 @@ USE_POSTGRES = DATABASE_URL and DATABASE_URL.startswith("postgresql")
 # ChromaDB 配置（本地开发）
 CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", "./chroma_db")
 
+# 本地向量存储后端：chroma（默认）| numpy（内置 memmap 矩阵，无需 chromadb）
+LOCAL_VECTOR_STORE = os.getenv("LOCAL_VECTOR_STORE", "chroma")
+LOCAL_VECTOR_STORE_PATH = os.getenv("LOCAL_VECTOR_STORE_PATH", "./vector_store")
+LOCAL_VECTOR_DTYPE = os.getenv("LOCAL_VECTOR_DTYPE", "float32")  # float32 | int8（量化，约 1/4 存储）；仅对新建知识库生效
+
 # ========== 模型配置 ==========
 MODEL_TEXT = os.getenv("MODEL_TEXT", "qwen-plus")
 MODEL_VISION = os.getenv("MODEL_VISION", "qwen-vl-plus")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-v2")
+EMBEDDING_VECTOR_FORMAT = os.getenv("EMBEDDING_VECTOR_FORMAT", "list")  # list | float32（紧凑 float32 缓冲区）
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "dashscope")  # dashscope | local（离线确定性哈希向量）
+EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", "1536"))  # 需与 document_chunks.embedding 维度一致
+
+# ========== 嵌入批处理配置 ==========
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "25"))  # DashScope text-embedding-v2 单次最多 25 条
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))  # 同时在途的批次数
+EMBEDDING_COALESCE_WINDOW_MS = float(os.getenv("EMBEDDING_COALESCE_WINDOW_MS", "5"))  # 查询嵌入合并窗口，0 表示不合并
+EMBEDDING_COALESCE_MAX_BATCH = int(os.getenv("EMBEDDING_COALESCE_MAX_BATCH", "25"))  # 单次合并的最大查询数
+
+# ========== 嵌入限流与退避配置 ==========
+EMBEDDING_RATE_INITIAL = float(os.getenv("EMBEDDING_RATE_INITIAL", "10"))  # 初始请求速率（次/秒）
+EMBEDDING_RATE_MIN = float(os.getenv("EMBEDDING_RATE_MIN", "0.5"))  # 限流后最低速率
+EMBEDDING_RATE_MAX = float(os.getenv("EMBEDDING_RATE_MAX", "50"))  # 爬升上限
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", "8"))  # 最大并发请求数（AIMD 上限）
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "4"))
+EMBEDDING_BACKOFF_BASE = float(os.getenv("EMBEDDING_BACKOFF_BASE", "0.5"))  # 退避基数（秒）
+EMBEDDING_BACKOFF_MAX = float(os.getenv("EMBEDDING_BACKOFF_MAX", "20"))  # 单次退避上限（秒）
+
+# ========== 嵌入缓存配置 ==========
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "5000"))  # 进程内 LRU 条目数
+EMBEDDING_CACHE_MAX_ROWS = int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", "200000"))  # 数据库缓存最大行数
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1000"))  # 检索层查询向量缓存条目数，0 表示关闭
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "600"))  # 查询向量缓存有效期（秒）
+RAG_RESULT_CACHE_SIZE = int(os.getenv("RAG_RESULT_CACHE_SIZE", "500"))  # 检索结果缓存条目数，0 表示关闭
+RAG_RESULT_CACHE_TTL = float(os.getenv("RAG_RESULT_CACHE_TTL", "300"))  # 检索结果缓存有效期（秒）
+RAG_MAX_WORKERS = int(os.getenv("RAG_MAX_WORKERS", "16"))  # 检索分路并发线程数（含嵌套子分路）
+RAG_LEG_TIMEOUT_MS = float(os.getenv("RAG_LEG_TIMEOUT_MS", "2000"))  # 单路检索超时（毫秒），超时的一路被丢弃
+RAG_TIME_BUDGET_MS = float(os.getenv("RAG_TIME_BUDGET_MS", "1500"))  # 聊天接口检索总预算（毫秒，含 DashScope 查询嵌入往返），到期后带着已就绪的上下文开始生成，0 表示不限
+
+# ========== 向量索引配置（pgvector）==========
+VECTOR_INDEX_METHOD = os.getenv("VECTOR_INDEX_METHOD", "hnsw")  # hnsw | ivfflat
+VECTOR_HNSW_M = int(os.getenv("VECTOR_HNSW_M", "16"))  # HNSW 每层最大邻居数
+VECTOR_HNSW_EF_CONSTRUCTION = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", "64"))  # HNSW 构建时候选集大小
+VECTOR_HNSW_EF_SEARCH = int(os.getenv("VECTOR_HNSW_EF_SEARCH", "100"))  # HNSW 查询时候选集大小（越大召回越高）
+VECTOR_IVFFLAT_PROBES = int(os.getenv("VECTOR_IVFFLAT_PROBES", "10"))  # ivfflat 查询时探测的列表数
+VECTOR_IVFFLAT_MIN_ROWS = int(os.getenv("VECTOR_IVFFLAT_MIN_ROWS", "10000"))  # ivfflat 行数不足时不建索引（精确扫描）
+
+# ========== 文档入库任务配置 ==========
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))  # 后台入库线程数
+INGESTION_SPOOL_DIR = os.getenv("INGESTION_SPOOL_DIR", "./ingestion_spool")  # 上传文件暂存目录（任务结束后删除）
+INGESTION_BATCH_SIZE = int(os.getenv("INGESTION_BATCH_SIZE", "100"))  # 每批嵌入并写入的块数（进度按批更新）
+INGESTION_HEARTBEAT_INTERVAL = float(os.getenv("INGESTION_HEARTBEAT_INTERVAL", "30"))  # 执行中的任务刷新 updated_at 的间隔秒数
+INGESTION_STALE_AFTER = float(os.getenv("INGESTION_STALE_AFTER", "120"))  # processing 任务超过该秒数没有心跳视为进程已退出，启动时重新排队
+
+# ========== 文档解析配置 ==========
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "0")) or (os.cpu_count() or 1)  # PDF 并行解析进程数（0 表示按 CPU 核数）
+EXTRACTION_PARALLEL_MIN_PAGES = int(os.getenv("EXTRACTION_PARALLEL_MIN_PAGES", "32"))  # 达到该页数的 PDF 才并行解析
+EXTRACTION_PAGES_PER_TASK = int(os.getenv("EXTRACTION_PAGES_PER_TASK", "8"))  # 每个解析任务的页数
+
+# ========== 文档分块配置 ==========
+CHUNK_SIZE_TOKENS = int(os.getenv("CHUNK_SIZE_TOKENS", "500"))  # 每块最多的 token 数
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "50"))  # 相邻块重叠的 token 数
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "cl100k_base")  # tiktoken 编码
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))  # 上下文中知识库片段的 token 预算
 
 # ========== 限制配置 ==========
 DAILY_LIMIT = int(os.getenv("DAILY_LIMIT", "10"))
@@ -37,6 +98,8 @@ MAX_TOKENS = int(os.getenv("MAX_TOKENS", "6000"))
 
 # ========== 文件上传限制 ==========
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "2097152"))  # 默认 2MB (2 * 1024 * 1024)
+MAX_IMAGE_UPLOAD_SIZE = int(os.getenv("MAX_IMAGE_UPLOAD_SIZE", "20971520"))  # 图片压缩前的上传上限（压缩后仍不能超过 MAX_FILE_SIZE），默认 20MB
+UPLOAD_SPOOL_MEMORY = int(os.getenv("UPLOAD_SPOOL_MEMORY", "524288"))  # 上传文件在内存中缓存的上限，超过后转存临时文件，默认 512KB
 ALLOWED_EXTENSIONS = {
     'txt', 'md', 'pdf', 'docx',  # 文档
     'jpg', 'jpeg', 'png', 'gif', 'webp',  # 图片
@@ -52,6 +115,11 @@ HTTP_TIMEOUT_GENERAL = int(os.getenv("HTTP_TIMEOUT_GENERAL", "30"))  # 通用接
 DASHSCOPE_HOST = "dashscope.aliyuncs.com"
 DASHSCOPE_CHAT_PATH = "/compatible-mode/v1/chat/completions"
 DASHSCOPE_EMBEDDING_PATH = "/api/v1/services/embeddings/text-embedding/text-embedding"
+DASHSCOPE_MODELS_PATH = "/compatible-mode/v1/models"  # 健康检查使用
+
+# DashScope 长连接池
+DASHSCOPE_POOL_SIZE = int(os.getenv("DASHSCOPE_POOL_SIZE", "8"))  # 最大空闲连接数
+DASHSCOPE_POOL_IDLE_TIMEOUT = float(os.getenv("DASHSCOPE_POOL_IDLE_TIMEOUT", "50"))  # 空闲超过该秒数的连接不再复用
 
 # ========== 系统提示词 ==========
 SYSTEM_PROMPT = """你是专业的头脑风暴助手，任务是通过深度提问帮助用户完善想法。
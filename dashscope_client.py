@@ -0,0 +1,293 @@
+"""
+DashScope HTTP 客户端 - 共享长连接池
+所有嵌入、聊天和健康检查请求都经由此模块，复用 TCP + TLS 连接
+"""
+import http.client
+import json
+import select
+import ssl
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from config import (
+    DASHSCOPE_API_KEY, DASHSCOPE_HOST, DASHSCOPE_MODELS_PATH,
+    DASHSCOPE_POOL_SIZE, DASHSCOPE_POOL_IDLE_TIMEOUT,
+    HTTP_TIMEOUT_GENERAL
+)
+
+# 复用连接时可能遇到的“服务端已关闭”类错误，允许换新连接重试一次
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+    ConnectionAbortedError,
+)
+
+
+class _PooledHTTPSConnection(http.client.HTTPSConnection):
+    """带 TLS 会话复用的 HTTPS 连接"""
+
+    def __init__(self, pool: "DashScopeConnectionPool", timeout: float):
+        super().__init__(pool.host, context=pool.ssl_context, timeout=timeout)
+        self._pool = pool
+        self.last_used = time.monotonic()
+
+    def connect(self):
+        """建立 TCP 连接并握手，尽量恢复上一次的 TLS 会话"""
+        start = time.monotonic()
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(
+            self.sock,
+            server_hostname=server_hostname,
+            session=self._pool.tls_session
+        )
+        self._pool._record_handshake(self.sock, time.monotonic() - start)
+
+
+class ConnectionLease:
+    """
+    流式响应的连接租约
+
+    调用方读完响应后调用 close()，完整读完且可复用的连接会归还连接池，
+    否则直接关闭。
+    """
+
+    def __init__(self, pool: "DashScopeConnectionPool", conn: _PooledHTTPSConnection,
+                 resp: http.client.HTTPResponse):
+        self._pool = pool
+        self._conn = conn
+        self._resp = resp
+        self._released = False
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        reusable = self._resp.isclosed() and not self._resp.will_close
+        self._pool.release(self._conn, reusable=reusable)
+
+
+class DashScopeConnectionPool:
+    """线程安全的 DashScope HTTPS 长连接池"""
+
+    def __init__(self, host: str = DASHSCOPE_HOST, max_idle: int = DASHSCOPE_POOL_SIZE,
+                 idle_timeout: float = DASHSCOPE_POOL_IDLE_TIMEOUT):
+        self.host = host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl.create_default_context()
+        self.tls_session = None
+        self._idle = []  # LIFO，优先复用最近使用的连接
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "pool_hits": 0,
+            "new_connections": 0,
+            "tls_sessions_reused": 0,
+            "stale_discarded": 0,
+            "stale_retries": 0,
+            "handshake_ms_total": 0.0,
+        }
+
+    # ---------- 连接管理 ----------
+
+    def _record_handshake(self, sock, elapsed: float):
+        with self._lock:
+            self._stats["new_connections"] += 1
+            self._stats["handshake_ms_total"] += elapsed * 1000
+            if getattr(sock, "session_reused", False):
+                self._stats["tls_sessions_reused"] += 1
+
+    @staticmethod
+    def _is_alive(conn: _PooledHTTPSConnection) -> bool:
+        """空闲连接上不应有可读数据；可读通常意味着服务端已关闭连接"""
+        sock = conn.sock
+        if sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def acquire(self, timeout: float) -> Tuple[_PooledHTTPSConnection, bool]:
+        """
+        获取一个连接
+
+        Returns:
+            (连接, 是否为复用的空闲连接)
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._stats["requests"] += 1
+            while self._idle:
+                conn = self._idle.pop()
+                if now - conn.last_used > self.idle_timeout or not self._is_alive(conn):
+                    self._stats["stale_discarded"] += 1
+                    conn.close()
+                    continue
+                self._stats["pool_hits"] += 1
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+                return conn, True
+
+        conn = _PooledHTTPSConnection(self, timeout)
+        conn.connect()
+        return conn, False
+
+    def release(self, conn: _PooledHTTPSConnection, reusable: bool = True):
+        """归还连接；不可复用或池已满时关闭"""
+        if reusable and conn.sock is not None:
+            session = getattr(conn.sock, "session", None)
+            conn.last_used = time.monotonic()
+            with self._lock:
+                if session is not None:
+                    self.tls_session = session
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    # ---------- 请求 ----------
+
+    def _send(self, method: str, path: str, body: Optional[bytes], headers: Dict,
+              timeout: float) -> Tuple[_PooledHTTPSConnection, http.client.HTTPResponse]:
+        """发送请求并返回 (连接, 响应)；复用连接已失效时换新连接重试一次"""
+        for attempt in range(2):
+            conn, reused = self.acquire(timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except _STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused and attempt == 0:
+                    with self._lock:
+                        self._stats["stale_retries"] += 1
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                headers: Optional[Dict] = None, timeout: float = HTTP_TIMEOUT_GENERAL
+                ) -> Tuple[int, Dict[str, str], bytes]:
+        """
+        发送请求并完整读取响应
+
+        Returns:
+            (状态码, 响应头, 响应体)
+        """
+        conn, resp = self._send(method, path, body, headers or {}, timeout)
+        try:
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        self.release(conn, reusable=not resp.will_close)
+        return resp.status, dict(resp.getheaders()), data
+
+    def stream(self, method: str, path: str, body: Optional[bytes] = None,
+               headers: Optional[Dict] = None, timeout: float = HTTP_TIMEOUT_GENERAL
+               ) -> Tuple[ConnectionLease, http.client.HTTPResponse]:
+        """发送请求并返回未读取的响应，调用方负责读取后关闭租约"""
+        conn, resp = self._send(method, path, body, headers or {}, timeout)
+        return ConnectionLease(self, conn, resp), resp
+
+    def get_stats(self) -> Dict:
+        """连接池统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle_connections"] = len(self._idle)
+        new_conns = stats["new_connections"]
+        stats["handshake_ms_avg"] = round(stats["handshake_ms_total"] / new_conns, 2) if new_conns else 0.0
+        stats["handshake_ms_total"] = round(stats["handshake_ms_total"], 2)
+        stats["hit_rate"] = round(stats["pool_hits"] / stats["requests"], 4) if stats["requests"] else 0.0
+        return stats
+
+
+# 全局连接池（进程内单例）
+_pool: Optional[DashScopeConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> DashScopeConnectionPool:
+    """获取 DashScope 连接池（单例）"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = DashScopeConnectionPool()
+    return _pool
+
+
+def _auth_headers() -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {DASHSCOPE_API_KEY}",
+        "Content-Type": "application/json",
+    }
+
+
+def post_json(path: str, payload: Dict, timeout: float = HTTP_TIMEOUT_GENERAL
+              ) -> Tuple[int, Dict[str, str], Dict]:
+    """
+    POST JSON 请求并解析 JSON 响应
+
+    Returns:
+        (状态码, 响应头, 响应 JSON)
+    """
+    body = json.dumps(payload).encode("utf-8")
+    status, headers, data = get_pool().request("POST", path, body=body,
+                                               headers=_auth_headers(), timeout=timeout)
+    try:
+        parsed = json.loads(data.decode("utf-8")) if data else {}
+    except ValueError:
+        parsed = {"message": data.decode("utf-8", errors="replace")[:200]}
+    return status, headers, parsed
+
+
+def post_stream(path: str, payload: Dict, timeout: float = HTTP_TIMEOUT_GENERAL
+                ) -> Tuple[ConnectionLease, http.client.HTTPResponse]:
+    """POST JSON 请求并返回流式响应（SSE）"""
+    body = json.dumps(payload).encode("utf-8")
+    return get_pool().stream("POST", path, body=body, headers=_auth_headers(), timeout=timeout)
+
+
+def ping(timeout: float = HTTP_TIMEOUT_GENERAL) -> Dict:
+    """通过连接池探测 DashScope 连通性"""
+    start = time.monotonic()
+    try:
+        status, _, _ = get_pool().request("GET", DASHSCOPE_MODELS_PATH,
+                                          headers=_auth_headers(), timeout=timeout)
+        return {
+            "reachable": True,
+            "status": status,
+            "latency_ms": round((time.monotonic() - start) * 1000, 2)
+        }
+    except Exception as e:
+        return {
+            "reachable": False,
+            "error": str(e),
+            "latency_ms": round((time.monotonic() - start) * 1000, 2)
+        }
+
+
+def get_pool_stats() -> Dict:
+    """获取连接池统计信息"""
+    return get_pool().get_stats()
+
+
+def close_pool():
+    """关闭连接池中的空闲连接"""
+    if _pool is not None:
+        _pool.close_all()
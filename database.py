@@ -4,9 +4,16 @@
 使用连接池优化性能
 """
 import os
+import threading
+import time
 from datetime import datetime
 from contextlib import contextmanager
 
+from config import (
+    VECTOR_INDEX_METHOD, VECTOR_HNSW_M, VECTOR_HNSW_EF_CONSTRUCTION, VECTOR_IVFFLAT_MIN_ROWS
+)
+from logger import log_db_operation
+
 # 设置东八区时区（北京时间）
 try:
     from zoneinfo import ZoneInfo
@@ -36,17 +43,33 @@ USE_POSTGRES = DATABASE_URL and DATABASE_URL.startswith("postgresql")
 # PostgreSQL 连接池
 _pg_pool = None
 
+# 连接池占用槽位：连接耗尽时排队等待，而不是直接抛出 PoolError
+_pg_pool_slots = None
+_pg_max_conn = 0
+_pg_in_use = 0  # 已借出的连接数（由 get_db 维护，受 _pool_stats_lock 保护）
+DB_POOL_WAIT_TIMEOUT = float(os.getenv("DB_POOL_WAIT_TIMEOUT", "10"))  # 等待空闲连接的最长秒数
+
+# 连接获取统计
+_pool_stats_lock = threading.Lock()
+_pool_stats = {
+    "acquisitions": 0,
+    "wait_ms_total": 0.0,
+    "wait_ms_max": 0.0,
+    "wait_timeouts": 0,
+    "broken_connections": 0,
+}
+
 # SQLite 连接（单连接复用）
 _sqlite_conn = None
 
 if USE_POSTGRES:
     import psycopg2
-    from psycopg2 import pool
+    from psycopg2 import pool, IntegrityError
     from psycopg2.extras import RealDictCursor
     
     def init_connection_pool(min_conn=1, max_conn=10):
         """初始化 PostgreSQL 连接池"""
-        global _pg_pool
+        global _pg_pool, _pg_pool_slots, _pg_max_conn
         if _pg_pool is None:
             try:
                 _pg_pool = pool.ThreadedConnectionPool(
@@ -60,6 +83,8 @@ if USE_POSTGRES:
                     keepalives_interval=10,
                     keepalives_count=5
                 )
+                _pg_pool_slots = threading.BoundedSemaphore(max_conn)
+                _pg_max_conn = max_conn
                 print(f"[DB] PostgreSQL 连接池初始化成功 (min={min_conn}, max={max_conn})")
             except Exception as e:
                 print(f"[DB] 连接池初始化失败: {e}")
@@ -73,54 +98,71 @@ if USE_POSTGRES:
             _pg_pool = init_connection_pool()
         return _pg_pool
     
-    @contextmanager
-    def get_db():
-        """PostgreSQL 连接上下文管理器（使用连接池，带健康检查）"""
-        pg_pool = get_pool()
-        conn = None
+    def _acquire_connection(pg_pool):
+        """从连接池取出一个健康的连接（带健康检查，失效连接最多重试 3 次）"""
         max_retries = 3
-        retry_count = 0
-        
-        while retry_count < max_retries:
+        for retry_count in range(max_retries):
+            conn = pg_pool.getconn()
             try:
-                conn = pg_pool.getconn()
                 # 健康检查：执行简单查询确认连接有效
                 with conn.cursor() as cur:
                     cur.execute('SELECT 1')
                     cur.fetchone()
-                yield conn
-                return
+                return conn
             except psycopg2.OperationalError as e:
                 # 连接失效，关闭并重试
                 print(f"[DB] 连接失效，重试 {retry_count + 1}/{max_retries}: {e}")
-                if conn:
-                    try:
-                        pg_pool.putconn(conn, close=True)
-                    except:
-                        pass
-                    conn = None
-                retry_count += 1
-                if retry_count >= max_retries:
+                with _pool_stats_lock:
+                    _pool_stats["broken_connections"] += 1
+                try:
+                    pg_pool.putconn(conn, close=True)
+                except:
+                    pass
+                if retry_count + 1 >= max_retries:
                     raise
-            except Exception:
-                raise
+    
+    @contextmanager
+    def get_db():
+        """PostgreSQL 连接上下文管理器（使用连接池，带健康检查；连接耗尽时排队等待）"""
+        global _pg_in_use
+        pg_pool = get_pool()
+        start = time.perf_counter()
+        if not _pg_pool_slots.acquire(timeout=DB_POOL_WAIT_TIMEOUT):
+            with _pool_stats_lock:
+                _pool_stats["wait_timeouts"] += 1
+            raise pool.PoolError(f"等待数据库连接超时 ({DB_POOL_WAIT_TIMEOUT}s)")
+        try:
+            conn = _acquire_connection(pg_pool)
+            wait_ms = (time.perf_counter() - start) * 1000
+            with _pool_stats_lock:
+                _pool_stats["acquisitions"] += 1
+                _pool_stats["wait_ms_total"] += wait_ms
+                _pool_stats["wait_ms_max"] = max(_pool_stats["wait_ms_max"], wait_ms)
+                _pg_in_use += 1
+            try:
+                yield conn
             finally:
-                if conn:
-                    try:
-                        pg_pool.putconn(conn)
-                    except:
-                        pass
+                try:
+                    pg_pool.putconn(conn)
+                except:
+                    pass
+                with _pool_stats_lock:
+                    _pg_in_use -= 1
+        finally:
+            _pg_pool_slots.release()
     
     def close_pool():
         """关闭连接池"""
-        global _pg_pool
+        global _pg_pool, _pg_pool_slots
         if _pg_pool:
             _pg_pool.closeall()
             _pg_pool = None
+            _pg_pool_slots = None
             print("[DB] PostgreSQL 连接池已关闭")
 
 else:
     import sqlite3
+    from sqlite3 import IntegrityError
     from threading import Lock
     
     DB_PATH = os.getenv("DB_PATH", "brainstorm.db")
@@ -157,6 +199,49 @@ else:
             print("[DB] SQLite 连接已关闭")
 
 
+def get_db_pool_stats():
+    """数据库连接获取统计（等待时间、超时、失效连接数）"""
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    acquisitions = stats["acquisitions"]
+    stats["wait_ms_avg"] = round(stats["wait_ms_total"] / acquisitions, 2) if acquisitions else 0.0
+    stats["wait_ms_total"] = round(stats["wait_ms_total"], 2)
+    stats["wait_ms_max"] = round(stats["wait_ms_max"], 2)
+    stats["backend"] = "postgresql" if USE_POSTGRES else "sqlite"
+    if USE_POSTGRES and _pg_pool is not None:
+        stats.update(get_db_pool_usage())
+    return stats
+
+
+def get_db_pool_usage():
+    """PostgreSQL 连接池占用情况：最大连接数、已借出、可借出"""
+    with _pool_stats_lock:
+        in_use = _pg_in_use
+    return {"max_connections": _pg_max_conn, "in_use": in_use, "available": _pg_max_conn - in_use}
+
+
+@contextmanager
+def timed_db(operation: str, table: str, **kwargs):
+    """
+    带耗时统计的 get_db()
+
+    退出时记录一条 db_operation 日志，包含总耗时 duration_ms
+    与等待连接的时间 pool_wait_ms。
+    """
+    start = time.perf_counter()
+    with get_db() as conn:
+        pool_wait_ms = (time.perf_counter() - start) * 1000
+        try:
+            yield conn
+        finally:
+            log_db_operation(
+                operation, table,
+                duration_ms=round((time.perf_counter() - start) * 1000, 2),
+                pool_wait_ms=round(pool_wait_ms, 2),
+                **kwargs
+            )
+
+
 def init_db():
     """初始化数据库表"""
     print(f"[DB] ========== 开始初始化数据库 ==========")
@@ -245,6 +330,73 @@ def init_db():
             ''')
             print("[DB] visitor_usage 表 OK")
             
+            # 嵌入缓存表（按模型 + 规范化文本哈希寻址）
+            print("[DB] 创建 embedding_cache 表...")
+            embedding_type = "BYTEA" if USE_POSTGRES else "BLOB"
+            cur.execute(f'''
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    embedding {embedding_type} NOT NULL,
+                    created_at TIMESTAMP,
+                    last_used_at TIMESTAMP,
+                    PRIMARY KEY (model, text_hash)
+                )
+            ''')
+            cur.execute('''
+                CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used 
+                ON embedding_cache(last_used_at)
+            ''')
+            print("[DB] embedding_cache 表 OK")
+            
+            # 知识库版本号表（文档增删后递增，用于检索结果缓存失效）
+            print("[DB] 创建 kb_generations 表...")
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS kb_generations (
+                    kb_id TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            print("[DB] kb_generations 表 OK")
+            
+            # 文档入库任务表（后台解析/嵌入/写入，进程重启后恢复未完成的任务）
+            print("[DB] 创建 ingestion_jobs 表...")
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                    id TEXT PRIMARY KEY,
+                    kb_id TEXT NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    content_type TEXT,
+                    file_path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    chunks_total INTEGER DEFAULT 0,
+                    chunks_embedded INTEGER DEFAULT 0,
+                    chunks_stored INTEGER DEFAULT 0,
+                    error TEXT,
+                    created_at TIMESTAMP,
+                    updated_at TIMESTAMP
+                )
+            ''')
+            cur.execute('''
+                CREATE INDEX IF NOT EXISTS idx_ingestion_jobs_status 
+                ON ingestion_jobs(status)
+            ''')
+            # 同一知识库的同名文档同时只能有一个任务在执行（多个 gunicorn worker 之间也互斥）
+            cur.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_ingestion_jobs_active_document
+                ON ingestion_jobs(kb_id, filename) WHERE status = 'processing'
+            ''')
+            print("[DB] ingestion_jobs 表 OK")
+
+            if not USE_POSTGRES:
+                # 旧版 SQLite 的 documents 表没有 content_hash 列（该表在首次创建知识库时才建，不存在时跳过）
+                cur.execute('PRAGMA table_info(documents)')
+                columns = [row[1] for row in cur.fetchall()]
+                if columns and "content_hash" not in columns:
+                    cur.execute('ALTER TABLE documents ADD COLUMN content_hash TEXT')
+                    print("[DB] documents 表已添加 content_hash 列")
+            
             db.commit()
             print("[DB] ========== 数据库初始化完成 ==========")
     except Exception as e:
@@ -471,9 +623,12 @@ def init_vector_db():
                     filename TEXT NOT NULL,
                     content_type TEXT,
                     chunk_count INTEGER DEFAULT 0,
+                    content_hash TEXT,
                     created_at TIMESTAMP
                 )
             ''')
+            # 文件内容哈希（重新上传同名文件时用于跳过未变化的文件）
+            cur.execute('ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash TEXT')
             db.commit()
             print("[DB] documents 表已创建或已存在")
         except Exception as e:
@@ -494,12 +649,22 @@ def init_vector_db():
                     created_at TIMESTAMP
                 )
             ''')
-            
-            # 创建向量索引
+
+            # 关键词检索：入库时写入分词后的 tsvector（CJK 二元切分），GIN 索引查询
+            cur.execute('''
+                ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS content_tsv tsvector
+            ''')
             cur.execute('''
-                CREATE INDEX IF NOT EXISTS idx_document_chunks_embedding 
-                ON document_chunks USING ivfflat (embedding vector_cosine_ops)
+                CREATE INDEX IF NOT EXISTS idx_document_chunks_tsv
+                ON document_chunks USING GIN (content_tsv)
             ''')
+            # 只包含待补齐的行：补齐完成后索引为空，启动时的补齐检查不再扫描全表
+            cur.execute('''
+                CREATE INDEX IF NOT EXISTS idx_document_chunks_tsv_missing
+                ON document_chunks (id) WHERE content_tsv IS NULL
+            ''')
+
+            # 向量索引由 ensure_vector_index() 管理（空表上建 ivfflat 会得到退化的聚类中心）
             cur.execute('''
                 CREATE INDEX IF NOT EXISTS idx_document_chunks_kb 
                 ON document_chunks(kb_id)
@@ -516,6 +681,173 @@ def init_vector_db():
         
         print("[DB] 向量数据库初始化完成")
 
+    ensure_vector_index_async()
+    backfill_content_tsv_async()
+
+
+def backfill_content_tsv_async():
+    """在后台线程中为升级前入库的块补齐 content_tsv（已补齐时只查询一次空的部分索引）"""
+    if not USE_POSTGRES:
+        return
+
+    def run():
+        # knowledge_base 依赖本模块，延迟导入
+        from knowledge_base import backfill_content_tsv
+        try:
+            rows = backfill_content_tsv()
+            if rows:
+                print(f"[DB] content_tsv 补齐完成: {rows} 行")
+        except Exception as e:
+            print(f"[DB] 警告: content_tsv 补齐失败: {e}")
+
+    threading.Thread(target=run, name="content-tsv-backfill", daemon=True).start()
+
+
+# ========== 向量索引管理（pgvector）==========
+
+VECTOR_INDEX_NAME = "idx_document_chunks_embedding"
+_VECTOR_INDEX_LOCK_KEY = 7261501  # pg_advisory_lock 键，避免多个进程同时建索引
+_vector_index_thread = None
+_vector_index_thread_lock = threading.Lock()
+
+
+def ideal_ivfflat_lists(rows: int) -> int:
+    """pgvector 建议值：100 万行以内 lists = rows / 1000，以上 lists = sqrt(rows)"""
+    if rows <= 1_000_000:
+        return max(rows // 1000, 1)
+    return int(rows ** 0.5)
+
+
+def _parse_reloptions(reloptions) -> dict:
+    """把 pg_class.reloptions（如 ['lists=100']）解析为字典"""
+    options = {}
+    for item in reloptions or []:
+        key, _, value = item.partition("=")
+        options[key] = value
+    return options
+
+
+def _count_document_chunks(cur) -> int:
+    """document_chunks 行数：优先用 reltuples 估算，从未统计过时回退 count(*)"""
+    cur.execute("SELECT reltuples::bigint AS n FROM pg_class WHERE relname = 'document_chunks'")
+    row = cur.fetchone()
+    rows = row["n"] if row else -1
+    if rows is None or rows <= 0:
+        cur.execute("SELECT count(*) AS n FROM document_chunks")
+        rows = cur.fetchone()["n"]
+    return rows
+
+
+def _plan_vector_index(current, rows: int, rebuild: bool):
+    """
+    判断是否需要（重）建向量索引
+
+    Returns:
+        (CREATE INDEX 的 USING/WITH 子句, 原因)；无需变更时子句为 None
+    """
+    if VECTOR_INDEX_METHOD == "hnsw":
+        clause = (f"USING hnsw (embedding vector_cosine_ops) "
+                  f"WITH (m = {VECTOR_HNSW_M}, ef_construction = {VECTOR_HNSW_EF_CONSTRUCTION})")
+        if current is None:
+            return clause, "missing"
+        if current["amname"] != "hnsw":
+            return clause, f"{current['amname']} -> hnsw"
+        options = _parse_reloptions(current["reloptions"])
+        if (options.get("m", "16") != str(VECTOR_HNSW_M)
+                or options.get("ef_construction", "64") != str(VECTOR_HNSW_EF_CONSTRUCTION)):
+            return clause, "parameters changed"
+        return (clause, "forced") if rebuild else (None, "up to date")
+
+    # ivfflat：行数太少时不建索引，精确扫描召回更好且足够快
+    if rows < VECTOR_IVFFLAT_MIN_ROWS and not rebuild:
+        return None, f"only {rows} rows"
+    lists = ideal_ivfflat_lists(rows)
+    clause = f"USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists})"
+    if current is None:
+        return clause, "missing"
+    if current["amname"] != "ivfflat":
+        return clause, f"{current['amname']} -> ivfflat"
+    current_lists = int(_parse_reloptions(current["reloptions"]).get("lists", "100"))
+    if lists >= current_lists * 2:
+        return clause, f"lists {current_lists} -> {lists}"
+    return (clause, "forced") if rebuild else (None, "up to date")
+
+
+def ensure_vector_index(rebuild: bool = False) -> dict:
+    """
+    按配置创建或重建 document_chunks 的向量索引（仅 PostgreSQL）
+
+    - hnsw：不依赖数据分布，空表上也可创建；参数变化时重建
+    - ivfflat：行数达到 VECTOR_IVFFLAT_MIN_ROWS 后才创建，lists 按行数计算，
+      理想值达到当前值 2 倍时重建
+    先 CREATE INDEX CONCURRENTLY 建新索引再替换旧索引，期间不阻塞读写。
+
+    Returns:
+        {"action": "built" | "skipped" | "locked", "reason": ..., ...}
+    """
+    if not USE_POSTGRES:
+        return {"action": "skipped", "reason": "sqlite"}
+
+    with get_db() as db:
+        db.rollback()  # 结束健康检查开启的事务
+        previous_autocommit = db.autocommit
+        db.autocommit = True  # CONCURRENTLY 不能在事务块中执行
+        cur = db.cursor()
+        try:
+            cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (_VECTOR_INDEX_LOCK_KEY,))
+            if not cur.fetchone()["locked"]:
+                return {"action": "locked", "reason": "another process is building the index"}
+            try:
+                cur.execute('''
+                    SELECT am.amname, c.reloptions
+                    FROM pg_class c JOIN pg_am am ON am.oid = c.relam
+                    WHERE c.relname = %s
+                ''', (VECTOR_INDEX_NAME,))
+                current = cur.fetchone()
+                rows = _count_document_chunks(cur)
+                clause, reason = _plan_vector_index(current, rows, rebuild)
+                if clause is None:
+                    return {"action": "skipped", "reason": reason, "rows": rows}
+
+                start = time.perf_counter()
+                print(f"[DB] 构建向量索引 ({reason}): {clause}")
+                new_name = f"{VECTOR_INDEX_NAME}_new"
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {new_name}")  # 清理上次失败残留的无效索引
+                cur.execute(f"CREATE INDEX CONCURRENTLY {new_name} ON document_chunks {clause}")
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {VECTOR_INDEX_NAME}")
+                cur.execute(f"ALTER INDEX {new_name} RENAME TO {VECTOR_INDEX_NAME}")
+                duration_ms = round((time.perf_counter() - start) * 1000, 2)
+                log_db_operation("build_index", "document_chunks", index=VECTOR_INDEX_NAME,
+                                 clause=clause, reason=reason, rows=rows, duration_ms=duration_ms)
+                print(f"[DB] 向量索引构建完成: rows={rows}, 耗时 {duration_ms}ms")
+                return {"action": "built", "reason": reason, "rows": rows,
+                        "clause": clause, "duration_ms": duration_ms}
+            finally:
+                # 会话级 advisory lock 必须在连接归还连接池前释放
+                cur.execute("SELECT pg_advisory_unlock(%s)", (_VECTOR_INDEX_LOCK_KEY,))
+        finally:
+            cur.close()
+            db.autocommit = previous_autocommit
+
+
+def ensure_vector_index_async():
+    """在后台线程中检查并（重）建向量索引；已有检查在运行时直接返回"""
+    global _vector_index_thread
+    if not USE_POSTGRES:
+        return
+
+    def run():
+        try:
+            ensure_vector_index()
+        except Exception as e:
+            print(f"[DB] 警告: 向量索引维护失败: {e}")
+
+    with _vector_index_thread_lock:
+        if _vector_index_thread is not None and _vector_index_thread.is_alive():
+            return
+        _vector_index_thread = threading.Thread(target=run, name="vector-index", daemon=True)
+        _vector_index_thread.start()
+
 
 def create_knowledge_base(user_id: str, name: str, description: str = None) -> str:
     """创建知识库"""
@@ -546,6 +878,7 @@ def create_knowledge_base(user_id: str, name: str, description: str = None) -> s
                     filename TEXT NOT NULL,
                     content_type TEXT,
                     chunk_count INTEGER DEFAULT 0,
+                    content_hash TEXT,
                     created_at TIMESTAMP
                 )
             ''')
@@ -575,6 +908,7 @@ def create_knowledge_base(user_id: str, name: str, description: str = None) -> s
                     filename TEXT NOT NULL,
                     content_type TEXT,
                     chunk_count INTEGER DEFAULT 0,
+                    content_hash TEXT,
                     created_at TIMESTAMP
                 )
             ''')
@@ -638,24 +972,71 @@ def delete_knowledge_base(kb_id: str, user_id: str):
         db.commit()
 
 
-def add_document(kb_id: str, doc_id: str, filename: str, content_type: str, chunk_count: int = 0):
+def add_document(kb_id: str, doc_id: str, filename: str, content_type: str, chunk_count: int = 0,
+                 content_hash: str = None):
     """添加文档记录"""
     beijing_time = get_beijing_time()
     with get_db() as db:
         cur = db.cursor()
         if USE_POSTGRES:
             cur.execute('''
-                INSERT INTO documents (id, kb_id, filename, content_type, chunk_count, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (doc_id, kb_id, filename, content_type, chunk_count, beijing_time))
+                INSERT INTO documents (id, kb_id, filename, content_type, chunk_count, content_hash, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ''', (doc_id, kb_id, filename, content_type, chunk_count, content_hash, beijing_time))
         else:
             cur.execute('''
-                INSERT INTO documents (id, kb_id, filename, content_type, chunk_count, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (doc_id, kb_id, filename, content_type, chunk_count, beijing_time))
+                INSERT INTO documents (id, kb_id, filename, content_type, chunk_count, content_hash, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (doc_id, kb_id, filename, content_type, chunk_count, content_hash, beijing_time))
+        db.commit()
+
+
+def update_document(doc_id: str, content_type: str, chunk_count: int, content_hash: str):
+    """重新入库后更新文档记录（创建时间更新为本次上传时间）"""
+    beijing_time = get_beijing_time()
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.execute('''
+                UPDATE documents SET content_type = %s, chunk_count = %s, content_hash = %s, created_at = %s
+                WHERE id = %s
+            ''', (content_type, chunk_count, content_hash, beijing_time, doc_id))
+        else:
+            cur.execute('''
+                UPDATE documents SET content_type = ?, chunk_count = ?, content_hash = ?, created_at = ?
+                WHERE id = ?
+            ''', (content_type, chunk_count, content_hash, beijing_time, doc_id))
         db.commit()
 
 
+def get_document_by_filename(kb_id: str, filename: str):
+    """按文件名查找知识库中的文档（同名多份时取最新一份），不存在时返回 None"""
+    with get_db() as db:
+        cur = db.cursor()
+        try:
+            if USE_POSTGRES:
+                cur.execute('''
+                    SELECT id, filename, content_type, chunk_count, content_hash, created_at
+                    FROM documents
+                    WHERE kb_id = %s AND filename = %s
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                ''', (kb_id, filename))
+            else:
+                cur.execute('''
+                    SELECT id, filename, content_type, chunk_count, content_hash, created_at
+                    FROM documents
+                    WHERE kb_id = ? AND filename = ?
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                ''', (kb_id, filename))
+            row = cur.fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            print(f"[DB] 查询文档失败: {e}")
+            return None
+
+
 def get_documents(kb_id: str):
     """获取知识库的所有文档"""
     with get_db() as db:
@@ -743,7 +1124,6 @@ def update_knowledge_base(kb_id: str, name: str = None, description: str = None)
 
 # ========== 访客使用限制 ==========
 
-import threading
 _usage_lock = threading.Lock()
 
 def get_visitor_usage(visitor_id: str, usage_date: str):
@@ -837,3 +1217,273 @@ def increment_visitor_usage_db(visitor_id: str, usage_date: str) -> int:
             
             db.commit()
             return new_count
+
+
+# ========== 知识库版本号 ==========
+
+def bump_kb_generation(kb_id: str) -> int:
+    """知识库内容变更后递增版本号，返回新版本号"""
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.execute('''
+                INSERT INTO kb_generations (kb_id, generation) VALUES (%s, 1)
+                ON CONFLICT (kb_id) DO UPDATE SET generation = kb_generations.generation + 1
+                RETURNING generation
+            ''', (kb_id,))
+            generation = cur.fetchone()['generation']
+        else:
+            cur.execute('''
+                INSERT INTO kb_generations (kb_id, generation) VALUES (?, 1)
+                ON CONFLICT (kb_id) DO UPDATE SET generation = generation + 1
+            ''', (kb_id,))
+            cur.execute('SELECT generation FROM kb_generations WHERE kb_id = ?', (kb_id,))
+            generation = cur.fetchone()[0]
+        db.commit()
+        return generation
+
+
+def get_kb_generations(kb_ids: list) -> dict:
+    """批量读取知识库版本号 {kb_id: generation}，从未变更过的知识库为 0"""
+    if not kb_ids:
+        return {}
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.execute('SELECT kb_id, generation FROM kb_generations WHERE kb_id = ANY(%s)',
+                        (list(kb_ids),))
+            found = {row['kb_id']: row['generation'] for row in cur.fetchall()}
+        else:
+            placeholders = ",".join("?" * len(kb_ids))
+            cur.execute(f'SELECT kb_id, generation FROM kb_generations WHERE kb_id IN ({placeholders})',
+                        list(kb_ids))
+            found = {row[0]: row[1] for row in cur.fetchall()}
+    return {kb_id: found.get(kb_id, 0) for kb_id in kb_ids}
+
+
+# ========== 文档入库任务 ==========
+
+INGESTION_JOB_FIELDS = ("status", "doc_id", "chunks_total", "chunks_embedded", "chunks_stored", "error")
+
+
+def create_ingestion_job(job_id: str, kb_id: str, doc_id: str, filename: str,
+                         content_type: str, file_path: str):
+    """创建入库任务（状态 queued）"""
+    beijing_time = get_beijing_time()
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.execute('''
+                INSERT INTO ingestion_jobs (id, kb_id, doc_id, filename, content_type, file_path,
+                                            status, created_at, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, 'queued', %s, %s)
+            ''', (job_id, kb_id, doc_id, filename, content_type, file_path, beijing_time, beijing_time))
+        else:
+            cur.execute('''
+                INSERT INTO ingestion_jobs (id, kb_id, doc_id, filename, content_type, file_path,
+                                            status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)
+            ''', (job_id, kb_id, doc_id, filename, content_type, file_path, beijing_time, beijing_time))
+        db.commit()
+
+
+def claim_ingestion_job(job_id: str) -> str:
+    """
+    把 queued 状态的任务标记为 processing
+
+    Returns:
+        "claimed" 抢到任务；"taken" 任务已被领取或不存在；
+        "busy" 同一知识库的同名文档已有任务在执行（唯一索引冲突），任务保持 queued
+    """
+    beijing_time = get_beijing_time()
+    with get_db() as db:
+        cur = db.cursor()
+        try:
+            if USE_POSTGRES:
+                cur.execute('''
+                    UPDATE ingestion_jobs SET status = 'processing', updated_at = %s
+                    WHERE id = %s AND status = 'queued'
+                ''', (beijing_time, job_id))
+            else:
+                cur.execute('''
+                    UPDATE ingestion_jobs SET status = 'processing', updated_at = ?
+                    WHERE id = ? AND status = 'queued'
+                ''', (beijing_time, job_id))
+        except IntegrityError:
+            db.rollback()
+            return "busy"
+        claimed = cur.rowcount == 1
+        db.commit()
+        return "claimed" if claimed else "taken"
+
+
+def touch_ingestion_job(job_id: str):
+    """执行中任务的心跳：刷新 updated_at"""
+    beijing_time = get_beijing_time()
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.execute('''
+                UPDATE ingestion_jobs SET updated_at = %s WHERE id = %s AND status = 'processing'
+            ''', (beijing_time, job_id))
+        else:
+            cur.execute('''
+                UPDATE ingestion_jobs SET updated_at = ? WHERE id = ? AND status = 'processing'
+            ''', (beijing_time, job_id))
+        db.commit()
+
+
+def requeue_stale_ingestion_jobs(stale_after: float) -> list:
+    """
+    把超过 stale_after 秒没有心跳的 processing 任务原子地改回 queued，返回这些任务的 ID
+    （仍在其他进程中执行的任务有心跳，不会被重复执行）
+    """
+    from datetime import timedelta
+    beijing_time = get_beijing_time()
+    cutoff = beijing_time - timedelta(seconds=stale_after)
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.execute('''
+                UPDATE ingestion_jobs
+                SET status = 'queued', chunks_embedded = 0, chunks_stored = 0, updated_at = %s
+                WHERE status = 'processing' AND updated_at < %s
+                RETURNING id
+            ''', (beijing_time, cutoff))
+        else:
+            cur.execute('''
+                UPDATE ingestion_jobs
+                SET status = 'queued', chunks_embedded = 0, chunks_stored = 0, updated_at = ?
+                WHERE status = 'processing' AND updated_at < ?
+                RETURNING id
+            ''', (beijing_time, cutoff))
+        job_ids = [row['id'] for row in cur.fetchall()]
+        db.commit()
+        return job_ids
+
+
+def update_ingestion_job(job_id: str, **fields):
+    """更新任务状态与进度（只允许 INGESTION_JOB_FIELDS 中的字段）"""
+    fields = {k: v for k, v in fields.items() if k in INGESTION_JOB_FIELDS}
+    if not fields:
+        return
+    fields["updated_at"] = get_beijing_time()
+    placeholder = "%s" if USE_POSTGRES else "?"
+    assignments = ", ".join(f"{k} = {placeholder}" for k in fields)
+    with get_db() as db:
+        cur = db.cursor()
+        cur.execute(f'UPDATE ingestion_jobs SET {assignments} WHERE id = {placeholder}',
+                    (*fields.values(), job_id))
+        db.commit()
+
+
+def get_ingestion_job(job_id: str):
+    """获取入库任务，不存在时返回 None"""
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.execute('SELECT * FROM ingestion_jobs WHERE id = %s', (job_id,))
+        else:
+            cur.execute('SELECT * FROM ingestion_jobs WHERE id = ?', (job_id,))
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+
+def get_queued_ingestion_jobs():
+    """获取排队中（queued）的入库任务 ID，按创建时间排序"""
+    with get_db() as db:
+        cur = db.cursor()
+        cur.execute('''
+            SELECT id FROM ingestion_jobs
+            WHERE status = 'queued'
+            ORDER BY created_at
+        ''')
+        return [row['id'] for row in cur.fetchall()]
+
+
+# ========== 嵌入缓存 ==========
+
+def get_cached_embeddings(model: str, text_hashes: list) -> dict:
+    """批量读取缓存的嵌入向量并刷新最近使用时间，返回 {text_hash: float32 bytes}"""
+    if not text_hashes:
+        return {}
+    beijing_time = get_beijing_time()
+    found = {}
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.execute('''
+                UPDATE embedding_cache SET last_used_at = %s
+                WHERE model = %s AND text_hash = ANY(%s)
+                RETURNING text_hash, embedding
+            ''', (beijing_time, model, list(text_hashes)))
+            for row in cur.fetchall():
+                found[row['text_hash']] = bytes(row['embedding'])
+        else:
+            # SQLite 绑定变量数量有限，分段查询
+            hashes = list(text_hashes)
+            for i in range(0, len(hashes), 500):
+                part = hashes[i:i + 500]
+                placeholders = ",".join("?" * len(part))
+                cur.execute(f'''
+                    SELECT text_hash, embedding FROM embedding_cache
+                    WHERE model = ? AND text_hash IN ({placeholders})
+                ''', (model, *part))
+                for row in cur.fetchall():
+                    found[row[0]] = bytes(row[1])
+            if found:
+                cur.executemany('''
+                    UPDATE embedding_cache SET last_used_at = ?
+                    WHERE model = ? AND text_hash = ?
+                ''', [(beijing_time, model, h) for h in found])
+        db.commit()
+    return found
+
+
+def save_cached_embeddings(model: str, items: dict):
+    """批量写入嵌入缓存，items 为 {text_hash: float32 bytes}"""
+    if not items:
+        return
+    beijing_time = get_beijing_time()
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.executemany('''
+                INSERT INTO embedding_cache (model, text_hash, embedding, created_at, last_used_at)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (model, text_hash) DO UPDATE SET last_used_at = EXCLUDED.last_used_at
+            ''', [(model, h, psycopg2.Binary(v), beijing_time, beijing_time) for h, v in items.items()])
+        else:
+            cur.executemany('''
+                INSERT INTO embedding_cache (model, text_hash, embedding, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (model, text_hash) DO UPDATE SET last_used_at = excluded.last_used_at
+            ''', [(model, h, v, beijing_time, beijing_time) for h, v in items.items()])
+        db.commit()
+
+
+def evict_embedding_cache(max_rows: int) -> int:
+    """按最近使用时间淘汰超出上限的缓存行，返回删除行数"""
+    with get_db() as db:
+        cur = db.cursor()
+        if USE_POSTGRES:
+            cur.execute('''
+                DELETE FROM embedding_cache
+                WHERE (model, text_hash) IN (
+                    SELECT model, text_hash FROM embedding_cache
+                    ORDER BY last_used_at DESC
+                    OFFSET %s
+                )
+            ''', (max_rows,))
+        else:
+            cur.execute('''
+                DELETE FROM embedding_cache
+                WHERE rowid IN (
+                    SELECT rowid FROM embedding_cache
+                    ORDER BY last_used_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            ''', (max_rows,))
+        deleted = cur.rowcount
+        db.commit()
+        return deleted
@@ -1,89 +1,504 @@
 """
-文本嵌入服务 - 使用 DashScope text-embedding-v2
+文本嵌入服务 - 可插拔后端
+默认使用 DashScope text-embedding-v2，也可切换为本地确定性哈希向量（离线）
 """
-import json
-import http.client
-import ssl
-from typing import List, Union
+import math
+import random
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Union
 
 from config import (
-    DASHSCOPE_API_KEY, DASHSCOPE_HOST, 
-    DASHSCOPE_EMBEDDING_PATH, EMBEDDING_MODEL,
-    HTTP_TIMEOUT_EMBEDDING
+    DASHSCOPE_API_KEY, DASHSCOPE_EMBEDDING_PATH, EMBEDDING_MODEL,
+    EMBEDDING_BACKEND, EMBEDDING_DIMENSION,
+    HTTP_TIMEOUT_EMBEDDING,
+    EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_COALESCE_WINDOW_MS, EMBEDDING_COALESCE_MAX_BATCH,
+    EMBEDDING_RATE_INITIAL, EMBEDDING_RATE_MIN, EMBEDDING_RATE_MAX, EMBEDDING_MAX_IN_FLIGHT,
+    EMBEDDING_MAX_RETRIES, EMBEDDING_BACKOFF_BASE, EMBEDDING_BACKOFF_MAX
 )
+from dashscope_client import post_json
+from embedding_cache import get_embedding_cache, normalize_text
+from logger import log_info, log_warning
+from vectors import Vector, FORMAT_FLOAT32, use_float32, to_float32, to_format
 
 
-def get_embeddings(texts: Union[str, List[str]], max_retries: int = 2) -> List[List[float]]:
+class AdaptiveRateLimiter:
     """
-    获取文本的向量嵌入
-    
-    Args:
-        texts: 单个文本或文本列表
-        max_retries: 最大重试次数
+    嵌入请求的自适应限流器
     
-    Returns:
-        向量列表，每个向量是 1536 维的 float 列表
+    令牌桶控制请求速率，AIMD 控制并发数：成功时线性爬升，遇到限流
+    （429 / Throttling）时减半并暂停派发，直到退避时间结束。
     """
-    if isinstance(texts, str):
-        texts = [texts]
     
+    _LOG_INTERVAL = 30.0  # 速率状态日志间隔（秒）
+    _RATE_STEP = 0.2  # 每次成功增加的速率（次/秒）
+    
+    def __init__(self, rate: float = EMBEDDING_RATE_INITIAL, min_rate: float = EMBEDDING_RATE_MIN,
+                 max_rate: float = EMBEDDING_RATE_MAX, max_in_flight: int = EMBEDDING_MAX_IN_FLIGHT):
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.rate = min(max(rate, min_rate), self.max_rate)
+        self.max_in_flight = max(1, max_in_flight)
+        self.limit = float(self.max_in_flight)
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._last_log = 0.0
+        self._stats = {"requests": 0, "successes": 0, "throttled": 0, "errors": 0}
+    
+    def _refill(self, now: float):
+        capacity = max(1.0, self.rate)  # 最多积累 1 秒的突发量
+        self._tokens = min(capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+    
+    def acquire(self):
+        """等待令牌和并发槽位"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self._in_flight >= max(1, int(self.limit)):
+                    wait = 1.0  # 等待 release 唤醒
+                elif self._tokens < 1.0:
+                    wait = (1.0 - self._tokens) / self.rate
+                else:
+                    self._tokens -= 1.0
+                    self._in_flight += 1
+                    self._stats["requests"] += 1
+                    return
+                self._cond.wait(timeout=wait)
+    
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+    
+    def on_success(self):
+        """加性增：每次成功提升速率与并发上限"""
+        with self._cond:
+            self._stats["successes"] += 1
+            self.rate = min(self.max_rate, self.rate + self._RATE_STEP)
+            self.limit = min(float(self.max_in_flight), self.limit + 1.0 / self.limit)
+            now = time.monotonic()
+            should_log = now - self._last_log >= self._LOG_INTERVAL
+            if should_log:
+                self._last_log = now
+                stats = self._snapshot()
+        if should_log:
+            log_info(f"[Embedding] 当前速率 {stats['rate']}/s，并发上限 {stats['concurrency_limit']}",
+                     type="embedding_rate", **stats)
+    
+    def on_throttle(self, retry_after: float = 0.0):
+        """乘性减：速率和并发减半，并在退避期内暂停派发"""
+        with self._cond:
+            self._stats["throttled"] += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.limit = max(1.0, self.limit / 2)
+            self._tokens = 0.0
+            pause = max(retry_after, 1.0 / self.rate)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + pause)
+            stats = self._snapshot()
+        log_warning(f"[Embedding] 触发限流，速率降至 {stats['rate']}/s，暂停 {pause:.2f}s",
+                    type="embedding_throttle", retry_after=retry_after, **stats)
+    
+    def on_error(self):
+        with self._cond:
+            self._stats["errors"] += 1
+    
+    def _snapshot(self) -> Dict:
+        return {
+            "rate": round(self.rate, 2),
+            "concurrency_limit": int(self.limit),
+            "in_flight": self._in_flight,
+            **self._stats,
+        }
+    
+    def get_stats(self) -> Dict:
+        with self._cond:
+            return self._snapshot()
+
+
+_rate_limiter = AdaptiveRateLimiter()
+
+
+def _backoff_delay(attempt: int) -> float:
+    """指数退避 + 全抖动"""
+    return random.uniform(0, min(EMBEDDING_BACKOFF_MAX, EMBEDDING_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _is_throttled(status: int, data: Dict) -> bool:
+    """DashScope 限流：HTTP 429 或错误码以 Throttling 开头"""
+    return status == 429 or str(data.get("code", "")).startswith("Throttling")
+
+
+def _retry_after(headers: Dict[str, str]) -> float:
+    for key, value in headers.items():
+        if key.lower() == "retry-after":
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                return 0.0
+    return 0.0
+
+
+def _request_embeddings(texts: List[str], max_retries: int = EMBEDDING_MAX_RETRIES,
+                        vector_format: str = None) -> List[Vector]:
+    """调用 DashScope 嵌入接口（不经过缓存），经自适应限流器派发"""
     if not DASHSCOPE_API_KEY:
         raise ValueError("DASHSCOPE_API_KEY not configured")
     
     for attempt in range(max_retries + 1):
+        _rate_limiter.acquire()
         try:
-            payload = json.dumps({
-                "model": EMBEDDING_MODEL,
-                "input": {
-                    "texts": texts
-                }
-            })
-            
-            ctx = ssl.create_default_context()
-            conn = http.client.HTTPSConnection(
-                DASHSCOPE_HOST, 
-                context=ctx, 
-                timeout=HTTP_TIMEOUT_EMBEDDING
-            )
-            
-            headers = {
-                "Authorization": f"Bearer {DASHSCOPE_API_KEY}",
-                "Content-Type": "application/json",
-            }
-            
-            conn.request(
-                "POST",
+            status, headers, data = post_json(
                 DASHSCOPE_EMBEDDING_PATH,
-                body=payload.encode("utf-8"),
-                headers=headers
+                {
+                    "model": EMBEDDING_MODEL,
+                    "input": {
+                        "texts": texts
+                    }
+                },
+                timeout=HTTP_TIMEOUT_EMBEDDING
             )
-            
-            resp = conn.getresponse()
-            data = json.loads(resp.read().decode("utf-8"))
-            conn.close()
-            
-            if resp.status != 200:
-                error_msg = data.get("message", "Unknown error")
-                raise Exception(f"Embedding API error: {error_msg}")
-            
-            # 提取嵌入向量
-            embeddings = data.get("output", {}).get("embeddings", [])
-            return [e["embedding"] for e in embeddings]
-            
         except Exception as e:
+            # 网络错误：退避后重试
+            _rate_limiter.on_error()
             if attempt == max_retries:
                 raise e
-            print(f"[Embedding] Retry {attempt + 1}/{max_retries}: {e}")
+            delay = _backoff_delay(attempt)
+            log_warning(f"[Embedding] Retry {attempt + 1}/{max_retries} in {delay:.2f}s: {e}",
+                        type="embedding_retry", attempt=attempt + 1)
+            time.sleep(delay)
+            continue
+        finally:
+            _rate_limiter.release()
+        
+        if status == 200:
+            _rate_limiter.on_success()
+            # 提取嵌入向量（按 text_index 排序，保证与输入顺序一致）
+            embeddings = data.get("output", {}).get("embeddings", [])
+            embeddings.sort(key=lambda e: e.get("text_index", 0))
+            if use_float32(vector_format):
+                # 解析后立即转为 float32 缓冲区，尽早释放装箱的 float 列表
+                return [to_float32(e.pop("embedding")) for e in embeddings]
+            return [e["embedding"] for e in embeddings]
+        
+        error_msg = data.get("message", "Unknown error")
+        if _is_throttled(status, data):
+            retry_after = _retry_after(headers)
+            _rate_limiter.on_throttle(retry_after)
+            if attempt == max_retries:
+                raise Exception(f"Embedding API throttled: {error_msg}")
+            # 限流器已暂停派发，这里再叠加抖动，避免各线程同时恢复
+            time.sleep(_backoff_delay(attempt))
+            continue
+        
+        _rate_limiter.on_error()
+        if status < 500 or attempt == max_retries:
+            # 4xx（参数错误等）重试无意义
+            raise Exception(f"Embedding API error: {error_msg}")
+        delay = _backoff_delay(attempt)
+        log_warning(f"[Embedding] Retry {attempt + 1}/{max_retries} in {delay:.2f}s: HTTP {status} {error_msg}",
+                    type="embedding_retry", attempt=attempt + 1, status=status)
+        time.sleep(delay)
     
     return []
 
 
-def get_embedding(text: str) -> List[float]:
+def get_rate_limiter_stats() -> Dict:
+    """嵌入限流器状态"""
+    return _rate_limiter.get_stats()
+
+
+# ========== 嵌入后端 ==========
+
+class EmbeddingBackend(ABC):
+    """
+    嵌入后端接口
+    
+    子类必须实现 embed()；cacheable 为 True 时 get_embeddings 会在调用前查嵌入缓存。
+    """
+    
+    name = "base"
+    model = ""
+    dimension = EMBEDDING_DIMENSION
+    cacheable = False
+    
+    @abstractmethod
+    def embed(self, texts: List[str], max_retries: int = EMBEDDING_MAX_RETRIES,
+              vector_format: str = None) -> List[Vector]:
+        """把一批文本转为向量，顺序与 texts 一致"""
+
+
+class DashScopeEmbeddingBackend(EmbeddingBackend):
+    """DashScope text-embedding 网络后端"""
+    
+    name = "dashscope"
+    model = EMBEDDING_MODEL
+    cacheable = True
+    
+    def embed(self, texts: List[str], max_retries: int = EMBEDDING_MAX_RETRIES,
+              vector_format: str = None) -> List[Vector]:
+        return _request_embeddings(texts, max_retries, vector_format)
+
+
+class LocalHashEmbeddingBackend(EmbeddingBackend):
+    """
+    本地确定性嵌入后端（无需网络）
+    
+    对规范化文本的字符 n-gram 做带符号特征哈希，再 L2 归一化。
+    相同文本总是得到相同向量，字面相近的文本余弦相似度更高，
+    适合离线开发、CI 和基准测试。
+    """
+    
+    name = "local"
+    cacheable = False  # 本地计算比查缓存更快
+    
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION, min_n: int = 1, max_n: int = 3):
+        self.dimension = dimension
+        self.min_n = min_n
+        self.max_n = max_n
+        self.model = f"local-hash-ngram-{min_n}-{max_n}-{dimension}"
+    
+    def _embed_one(self, text: str) -> List[float]:
+        dim = self.dimension
+        vec = [0.0] * dim
+        normalized = normalize_text(text).lower()
+        for n in range(self.min_n, self.max_n + 1):
+            for i in range(len(normalized) - n + 1):
+                h = zlib.crc32(normalized[i:i + n].encode("utf-8"), n)
+                vec[h % dim] += -1.0 if h & 0x80000000 else 1.0
+        norm = math.sqrt(sum(v * v for v in vec))
+        if norm:
+            vec = [v / norm for v in vec]
+        return vec
+    
+    def embed(self, texts: List[str], max_retries: int = EMBEDDING_MAX_RETRIES,
+              vector_format: str = None) -> List[Vector]:
+        if use_float32(vector_format):
+            return [to_float32(self._embed_one(t)) for t in texts]
+        return [self._embed_one(t) for t in texts]
+
+
+# 可通过 EMBEDDING_BACKEND 选择的后端
+EMBEDDING_BACKENDS = {
+    DashScopeEmbeddingBackend.name: DashScopeEmbeddingBackend,
+    LocalHashEmbeddingBackend.name: LocalHashEmbeddingBackend,
+}
+
+_backend: Optional[EmbeddingBackend] = None
+
+
+def get_embedding_backend() -> EmbeddingBackend:
+    """获取当前嵌入后端（按 EMBEDDING_BACKEND 配置创建）"""
+    global _backend
+    if _backend is None:
+        backend_cls = EMBEDDING_BACKENDS.get(EMBEDDING_BACKEND)
+        if backend_cls is None:
+            raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+        _backend = backend_cls()
+    return _backend
+
+
+def set_embedding_backend(backend: EmbeddingBackend):
+    """替换当前嵌入后端（基准测试等场景使用）"""
+    global _backend
+    _backend = backend
+
+
+def get_embeddings(texts: Union[str, List[str]], max_retries: int = EMBEDDING_MAX_RETRIES,
+                   vector_format: str = None) -> List[Vector]:
+    """
+    获取文本的向量嵌入
+    
+    使用 EMBEDDING_BACKEND 指定的后端；网络后端先查嵌入缓存，
+    只把未命中的文本（去重后）发往后端。
+    
+    Args:
+        texts: 单个文本或文本列表
+        max_retries: 最大重试次数
+        vector_format: "list" 或 "float32"，默认读取 EMBEDDING_VECTOR_FORMAT
+    
+    Returns:
+        向量列表，每个向量是 1536 维的 float 列表（float32 模式下为 array('f')）
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    if not texts:
+        return []
+    
+    backend = get_embedding_backend()
+    cache = get_embedding_cache() if backend.cacheable else None
+    if cache is None:
+        return backend.embed(texts, max_retries, vector_format)
+    
+    results = cache.lookup(texts, vector_format)
+    miss_texts = list(dict.fromkeys(t for t, r in zip(texts, results) if r is None))
+    if not miss_texts:
+        return results
+    
+    fetched = backend.embed(miss_texts, max_retries, vector_format)
+    if len(fetched) != len(miss_texts):
+        raise Exception(f"Embedding API returned {len(fetched)} vectors for {len(miss_texts)} texts")
+    cache.store(miss_texts, fetched)
+    
+    fetched_by_text = dict(zip(miss_texts, fetched))
+    return [r if r is not None else fetched_by_text[t] for t, r in zip(texts, results)]
+
+
+def get_embedding(text: str, vector_format: str = None) -> Vector:
     """获取单个文本的向量嵌入"""
-    embeddings = get_embeddings([text])
+    embeddings = get_embeddings([text], vector_format=vector_format)
     return embeddings[0] if embeddings else []
 
 
+def get_embeddings_batched(texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE,
+                           max_workers: int = EMBEDDING_MAX_CONCURRENCY,
+                           vector_format: str = None) -> List[Vector]:
+    """
+    分批并发获取大量文本的向量嵌入（用于文档入库）
+    
+    Args:
+        texts: 文本列表
+        batch_size: 每批文本数，不超过 DashScope 单次调用上限
+        max_workers: 同时在途的最大批次数
+        vector_format: "list" 或 "float32"，默认读取 EMBEDDING_VECTOR_FORMAT
+    
+    Returns:
+        向量列表，顺序与输入文本一致
+    """
+    if not texts:
+        return []
+    
+    batch_size = max(1, batch_size)
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    if len(batches) == 1:
+        return get_embeddings(batches[0], vector_format=vector_format)
+    
+    results = [None] * len(batches)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches))))
+    try:
+        futures = {executor.submit(get_embeddings, batch, vector_format=vector_format): idx
+                   for idx, batch in enumerate(batches)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    except Exception:
+        # 任一批次失败即放弃剩余批次，避免继续消耗配额
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    
+    embeddings = []
+    for batch, batch_embeddings in zip(batches, results):
+        if len(batch_embeddings) != len(batch):
+            raise Exception(f"Embedding API returned {len(batch_embeddings)} vectors for {len(batch)} texts")
+        embeddings.extend(batch_embeddings)
+    return embeddings
+
+
+class QueryEmbeddingBatcher:
+    """
+    跨请求合并查询嵌入
+    
+    并发请求各自只嵌入一条短查询。已有合并批次在途时，窗口期内到达的请求
+    合并为一次 get_embeddings 调用，再把结果分发给各调用方；无并发时立即
+    发送，不增加单请求延迟。
+    """
+    
+    def __init__(self, window_ms: float = EMBEDDING_COALESCE_WINDOW_MS,
+                 max_batch: int = EMBEDDING_COALESCE_MAX_BATCH):
+        self.window = max(0.0, window_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._lock = threading.Lock()
+        self._pending = []  # [(text, Future)]
+        self._timer = None
+        self._in_flight = 0
+        self._stats = {"requests": 0, "batches": 0, "max_batch_size": 0}
+    
+    def _take_pending(self) -> List:
+        """取出待发送请求（需持有锁）"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self._in_flight += 1
+        return batch
+    
+    def _flush_pending(self):
+        with self._lock:
+            batch = self._take_pending()
+        if batch:
+            self._run_batch(batch)
+    
+    def _run_batch(self, batch: List):
+        try:
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            with self._lock:
+                self._stats["batches"] += 1
+                self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(texts))
+            vectors = dict(zip(texts, get_embeddings(texts, vector_format=FORMAT_FLOAT32)))
+            for text, future in batch:
+                future.set_result(vectors.get(text))
+        except BaseException as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+    
+    def embed(self, text: str, vector_format: str = None) -> Vector:
+        """获取单条查询的嵌入（可能与其他并发请求合并发送）"""
+        if self.window <= 0:
+            return get_embedding(text, vector_format=vector_format)
+        
+        future = Future()
+        batch = None
+        with self._lock:
+            self._stats["requests"] += 1
+            self._pending.append((text, future))
+            if len(self._pending) >= self.max_batch or self._in_flight == 0:
+                batch = self._take_pending()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush_pending)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._run_batch(batch)
+        
+        vector = future.result()
+        # 每个调用方拿到独立的向量副本
+        return to_format(vector, vector_format) if vector else []
+    
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["avg_batch_size"] = round(stats["requests"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+
+_query_batcher = QueryEmbeddingBatcher()
+
+
+def get_query_embedding(text: str, vector_format: str = None) -> Vector:
+    """获取查询文本的嵌入（跨请求合并发送）"""
+    return _query_batcher.embed(text, vector_format=vector_format)
+
+
+def get_query_batcher_stats() -> Dict:
+    """查询嵌入合并统计"""
+    return _query_batcher.get_stats()
+
+
 # 简单测试
 if __name__ == "__main__":
     
@@ -0,0 +1,195 @@
+"""
+嵌入向量缓存 - 进程内 LRU + 数据库持久化
+按 (EMBEDDING_MODEL, 规范化文本哈希) 寻址，相同文本只需嵌入一次
+"""
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from config import (
+    EMBEDDING_MODEL, EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_MEMORY_SIZE, EMBEDDING_CACHE_MAX_ROWS
+)
+from logger import log_warning
+from vectors import Vector, unpack_float32, to_float32, to_format
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# 每写入多少条新缓存执行一次数据库淘汰
+_EVICT_EVERY = 1000
+
+
+class LRUCache:
+    """线程安全的定长 LRU 缓存，可选 TTL，带命中统计"""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl if ttl and ttl > 0 else None
+        self._data = OrderedDict()  # key -> (value, 过期时间)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.expired += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本：Unicode NFC、合并空白、去除首尾空白"""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_hash(text: str) -> str:
+    """规范化文本的 SHA-256 摘要"""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """两级嵌入缓存：进程内 LRU -> 数据库表 embedding_cache"""
+
+    def __init__(self, model: str = EMBEDDING_MODEL, memory_size: int = EMBEDDING_CACHE_MEMORY_SIZE,
+                 max_rows: int = EMBEDDING_CACHE_MAX_ROWS):
+        self.model = model
+        self.max_rows = max_rows
+        self._memory = LRUCache(memory_size)
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self.db_hits = 0
+        self.db_misses = 0
+        self.db_errors = 0
+
+    def lookup(self, texts: List[str], vector_format: str = None) -> List[Optional[Vector]]:
+        """
+        查询缓存（内存中统一保存为 float32，返回时按 vector_format 转换）
+
+        Returns:
+            与 texts 等长的列表，未命中的位置为 None
+        """
+        hashes = [text_hash(t) for t in texts]
+        results = []
+        missing = {}
+        for i, h in enumerate(hashes):
+            vec = self._memory.get(h)
+            results.append(to_format(vec, vector_format) if vec is not None else None)
+            if vec is None:
+                missing.setdefault(h, []).append(i)
+
+        if missing:
+            try:
+                from database import get_cached_embeddings
+                found = get_cached_embeddings(self.model, list(missing))
+            except Exception as e:
+                self.db_errors += 1
+                log_warning(f"[EmbeddingCache] 读取持久化缓存失败: {e}", type="embedding_cache_error")
+                found = {}
+            with self._lock:
+                self.db_hits += len(found)
+                self.db_misses += len(missing) - len(found)
+            for h, data in found.items():
+                vec = unpack_float32(data)
+                self._memory.put(h, vec)
+                for i in missing[h]:
+                    results[i] = to_format(vec, vector_format)
+        return results
+
+    def store(self, texts: List[str], vectors: List[Vector]):
+        """写入缓存（内存 + 数据库）"""
+        items = {}
+        for text, vec in zip(texts, vectors):
+            if not vec:
+                continue
+            h = text_hash(text)
+            packed = to_float32(vec)
+            # 调用方持有的 float32 向量需拷贝一份，避免外部修改污染缓存
+            self._memory.put(h, array("f", packed) if packed is vec else packed)
+            items[h] = packed.tobytes()
+        if not items:
+            return
+        try:
+            from database import save_cached_embeddings, evict_embedding_cache
+            save_cached_embeddings(self.model, items)
+            with self._lock:
+                self._writes_since_evict += len(items)
+                should_evict = self._writes_since_evict >= _EVICT_EVERY
+                if should_evict:
+                    self._writes_since_evict = 0
+            if should_evict:
+                evict_embedding_cache(self.max_rows)
+        except Exception as e:
+            self.db_errors += 1
+            log_warning(f"[EmbeddingCache] 写入持久化缓存失败: {e}", type="embedding_cache_error")
+
+    def get_stats(self) -> Dict:
+        """缓存命中统计"""
+        db_total = self.db_hits + self.db_misses
+        return {
+            "model": self.model,
+            "memory": self._memory.get_stats(),
+            "db_hits": self.db_hits,
+            "db_misses": self.db_misses,
+            "db_hit_rate": round(self.db_hits / db_total, 4) if db_total else 0.0,
+            "db_errors": self.db_errors,
+            "max_rows": self.max_rows,
+        }
+
+
+# 全局缓存实例（未启用时为 None）
+_cache: Optional[EmbeddingCache] = EmbeddingCache() if EMBEDDING_CACHE_ENABLED else None
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """获取全局嵌入缓存"""
+    return _cache
+
+
+def get_embedding_cache_stats() -> Dict:
+    """获取嵌入缓存统计"""
+    if _cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **_cache.get_stats()}
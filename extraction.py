@@ -0,0 +1,175 @@
+"""
+文档文本提取引擎 - 按页（PDF）/ 按段落（DOCX）/ 按块（TXT、MD）流式产出文本
+大 PDF 按页区间分给进程池并行解析，仍按页序产出；在途的页区间有上限，内存不随页数增长
+"""
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import BinaryIO, Iterator, List, Tuple, Union
+
+from config import EXTRACTION_WORKERS, EXTRACTION_PARALLEL_MIN_PAGES, EXTRACTION_PAGES_PER_TASK
+
+# 纯文本按行累积到该字符数后产出一段
+_TEXT_BLOCK_CHARS = 64 * 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _pdf_reader(source):
+    """打开 PDF（优先 pypdf，回退 PyPDF2）"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        from PyPDF2 import PdfReader
+    return PdfReader(source)
+
+
+def _mp_context():
+    """
+    优先使用 forkserver，只预加载本模块，避免在多线程进程中 fork；不支持时退回 spawn
+    子进程仍会以 __mp_main__ 导入主模块（如 `python app.py`），因此主模块导入时不能有启动副作用（见 app.init_app）
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["extraction"])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """进程池延迟创建"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=_mp_context())
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _page_text(page, index: int) -> str:
+    try:
+        return page.extract_text() or ""
+    except Exception as e:
+        print(f"[PDF提取] 第 {index + 1} 页失败: {e}")
+        return ""
+
+
+def _extract_pdf_range(file_path: str, start: int, end: int) -> List[str]:
+    """子进程：解析 [start, end) 页的文本"""
+    reader = _pdf_reader(file_path)
+    return [_page_text(reader.pages[i], i) for i in range(start, end)]
+
+
+class PdfPages:
+    """
+    PDF 按页文本：len() 为总页数，迭代产出 (页序号, 文本)
+
+    source 为文件路径且页数达到 EXTRACTION_PARALLEL_MIN_PAGES 时按页区间并行解析，
+    否则（含内存中的文件对象）在当前进程逐页解析。可以中途停止迭代，后续页不会被解析。
+    """
+
+    def __init__(self, source: Union[str, BinaryIO], parallel: bool = True):
+        self.source = source
+        self.reader = _pdf_reader(source)
+        self.parallel = (parallel and isinstance(source, str) and EXTRACTION_WORKERS > 1
+                         and len(self) >= EXTRACTION_PARALLEL_MIN_PAGES)
+
+    def __len__(self) -> int:
+        return len(self.reader.pages)
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        if self.parallel:
+            try:
+                yield from self._iter_parallel()
+                return
+            except BrokenProcessPool as e:
+                # 子进程异常退出（如内存不足）：重建进程池，本次回退为单进程解析
+                print(f"[PDF提取] 进程池异常，回退为单进程解析: {e}")
+                _reset_pool()
+        yield from self._iter_sequential()
+
+    def _iter_sequential(self) -> Iterator[Tuple[int, str]]:
+        for i in range(len(self)):
+            yield i, _page_text(self.reader.pages[i], i)
+
+    def _iter_parallel(self) -> Iterator[Tuple[int, str]]:
+        pool = _get_pool()
+        page_count = len(self)
+        ranges = iter([(start, min(start + EXTRACTION_PAGES_PER_TASK, page_count))
+                       for start in range(0, page_count, EXTRACTION_PAGES_PER_TASK)])
+        pending = deque()
+
+        def submit_next():
+            for start, end in ranges:
+                pending.append((start, pool.submit(_extract_pdf_range, self.source, start, end)))
+                return
+
+        # 在途任务数为进程数的 2 倍：进程不空闲，已解析未消费的页也有上限
+        for _ in range(EXTRACTION_WORKERS * 2):
+            submit_next()
+        try:
+            while pending:
+                start, future = pending.popleft()
+                texts = future.result()
+                submit_next()
+                for offset, text in enumerate(texts):
+                    yield start + offset, text
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def _iter_pdf(file_path: str) -> Iterator[str]:
+    try:
+        for _, text in PdfPages(file_path):
+            yield text + "\n"
+    except Exception as e:
+        print(f"[PDF提取错误] {e}")
+
+
+def _iter_docx(file_path: str) -> Iterator[str]:
+    try:
+        from docx import Document
+    except ImportError:
+        print("[DOCX提取错误] python-docx 未安装")
+        return
+    for para in Document(file_path).paragraphs:
+        yield para.text + "\n"
+
+
+def _iter_plain_text(file_path: str) -> Iterator[str]:
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        block, size = [], 0
+        for line in f:
+            block.append(line)
+            size += len(line)
+            if size >= _TEXT_BLOCK_CHARS:
+                yield "".join(block)
+                block, size = [], 0
+        if block:
+            yield "".join(block)
+
+
+def iter_document_text(file_path: str, content_type: str) -> Iterator[str]:
+    """
+    流式提取文档文本
+
+    Yields:
+        文本段：PDF 每页一段、DOCX 每段落一段、TXT/MD 约 64K 字符一段
+    """
+    if content_type in ("text/plain", "text/markdown") or file_path.endswith((".txt", ".md")):
+        yield from _iter_plain_text(file_path)
+    elif content_type == "application/pdf" or file_path.endswith(".pdf"):
+        yield from _iter_pdf(file_path)
+    elif file_path.endswith(".docx"):
+        yield from _iter_docx(file_path)
@@ -0,0 +1,9 @@
+"""
+gunicorn 配置（gunicorn 启动时自动读取当前目录下的 gunicorn.conf.py）
+app.py 导入时不做初始化，每个 worker 启动后在这里执行
+"""
+
+
+def post_worker_init(worker):
+    from app import init_app
+    init_app()
@@ -0,0 +1,270 @@
+"""
+文档入库任务 - 上传请求只把文件落盘并登记任务，解析/嵌入/写入在后台线程池执行
+任务状态与进度（已嵌入/已写入块数）持久化在 ingestion_jobs 表，执行中的任务定期心跳，进程重启后恢复心跳超时的任务
+知识库中已有同名文档时增量更新：只嵌入新增或变化的块，未变化的块保留原向量
+"""
+import hashlib
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, List, Tuple
+
+from config import (
+    INGESTION_WORKERS, INGESTION_SPOOL_DIR, INGESTION_BATCH_SIZE,
+    INGESTION_HEARTBEAT_INTERVAL, INGESTION_STALE_AFTER
+)
+from database import (
+    create_ingestion_job, claim_ingestion_job, touch_ingestion_job, update_ingestion_job,
+    get_ingestion_job, requeue_stale_ingestion_jobs, get_queued_ingestion_jobs,
+    add_document, update_document, get_document_by_filename, delete_document, ensure_vector_index_async
+)
+from embedding import get_embeddings_batched
+from knowledge_base import (
+    iter_document_chunks, add_document_chunks, delete_document_vectors,
+    get_document_chunk_indexes, update_document_chunk_indexes, delete_document_chunks
+)
+from logger import log_info, log_error
+
+_executor = ThreadPoolExecutor(max_workers=max(1, INGESTION_WORKERS), thread_name_prefix="ingestion")
+
+# 同一知识库中的同名文件串行入库（增量更新基于同一份已入库的块）：由 ingestion_jobs 的唯一索引保证，
+# 领取时冲突的任务保持 queued，隔一段时间再试
+_BUSY_RETRY_SECONDS = 5
+
+
+def _file_hash(file_path: str) -> str:
+    """文件内容哈希（SHA-256，按 1MB 分块读取）"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _spool_path(job_id: str, filename: str) -> str:
+    """任务文件在暂存目录中的路径（保留扩展名，解析器按扩展名判断类型）"""
+    os.makedirs(INGESTION_SPOOL_DIR, exist_ok=True)
+    return os.path.join(INGESTION_SPOOL_DIR, f"{job_id}{os.path.splitext(filename)[1].lower()}")
+
+
+def job_status(job: Dict) -> Dict:
+    """对外返回的任务状态"""
+    return {
+        "job_id": job["id"],
+        "kb_id": job["kb_id"],
+        "doc_id": job["doc_id"],
+        "filename": job["filename"],
+        "status": job["status"],
+        "chunks_total": job["chunks_total"] or 0,
+        "chunks_embedded": job["chunks_embedded"] or 0,
+        "chunks_stored": job["chunks_stored"] or 0,
+        "error": job["error"],
+    }
+
+
+def submit_document(kb_id: str, filename: str, content_type: str, save: Callable[[str], None]) -> Dict:
+    """
+    登记入库任务并提交到后台线程池
+
+    Args:
+        kb_id: 知识库 ID
+        filename: 原始文件名
+        content_type: 文件 MIME 类型
+        save: 把上传内容写入给定路径的函数（如 FileStorage.save）
+
+    Returns:
+        任务状态（status 为 queued）
+    """
+    job_id = uuid.uuid4().hex
+    doc_id = f"doc_{uuid.uuid4().hex[:8]}"
+    file_path = _spool_path(job_id, filename)
+    save(file_path)
+    try:
+        create_ingestion_job(job_id, kb_id, doc_id, filename, content_type, file_path)
+    except Exception:
+        os.remove(file_path)
+        raise
+
+    _executor.submit(run_job, job_id)
+    log_info(f"[入库] 任务已排队: {job_id} ({filename})", type="ingestion", job_id=job_id, kb_id=kb_id)
+    return job_status(get_ingestion_job(job_id))
+
+
+def _process(job: Dict, added: List[str]) -> Tuple[int, int]:
+    """
+    流式解析 → 分块 → 按批嵌入并写入，每批完成后更新进度
+
+    解析与嵌入交替进行，内存中只保留一批块；chunks_total 随解析推进增长，任务完成时为最终块数。
+    知识库中已有同名文档时在原文档上增量更新：文件未变化直接完成；否则按 content_hash
+    只嵌入并写入新增或变化的块，未变化的块保留原向量（序号改为新版本中的序号），
+    最后删除新版本中已不存在的块。
+
+    Args:
+        job: 入库任务（增量更新时其中的 doc_id 被改为原文档 ID，incremental 置为 True）
+        added: 收集本次新写入的块的 content_hash（任务失败时据此清理）
+
+    Returns:
+        (文档块数, 复用原向量的块数)
+    """
+    job_id, kb_id = job["id"], job["kb_id"]
+    file_hash = _file_hash(job["file_path"])
+    existing = get_document_by_filename(kb_id, job["filename"])
+    replaced = None  # 整篇替换的旧文档（其块没有 content_hash）
+    if existing:
+        if existing["content_hash"] == file_hash:
+            chunk_count = existing["chunk_count"] or 0
+            update_ingestion_job(job_id, doc_id=existing["id"], chunks_total=chunk_count,
+                                 chunks_embedded=chunk_count, chunks_stored=chunk_count)
+            job["doc_id"] = existing["id"]
+            return chunk_count, chunk_count
+        if get_document_chunk_indexes(kb_id, existing["id"]) is None:
+            replaced = existing["id"]
+        else:
+            job["doc_id"] = existing["id"]
+            job["incremental"] = True
+            update_ingestion_job(job_id, doc_id=existing["id"])
+
+    doc_id = job["doc_id"]
+    # 新文档也可能已有部分块（进程重启前写入的），同样直接复用
+    stored = get_document_chunk_indexes(kb_id, doc_id) or {}
+    chunks = iter_document_chunks(job["file_path"], job["filename"], job["content_type"])
+
+    seen = set()
+    moved = {}  # 复用的块中序号变化的 {content_hash: 新序号}
+    total = 0
+    while True:
+        batch = list(islice(chunks, INGESTION_BATCH_SIZE))
+        if not batch:
+            break
+        total += len(batch)
+        update_ingestion_job(job_id, chunks_total=total)
+        hashes = [chunk["metadata"]["content_hash"] for chunk in batch]
+        seen.update(hashes)
+        new_chunks = []
+        for chunk, h in zip(batch, hashes):
+            if h not in stored:
+                new_chunks.append(chunk)
+            elif stored[h] != chunk["metadata"]["chunk_index"]:
+                moved[h] = chunk["metadata"]["chunk_index"]
+
+        if new_chunks:
+            # 生成嵌入（分批并发请求，保持块顺序）
+            embeddings = get_embeddings_batched([chunk["text"] for chunk in new_chunks])
+            update_ingestion_job(job_id, chunks_embedded=total)
+
+            # 存储到向量数据库（块 ID 按 content_hash 生成，分批写入不会冲突）
+            added.extend(chunk["metadata"]["content_hash"] for chunk in new_chunks)
+            add_document_chunks(kb_id, doc_id, new_chunks, embeddings)
+        update_ingestion_job(job_id, chunks_embedded=total, chunks_stored=total)
+
+    # 全部写入成功后再更新复用块的序号、删除新版本中已不存在的块（失败时原文档保持不变）
+    update_document_chunk_indexes(kb_id, doc_id, moved)
+    delete_document_chunks(kb_id, doc_id, stored.keys() - seen)
+
+    # 记录到数据库
+    if job.get("incremental"):
+        if total:
+            update_document(doc_id, job["content_type"], total, file_hash)
+        else:
+            delete_document(doc_id)
+    elif total:
+        add_document(kb_id, doc_id, job["filename"], job["content_type"], total, content_hash=file_hash)
+    if replaced:
+        delete_document_vectors(kb_id, replaced)
+        delete_document(replaced)
+    return total, len(seen & stored.keys())
+
+
+def _cleanup(job: Dict, added: List[str]):
+    """任务失败后清理本次写入的块，避免检索到不完整的文档；增量更新时原文档保持可用"""
+    if job.get("incremental"):
+        delete_document_chunks(job["kb_id"], job["doc_id"], added)
+    else:
+        delete_document_vectors(job["kb_id"], job["doc_id"])
+
+
+def _heartbeat(job_id: str, stop: threading.Event):
+    """任务执行期间定期刷新 updated_at，恢复时据此区分仍在执行的任务与进程退出后中断的任务"""
+    while not stop.wait(INGESTION_HEARTBEAT_INTERVAL):
+        try:
+            touch_ingestion_job(job_id)
+        except Exception as e:
+            print(f"[入库] 任务心跳失败: {job_id}: {e}")
+
+
+def _retry_later(job_id: str):
+    """同名文档正在入库：先恢复心跳超时的任务（可能正是占用者），再延迟重新提交"""
+    try:
+        _submit_stale_jobs()
+    except Exception as e:
+        print(f"[入库] 恢复超时任务失败: {e}")
+    timer = threading.Timer(_BUSY_RETRY_SECONDS, _executor.submit, (run_job, job_id))
+    timer.daemon = True
+    timer.start()
+
+
+def run_job(job_id: str):
+    """执行一个入库任务（已被领取的任务直接跳过，同名文档正在入库时稍后重试）"""
+    claim = claim_ingestion_job(job_id)
+    if claim == "busy":
+        _retry_later(job_id)
+        return
+    if claim != "claimed":
+        return
+    job = get_ingestion_job(job_id)
+    if not os.path.exists(job["file_path"]):
+        update_ingestion_job(job_id, status="failed", error="上传文件已丢失，请重新上传")
+        return
+    added = []
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, stop), daemon=True).start()
+    try:
+        chunk_count, reused = _process(job, added)
+        update_ingestion_job(job_id, status="done")
+        # 整个文档写入后检查向量索引是否需要按新的行数重建（后台执行，仅 PostgreSQL）
+        ensure_vector_index_async()
+        log_info(f"[入库] 任务完成: {job_id} ({job['filename']}, {chunk_count} 块，复用 {reused} 块)",
+                 type="ingestion", job_id=job_id, kb_id=job["kb_id"], chunk_count=chunk_count,
+                 reused_chunks=reused)
+    except Exception as e:
+        log_error(f"[入库] 任务失败: {job_id} ({job['filename']}): {e}",
+                  type="ingestion", job_id=job_id, kb_id=job["kb_id"])
+        try:
+            _cleanup(job, added)
+        except Exception as cleanup_error:
+            print(f"[入库] 清理部分写入失败: {cleanup_error}")
+        update_ingestion_job(job_id, status="failed", error=str(e)[:1000])
+    finally:
+        stop.set()
+        try:
+            os.remove(job["file_path"])
+        except FileNotFoundError:
+            pass
+
+
+def _submit_stale_jobs() -> int:
+    """把心跳超时的 processing 任务重新排队并提交，返回任务数"""
+    job_ids = requeue_stale_ingestion_jobs(INGESTION_STALE_AFTER)
+    for job_id in job_ids:
+        _executor.submit(run_job, job_id)
+    return len(job_ids)
+
+
+def recover_ingestion_jobs() -> int:
+    """
+    启动时恢复未完成的任务，返回提交的任务数
+
+    只有心跳超过 INGESTION_STALE_AFTER 秒的 processing 任务才视为进程退出时被中断，原子地改回 queued
+    后重新执行（多个 worker 同时启动也只有一个能改到）；已写入的块按 content_hash 直接复用，
+    尚未删除的旧块照常删除。queued 任务直接提交，领取时保证只执行一次。
+    """
+    requeue_stale_ingestion_jobs(INGESTION_STALE_AFTER)
+    recovered = 0
+    for job_id in get_queued_ingestion_jobs():
+        _executor.submit(run_job, job_id)
+        recovered += 1
+    if recovered:
+        print(f"[入库] 已恢复 {recovered} 个未完成的任务")
+    return recovered
@@ -0,0 +1,217 @@
+"""
+本地关键词倒排索引 - ChromaDB 模式下的 BM25 检索
+每个知识库一个 SQLite 文件（CHROMA_DB_PATH/keyword_index/<kb_id>.db），
+入库/删除文档时增量维护，查询只读取命中词条的倒排表
+"""
+import heapq
+import math
+import os
+import sqlite3
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from tokenizer import tokenize, query_terms
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS chunks (
+        id INTEGER PRIMARY KEY,
+        chunk_id TEXT NOT NULL UNIQUE,
+        doc_id TEXT NOT NULL,
+        length INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(doc_id);
+    CREATE TABLE IF NOT EXISTS terms (
+        term TEXT PRIMARY KEY,
+        df INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS postings (
+        term TEXT NOT NULL,
+        chunk INTEGER NOT NULL,
+        tf INTEGER NOT NULL,
+        PRIMARY KEY (term, chunk)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings(chunk);
+    CREATE TABLE IF NOT EXISTS stats (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID;
+'''
+
+
+class KeywordIndex:
+    """单个知识库的 BM25 倒排索引"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    @staticmethod
+    def _bump_stats(conn: sqlite3.Connection, chunks: int, length: int):
+        """更新全局统计：块数与总词数（用于 BM25 的 N 与平均长度）"""
+        for key, delta in (("chunk_count", chunks), ("total_length", length)):
+            conn.execute('''
+                INSERT INTO stats (key, value) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+            ''', (key, delta))
+
+    def add_chunks(self, doc_id: str, items: List[Tuple[str, str]]):
+        """
+        增量写入文档块
+
+        Args:
+            doc_id: 文档 ID
+            items: [(chunk_id, text), ...]，chunk_id 与 ChromaDB 中的 ID 一致
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                total_length = 0
+                added = 0
+                for chunk_id, text in items:
+                    tokens = tokenize(text)
+                    cur = conn.execute(
+                        "INSERT OR IGNORE INTO chunks (chunk_id, doc_id, length) VALUES (?, ?, ?)",
+                        (chunk_id, doc_id, len(tokens))
+                    )
+                    if cur.rowcount == 0:
+                        continue  # 已索引过
+                    chunk = cur.lastrowid
+                    counts = Counter(tokens)
+                    conn.executemany(
+                        "INSERT INTO postings (term, chunk, tf) VALUES (?, ?, ?)",
+                        [(term, chunk, tf) for term, tf in counts.items()]
+                    )
+                    conn.executemany('''
+                        INSERT INTO terms (term, df) VALUES (?, 1)
+                        ON CONFLICT(term) DO UPDATE SET df = df + 1
+                    ''', [(term,) for term in counts])
+                    total_length += len(tokens)
+                    added += 1
+                self._bump_stats(conn, added, total_length)
+        finally:
+            conn.close()
+
+    def delete_document(self, doc_id: str) -> List[str]:
+        """
+        删除文档的所有块
+
+        Returns:
+            被删除的 chunk_id 列表
+        """
+        return self._delete_where("doc_id = ?", [doc_id])
+
+    def delete_chunks(self, chunk_ids: List[str]) -> List[str]:
+        """按 chunk_id 删除块，返回实际被删除的 chunk_id 列表"""
+        if not chunk_ids:
+            return []
+        return self._delete_where(f"chunk_id IN ({','.join('?' * len(chunk_ids))})", list(chunk_ids))
+
+    def _delete_where(self, where: str, params: List) -> List[str]:
+        if not self.exists():
+            return []
+        conn = self._connect()
+        try:
+            with conn:
+                rows = conn.execute(
+                    f"SELECT id, chunk_id, length FROM chunks WHERE {where}", params
+                ).fetchall()
+                if not rows:
+                    return []
+                chunk_ids = [row[0] for row in rows]
+                placeholders = ",".join("?" * len(chunk_ids))
+                term_counts = conn.execute(
+                    f"SELECT term, COUNT(*) FROM postings WHERE chunk IN ({placeholders}) GROUP BY term",
+                    chunk_ids
+                ).fetchall()
+                conn.executemany("UPDATE terms SET df = df - ? WHERE term = ?",
+                                 [(count, term) for term, count in term_counts])
+                conn.execute("DELETE FROM terms WHERE df <= 0")
+                conn.execute(f"DELETE FROM postings WHERE chunk IN ({placeholders})", chunk_ids)
+                conn.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", chunk_ids)
+                self._bump_stats(conn, -len(rows), -sum(row[2] for row in rows))
+            return [row[1] for row in rows]
+        finally:
+            conn.close()
+
+    def search(self, query: str, top_k: int = 20) -> List[Tuple[str, float]]:
+        """
+        BM25 检索
+
+        Returns:
+            [(chunk_id, score), ...]，按分数降序
+        """
+        terms = query_terms(query)
+        if not terms or not self.exists():
+            return []
+        conn = self._connect()
+        try:
+            stats = dict(conn.execute("SELECT key, value FROM stats").fetchall())
+            n = stats.get("chunk_count", 0)
+            if n <= 0:
+                return []
+            avgdl = stats.get("total_length", 0) / n or 1.0
+
+            placeholders = ",".join("?" * len(terms))
+            idf = {}
+            for term, df in conn.execute(
+                    f"SELECT term, df FROM terms WHERE term IN ({placeholders})", terms):
+                idf[term] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            if not idf:
+                return []
+
+            scores: Dict[str, float] = {}
+            rows = conn.execute(f'''
+                SELECT p.term, p.tf, c.chunk_id, c.length
+                FROM postings p JOIN chunks c ON c.id = p.chunk
+                WHERE p.term IN ({",".join("?" * len(idf))})
+            ''', list(idf))
+            for term, tf, chunk_id, length in rows:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avgdl)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+            return heapq.nlargest(top_k, scores.items(), key=lambda x: x[1])
+        finally:
+            conn.close()
+
+    def rebuild(self, items: List[Tuple[str, str, str]]):
+        """
+        全量重建索引（用于升级前已入库的知识库）
+
+        Args:
+            items: [(chunk_id, doc_id, text), ...]
+        """
+        self.drop()
+        by_doc: Dict[str, List[Tuple[str, str]]] = {}
+        for chunk_id, doc_id, text in items:
+            by_doc.setdefault(doc_id, []).append((chunk_id, text))
+        for doc_id, doc_items in by_doc.items():
+            self.add_chunks(doc_id, doc_items)
+        if not by_doc:
+            self._connect().close()  # 空知识库也落盘，避免反复重建
+
+    def drop(self):
+        """删除索引文件"""
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+
+def get_keyword_index(base_path: str, kb_id: str) -> KeywordIndex:
+    """获取知识库的倒排索引（索引文件位于 base_path/keyword_index/）"""
+    index_dir = os.path.join(base_path, "keyword_index")
+    os.makedirs(index_dir, exist_ok=True)
+    return KeywordIndex(os.path.join(index_dir, f"{kb_id}.db"))
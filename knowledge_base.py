@@ -2,12 +2,27 @@
 知识库管理模块 - 文档处理和向量存储
 支持 ChromaDB (SQLite 本地开发) 和 PostgreSQL pgvector (生产)
 """
+import hashlib
+import heapq
 import os
+from functools import partial
+import threading
 import uuid
 import json
-from typing import List, Dict, Optional
+import struct
+from array import array
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 from datetime import datetime
 
+from vectors import (
+    Vector, NUMPY_AVAILABLE, as_numpy_matrix, to_list, to_pgvector_text, to_pgvector_binary
+)
+from tokenizer import lexeme_positions, query_terms
+from keyword_index import get_keyword_index
+from extraction import iter_document_text
+from text_splitter import iter_chunks
+from retrieval_executor import get_retrieval_executor
+
 # 导入北京时间工具
 try:
     from database import get_beijing_time
@@ -33,12 +48,29 @@ except ImportError:
 DATABASE_URL = os.getenv("DATABASE_URL")
 USE_POSTGRES = DATABASE_URL and DATABASE_URL.startswith("postgresql")
 
+if USE_POSTGRES:
+    # 复用 database 模块的连接池，带耗时与等待连接统计
+    from database import timed_db
+    from config import VECTOR_INDEX_METHOD, VECTOR_HNSW_EF_SEARCH, VECTOR_IVFFLAT_PROBES
+
+# 知识库版本号：文档增删后递增，检索结果缓存以此判断是否失效
+from database import bump_kb_generation
+
 # ChromaDB 配置（本地开发）
 CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", "./chroma_db")
 
+# 本地模式可改用内置 NumPy 向量存储（LOCAL_VECTOR_STORE=numpy），不再依赖 chromadb
+from config import LOCAL_VECTOR_STORE, LOCAL_VECTOR_STORE_PATH
+USE_NUMPY_STORE = not USE_POSTGRES and LOCAL_VECTOR_STORE == "numpy"
+if USE_NUMPY_STORE:
+    from vector_store import get_vector_store, drop_vector_store
+
 # 全局 ChromaDB 客户端（延迟初始化）
 _chroma_client = None
 
+# 本地倒排索引首次构建锁（升级前已入库的知识库按需全量构建）
+_keyword_index_build_lock = threading.Lock()
+
 def get_chroma_client():
     """获取 ChromaDB 客户端（单例）"""
     global _chroma_client
@@ -56,141 +88,89 @@ def get_or_create_collection(name: str):
     return client.get_or_create_collection(name=name)
 
 
-def extract_text_from_file(file_path: str, content_type: str) -> str:
-    """从文件中提取文本"""
-    text = ""
-    
-    if content_type == "text/plain" or file_path.endswith(".txt"):
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-            text = f.read()
-    
-    elif content_type == "text/markdown" or file_path.endswith(".md"):
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-            text = f.read()
-    
-    elif content_type == "application/pdf" or file_path.endswith(".pdf"):
-        try:
-            from pypdf import PdfReader
-            reader = PdfReader(file_path)
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-        except ImportError:
-            try:
-                from PyPDF2 import PdfReader
-                reader = PdfReader(file_path)
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-            except Exception as e:
-                print(f"[PDF提取错误] {e}")
-    
-    elif file_path.endswith(".docx"):
-        try:
-            from docx import Document
-            doc = Document(file_path)
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-        except ImportError:
-            print("[DOCX提取错误] python-docx 未安装")
+def _chroma_embeddings(embeddings: List[Vector]):
+    """
+    转换为 ChromaDB 接受的嵌入格式
     
-    return text
+    float32 向量以 (n, dim) NumPy 矩阵传入（array('f') 零拷贝视图拼接），
+    不支持 NumPy 输入的旧版本 ChromaDB 由调用方回退为列表。
+    """
+    if NUMPY_AVAILABLE and embeddings and isinstance(embeddings[0], array):
+        return as_numpy_matrix(embeddings)
+    return [to_list(e) for e in embeddings]
 
 
-def split_text(text: str, chunk_size: int = 500, chunk_overlap: int = 50) -> List[str]:
-    """将文本分割成块"""
-    try:
-        from langchain.text_splitter import RecursiveCharacterTextSplitter
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=len,
-            separators=["\n\n", "\n", "。", "，", " ", ""]
-        )
-        return splitter.split_text(text)
-    except ImportError:
-        # 简单的文本分割回退
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            chunk = text[start:end]
-            chunks.append(chunk)
-            start = end - chunk_overlap
-        return chunks
+def content_hash(text: str) -> str:
+    """文本内容哈希（SHA-256）"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
-def process_document(file_path: str, filename: str, content_type: str) -> List[Dict]:
+def iter_document_chunks(file_path: str, filename: str, content_type: str) -> Iterator[Dict]:
     """
-    处理文档：提取文本、分块
-    
-    Returns:
-        List[Dict]: 文档块列表，每个块包含 text 和 metadata
+    流式处理文档：边提取边分块，逐块产出（不含 total_chunks，总块数在遍历结束后才知道）
+
+    每块带 token_count：块正文的 token 数，构建上下文时按它分配 token 预算。
+
+    每块带 content_hash：正文哈希，同一文档内重复出现的块追加 ":序号"，保证文档内唯一。
+    重新上传时按它判断哪些块未变化。
     """
-    # 提取文本
-    text = extract_text_from_file(file_path, content_type)
-    
-    if not text.strip():
-        return []
-    
-    # 分块
-    chunks = split_text(text)
-    
-    # 构建文档块
-    doc_chunks = []
-    for i, chunk in enumerate(chunks):
-        doc_chunks.append({
+    index = 0
+    seen = {}
+    for chunk, token_count in iter_chunks(iter_document_text(file_path, content_type)):
+        digest = content_hash(chunk)
+        occurrence = seen.get(digest, 0)
+        seen[digest] = occurrence + 1
+        yield {
             "text": chunk,
             "metadata": {
                 "filename": filename,
-                "chunk_index": i,
-                "total_chunks": len(chunks),
+                "chunk_index": index,
+                "content_hash": f"{digest}:{occurrence}" if occurrence else digest,
+                "token_count": token_count,
                 "source": filename
             }
-        })
-    
-    return doc_chunks
+        }
+        index += 1
+
 
+def _hash_chunk_id(doc_id: str, chunk_hash: str) -> str:
+    digest, _, occurrence = chunk_hash.partition(":")
+    return f"{doc_id}_{digest[:16]}" + (f"_{occurrence}" if occurrence else "")
 
-def add_chunks_to_chroma(kb_id: str, doc_id: str, chunks: List[Dict], embeddings: List[List[float]]):
+
+def _chunk_id(doc_id: str, chunk: Dict, i: int) -> str:
+    """
+    块 ID：按块内容哈希生成，内容不变的块重新入库时 ID 不变；
+    没有 content_hash 的块按序号（chunk_index）生成
+    """
+    chunk_hash = chunk["metadata"].get("content_hash")
+    if chunk_hash:
+        return _hash_chunk_id(doc_id, chunk_hash)
+    return f"{doc_id}_{chunk['metadata'].get('chunk_index', i)}"
+
+
+def add_chunks_to_chroma(kb_id: str, doc_id: str, chunks: List[Dict], embeddings: List[Vector]):
     """将文档块添加到 ChromaDB"""
     collection = get_or_create_collection(f"kb_{kb_id}")
     if collection is None:
         return
     
     beijing_time = get_beijing_time().isoformat()
-    ids = [f"{doc_id}_{i}" for i in range(len(chunks))]
+    ids = [_chunk_id(doc_id, c, i) for i, c in enumerate(chunks)]
     texts = [c["text"] for c in chunks]
     metadatas = [{**c["metadata"], "doc_id": doc_id, "created_at": beijing_time} for c in chunks]
     
-    collection.add(
-        ids=ids,
-        documents=texts,
-        embeddings=embeddings,
-        metadatas=metadatas
-    )
-
-
-def search_chroma(kb_id: str, query_embedding: List[float], top_k: int = 5) -> List[Dict]:
-    """在 ChromaDB 中搜索"""
-    collection = get_or_create_collection(f"kb_{kb_id}")
-    if collection is None:
-        return []
-    
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=top_k,
-        include=["documents", "metadatas", "distances"]
-    )
-    
-    matches = []
-    if results["documents"] and results["documents"][0]:
-        for i, doc in enumerate(results["documents"][0]):
-            matches.append({
-                "text": doc,
-                "metadata": results["metadatas"][0][i] if results["metadatas"] else {},
-                "distance": results["distances"][0][i] if results["distances"] else 0
-            })
+    chroma_embeddings = _chroma_embeddings(embeddings)
+    try:
+        collection.add(ids=ids, documents=texts, embeddings=chroma_embeddings, metadatas=metadatas)
+    except (ValueError, TypeError):
+        if isinstance(chroma_embeddings, list):
+            raise
+        # 旧版 ChromaDB 只接受列表
+        collection.add(ids=ids, documents=texts, embeddings=[to_list(e) for e in embeddings],
+                       metadatas=metadatas)
     
-    return matches
+    _add_to_keyword_index(kb_id, doc_id, ids, texts, is_new_kb=collection.count() == len(ids))
 
 
 def delete_doc_from_chroma(kb_id: str, doc_id: str):
@@ -206,256 +186,867 @@ def delete_doc_from_chroma(kb_id: str, doc_id: str):
         ids_to_delete = [id for id in results["ids"] if id.startswith(f"{doc_id}_")]
         if ids_to_delete:
             collection.delete(ids=ids_to_delete)
+    
+    _delete_from_keyword_index(kb_id, doc_id)
 
 
-def add_chunks_to_pg(kb_id: str, doc_id: str, chunks: List[Dict], embeddings: List[List[float]]):
-    """将文档块添加到 PostgreSQL pgvector"""
-    import psycopg2
+def get_chunk_indexes_chroma(kb_id: str, doc_id: str) -> List[Tuple[Optional[str], Optional[int]]]:
+    """ChromaDB 中文档各块的 (content_hash, chunk_index)"""
+    collection = get_or_create_collection(f"kb_{kb_id}")
+    if collection is None:
+        return []
+    results = collection.get(where={"doc_id": doc_id}, include=["metadatas"])
+    return [((metadata or {}).get("content_hash"), (metadata or {}).get("chunk_index"))
+            for metadata in results["metadatas"] or []]
+
+
+def update_chunk_indexes_chroma(kb_id: str, chunk_indexes: Dict[str, int]):
+    """更新 ChromaDB 中块的 chunk_index {chunk_id: 新序号}"""
+    collection = get_or_create_collection(f"kb_{kb_id}")
+    if collection is None:
+        return
+    results = collection.get(ids=list(chunk_indexes), include=["metadatas"])
+    if not results["ids"]:
+        return
+    metadatas = [{**(metadata or {}), "chunk_index": chunk_indexes[chunk_id]}
+                 for chunk_id, metadata in zip(results["ids"], results["metadatas"])]
+    collection.update(ids=results["ids"], metadatas=metadatas)
+
+
+def delete_chunks_from_chroma(kb_id: str, chunk_ids: List[str]):
+    """从 ChromaDB 删除指定的块"""
+    collection = get_or_create_collection(f"kb_{kb_id}")
+    if collection is None:
+        return
+    collection.delete(ids=chunk_ids)
+    _delete_chunks_from_keyword_index(kb_id, chunk_ids)
+
+
+# ========== 内置向量存储（本地模式，LOCAL_VECTOR_STORE=numpy）==========
+
+def add_chunks_to_local(kb_id: str, doc_id: str, chunks: List[Dict], embeddings: List[Vector]):
+    """将文档块写入内置向量存储"""
+    store = get_vector_store(kb_id)
+    beijing_time = get_beijing_time().isoformat()
+    ids = [_chunk_id(doc_id, c, i) for i, c in enumerate(chunks)]
+    texts = [c["text"] for c in chunks]
+    metadatas = [{**c["metadata"], "doc_id": doc_id, "created_at": beijing_time} for c in chunks]
+    store.add(doc_id, ids, texts, metadatas, embeddings)
+    _add_to_keyword_index(kb_id, doc_id, ids, texts, is_new_kb=store.count() == len(ids))
+
+
+def delete_doc_from_local(kb_id: str, doc_id: str):
+    """从内置向量存储删除文档"""
+    get_vector_store(kb_id).delete_document(doc_id)
+    _delete_from_keyword_index(kb_id, doc_id)
+
+
+def get_chunk_indexes_local(kb_id: str, doc_id: str) -> List[Tuple[Optional[str], Optional[int]]]:
+    """内置向量存储中文档各块的 (content_hash, chunk_index)"""
+    return [(metadata.get("content_hash"), metadata.get("chunk_index"))
+            for metadata in get_vector_store(kb_id).document_chunks(doc_id).values()]
+
+
+def delete_chunks_from_local(kb_id: str, chunk_ids: List[str]):
+    """从内置向量存储删除指定的块"""
+    get_vector_store(kb_id).delete_chunks(chunk_ids)
+    _delete_chunks_from_keyword_index(kb_id, chunk_ids)
+
+
+# PostgreSQL COPY 二进制格式：签名 + flags + 扩展头长度；结尾为 -1 字段数
+_PG_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_PG_COPY_TRAILER = struct.pack(">h", -1)
+
+
+class _CopyStream:
+    """把字节块迭代器包装成 copy_expert 可读取的文件对象，按需生成，内存有界"""
     
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
+    def __init__(self, pieces):
+        self._pieces = iter(pieces)
+        self._buf = b""
     
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += next(self._pieces)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buf = self._buf, b""
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+def _tsvector_binary(lexemes: Dict[str, List[int]]) -> bytes:
+    """
+    编码为 tsvector 二进制格式（tsvector_recv）
+
+    布局：int32 词条数；每个词条为以 NUL 结尾的词条文本 + uint16 位置数 + uint16 位置列表。
+    """
+    parts = [struct.pack(">i", len(lexemes))]
+    for lexeme, positions in lexemes.items():
+        parts.append(lexeme.encode("utf-8") + b"\x00")
+        parts.append(struct.pack(">H%dH" % len(positions), len(positions), *positions))
+    return b"".join(parts)
+
+
+def _tsvector_text(lexemes: Dict[str, List[int]]) -> str:
+    """
+    编码为 tsvector 文本字面量 'lex':1,2 ...（配合 %s::tsvector 使用）
+
+    分词结果只含字母数字与 CJK 字符，无需转义。
+    """
+    return " ".join(f"'{lex}':{','.join(map(str, pos))}" for lex, pos in lexemes.items())
+
+
+def _tsquery_text(query: str) -> Optional[str]:
+    """把查询分词后以 OR 连接为 tsquery 文本字面量；无有效词条时返回 None"""
+    terms = query_terms(query)
+    if not terms:
+        return None
+    return " | ".join(f"'{term}'" for term in terms)
+
+
+def _pg_copy_rows(rows):
+    """按 COPY 二进制格式逐行编码 (kb_id, doc_id, content, embedding, metadata, content_tsv)"""
+    yield _PG_COPY_HEADER
+    for kb_id, doc_id, text, embedding, metadata in rows:
+        fields = (
+            kb_id.encode("utf-8"),
+            doc_id.encode("utf-8"),
+            text.encode("utf-8"),
+            to_pgvector_binary(embedding),
+            b"\x01" + json.dumps(metadata).encode("utf-8"),  # jsonb 二进制格式版本号 1
+            _tsvector_binary(lexeme_positions(text)),
+        )
+        parts = [struct.pack(">h", len(fields))]
+        for field in fields:
+            parts.append(struct.pack(">i", len(field)))
+            parts.append(field)
+        yield b"".join(parts)
+    yield _PG_COPY_TRAILER
+
+
+def add_chunks_to_pg(kb_id: str, doc_id: str, chunks: List[Dict], embeddings: List[Vector]):
+    """
+    将文档块批量写入 PostgreSQL pgvector
+    
+    使用连接池连接，以 COPY 二进制格式一次往返写入整篇文档（向量按 pgvector
+    二进制格式编码，关键词检索用的 content_tsv 同时写入）；COPY 失败时回退为多行 INSERT。
+    """
+    import psycopg2
+    from psycopg2.extras import execute_values
+    
+    rows = []
     for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-        metadata = {**chunk["metadata"], "doc_id": doc_id, "chunk_index": i}
+        metadata = {"chunk_index": i, **chunk["metadata"], "doc_id": doc_id}
         # 清理 NUL 字符，避免 PostgreSQL 插入错误
         text = chunk["text"].replace('\x00', '')
-        cur.execute('''
-            INSERT INTO document_chunks (kb_id, doc_id, content, embedding, metadata)
-            VALUES (%s, %s, %s, %s, %s)
-        ''', (kb_id, doc_id, text, embedding, json.dumps(metadata)))
+        rows.append((kb_id, doc_id, text, embedding, metadata))
+    if not rows:
+        return
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    with timed_db("copy", "document_chunks", rows=len(rows)) as conn:
+        cur = conn.cursor()
+        try:
+            cur.copy_expert(
+                "COPY document_chunks (kb_id, doc_id, content, embedding, metadata, content_tsv) "
+                "FROM STDIN WITH (FORMAT binary)",
+                _CopyStream(_pg_copy_rows(rows))
+            )
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"[向量写入] COPY 失败，回退为批量 INSERT: {e}")
+            execute_values(
+                cur,
+                '''
+                    INSERT INTO document_chunks (kb_id, doc_id, content, embedding, metadata, content_tsv)
+                    VALUES %s
+                ''',
+                [(k, d, t, to_pgvector_text(e), json.dumps(m), _tsvector_text(lexeme_positions(t)))
+                 for k, d, t, e, m in rows],
+                template="(%s, %s, %s, %s::vector, %s, %s::tsvector)",
+                page_size=500
+            )
+        conn.commit()
+        cur.close()
 
 
-def search_pg(kb_id: str, query_embedding: List[float], top_k: int = 5) -> List[Dict]:
-    """在 PostgreSQL pgvector 中搜索"""
-    import psycopg2
-    
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
-    
-    cur.execute('''
-        SELECT content, metadata, embedding <=> %s::vector as distance
-        FROM document_chunks
-        WHERE kb_id = %s
-        ORDER BY embedding <=> %s::vector
-        LIMIT %s
-    ''', (query_embedding, kb_id, query_embedding, top_k))
-    
-    matches = []
-    for row in cur.fetchall():
-        matches.append({
-            "text": row[0],
-            "metadata": row[1],
-            "distance": row[2]
-        })
-    
-    cur.close()
-    conn.close()
-    return matches
+def _set_vector_search_params(cur, top_k: int):
+    """按索引类型设置本事务内的查询参数（SET LOCAL，连接归还时随回滚失效）"""
+    if VECTOR_INDEX_METHOD == "hnsw":
+        # ef_search 小于 top_k 时 HNSW 最多只能返回 ef_search 条结果
+        cur.execute("SET LOCAL hnsw.ef_search = %s", (max(VECTOR_HNSW_EF_SEARCH, top_k),))
+    else:
+        cur.execute("SET LOCAL ivfflat.probes = %s", (VECTOR_IVFFLAT_PROBES,))
+
+
+# 不截断正文时传给 left() 的长度
+_NO_TEXT_LIMIT = 2147483647
+
+
+def search_pg_multi(kb_ids: List[str], query_embedding: Vector, top_k: int = 5,
+                    limit: Optional[int] = None, text_limit: Optional[int] = None) -> List[Dict]:
+    """
+    在多个知识库中做向量检索（一条 SQL、一次往返）
+
+    候选阶段对 kb_ids 逐个做 LATERAL 子查询（仍可走向量索引）且只取 (id, 距离)，
+    全局排序截断后才读取胜出块的正文（可只取前 text_limit 个字符）与元数据。
+
+    Returns:
+        按距离升序的结果列表（带 kb_id）
+    """
+    params = {
+        "kb_ids": list(kb_ids),
+        "vec": to_pgvector_text(query_embedding),
+        "top_k": top_k,
+        "limit": limit or top_k * len(kb_ids),
+        "text_limit": text_limit or _NO_TEXT_LIMIT,
+    }
+    with timed_db("vector_search_multi", "document_chunks", kb_count=len(kb_ids)) as conn:
+        cur = conn.cursor()
+        _set_vector_search_params(cur, top_k)
+        cur.execute('''
+            WITH cand AS (
+                SELECT k.kb_id, c.id, c.distance
+                FROM unnest(%(kb_ids)s::text[]) AS k(kb_id)
+                CROSS JOIN LATERAL (
+                    SELECT d.id, d.embedding <=> %(vec)s::vector AS distance
+                    FROM document_chunks d
+                    WHERE d.kb_id = k.kb_id
+                    ORDER BY d.embedding <=> %(vec)s::vector
+                    LIMIT %(top_k)s
+                ) c
+                ORDER BY c.distance
+                LIMIT %(limit)s
+            )
+            SELECT cand.kb_id, cand.distance, left(d.content, %(text_limit)s) AS content, d.metadata
+            FROM cand
+            JOIN document_chunks d ON d.id = cand.id
+            ORDER BY cand.distance
+        ''', params)
+        rows = cur.fetchall()
+        cur.close()
+
+    return [{
+        "text": row["content"],
+        "metadata": row["metadata"],
+        "distance": row["distance"],
+        "kb_id": row["kb_id"],
+    } for row in rows]
 
 
 def delete_doc_from_pg(kb_id: str, doc_id: str):
     """从 PostgreSQL 删除文档"""
-    import psycopg2
-    
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
-    
-    cur.execute('DELETE FROM document_chunks WHERE kb_id = %s AND doc_id = %s', (kb_id, doc_id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    with timed_db("delete", "document_chunks", kb_id=kb_id) as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM document_chunks WHERE kb_id = %s AND doc_id = %s', (kb_id, doc_id))
+        conn.commit()
+        cur.close()
 
 
-# ========== 混合召回：BM25 关键词检索 ==========
+def get_chunk_indexes_pg(kb_id: str, doc_id: str) -> List[Tuple[Optional[str], Optional[int]]]:
+    """PostgreSQL 中文档各块的 (content_hash, chunk_index)"""
+    with timed_db("chunk_hashes", "document_chunks", kb_id=kb_id) as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT metadata->>'content_hash' AS content_hash,
+                   (metadata->>'chunk_index')::int AS chunk_index
+            FROM document_chunks
+            WHERE kb_id = %s AND doc_id = %s
+        ''', (kb_id, doc_id))
+        rows = cur.fetchall()
+        cur.close()
+    return [(row["content_hash"], row["chunk_index"]) for row in rows]
 
-def search_bm25_pg(kb_id: str, query: str, top_k: int = 20) -> List[Dict]:
-    """使用 PostgreSQL 全文搜索进行 BM25 检索"""
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
+
+def update_chunk_indexes_pg(kb_id: str, doc_id: str, chunk_indexes: Dict[str, int]):
+    """按 content_hash 更新 PostgreSQL 中块的 chunk_index {content_hash: 新序号}"""
+    with timed_db("update_chunk_index", "document_chunks", kb_id=kb_id, rows=len(chunk_indexes)) as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE document_chunks AS d
+            SET metadata = jsonb_set(d.metadata, '{chunk_index}', to_jsonb(v.chunk_index))
+            FROM unnest(%s::text[], %s::int[]) AS v(content_hash, chunk_index)
+            WHERE d.kb_id = %s AND d.doc_id = %s AND d.metadata->>'content_hash' = v.content_hash
+        ''', (list(chunk_indexes), list(chunk_indexes.values()), kb_id, doc_id))
+        conn.commit()
+        cur.close()
+
+
+def delete_chunks_from_pg(kb_id: str, doc_id: str, chunk_hashes: List[str]):
+    """按 content_hash 从 PostgreSQL 删除文档的部分块"""
+    with timed_db("delete", "document_chunks", kb_id=kb_id, rows=len(chunk_hashes)) as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            DELETE FROM document_chunks
+            WHERE kb_id = %s AND doc_id = %s AND metadata->>'content_hash' = ANY(%s)
+        ''', (kb_id, doc_id, list(chunk_hashes)))
+        conn.commit()
+        cur.close()
+
+
+# ========== 混合召回：向量 + BM25 关键词检索 ==========
+
+# 混合召回每路候选数与 RRF 常数
+HYBRID_CANDIDATES = 20
+RRF_K = 60
+
+
+def search_hybrid_pg(kb_ids: List[str], query: str, query_embedding: Vector, top_k: int = 5,
+                     vector_weight: float = 0.5, limit: Optional[int] = None,
+                     text_limit: Optional[int] = None) -> List[Dict]:
+    """
+    PostgreSQL 混合召回（一条 CTE 查询完成两路召回与加权 RRF 融合）
+
+    每个知识库各取向量/关键词候选 HYBRID_CANDIDATES 条，按 chunk id 做加权 RRF，
+    每个知识库保留前 top_k 条，全局按融合分数取前 limit 条；候选阶段只处理 (id, 分数)，
+    只有最终结果才读取正文（可只取前 text_limit 个字符）。
+
+    Returns:
+        按 hybrid_score 降序的结果列表（带 kb_id）
+    """
+    limit = limit or top_k * len(kb_ids)
+    vector_literal = to_pgvector_text(query_embedding)
+    params = {
+        "kb_ids": list(kb_ids),
+        "vec": vector_literal,
+        "tsq": _tsquery_text(query),  # 无有效词条时为 NULL，关键词一路为空
+        "cand": HYBRID_CANDIDATES,
+        "rrf_k": RRF_K,
+        "vw": vector_weight,
+        "bw": 1 - vector_weight,
+        "top_k": top_k,
+        "limit": limit,
+        "text_limit": text_limit or _NO_TEXT_LIMIT,
+    }
+    with timed_db("hybrid_search", "document_chunks", kb_count=len(kb_ids)) as conn:
+        cur = conn.cursor()
+        _set_vector_search_params(cur, HYBRID_CANDIDATES)
+        cur.execute('''
+            WITH kbs AS (
+                SELECT unnest(%(kb_ids)s::text[]) AS kb_id
+            ),
+            vec AS (
+                SELECT k.kb_id, c.id, c.distance,
+                       row_number() OVER (PARTITION BY k.kb_id ORDER BY c.distance) AS rnk
+                FROM kbs k
+                CROSS JOIN LATERAL (
+                    SELECT d.id, d.embedding <=> %(vec)s::vector AS distance
+                    FROM document_chunks d
+                    WHERE d.kb_id = k.kb_id
+                    ORDER BY d.embedding <=> %(vec)s::vector
+                    LIMIT %(cand)s
+                ) c
+            ),
+            kw AS (
+                SELECT k.kb_id, c.id, c.score,
+                       row_number() OVER (PARTITION BY k.kb_id ORDER BY c.score DESC, c.id) AS rnk
+                FROM kbs k
+                CROSS JOIN LATERAL (
+                    SELECT d.id, ts_rank(d.content_tsv, %(tsq)s::tsquery) AS score
+                    FROM document_chunks d
+                    WHERE d.kb_id = k.kb_id
+                      AND d.content_tsv @@ %(tsq)s::tsquery
+                    ORDER BY score DESC
+                    LIMIT %(cand)s
+                ) c
+            ),
+            fused AS (
+                SELECT COALESCE(v.kb_id, b.kb_id) AS kb_id,
+                       COALESCE(v.id, b.id) AS id,
+                       COALESCE(%(vw)s::float8 / (%(rrf_k)s + v.rnk), 0)
+                         + COALESCE(%(bw)s::float8 / (%(rrf_k)s + b.rnk), 0) AS hybrid_score,
+                       v.distance,
+                       b.score AS bm25_score
+                FROM vec v
+                FULL OUTER JOIN kw b ON b.id = v.id
+            ),
+            ranked AS (
+                SELECT f.*,
+                       row_number() OVER (PARTITION BY f.kb_id ORDER BY f.hybrid_score DESC, f.id) AS kb_rank
+                FROM fused f
+            )
+            SELECT r.kb_id, r.hybrid_score, r.distance, r.bm25_score,
+                   left(d.content, %(text_limit)s) AS content, d.metadata
+            FROM ranked r
+            JOIN document_chunks d ON d.id = r.id
+            WHERE r.kb_rank <= %(top_k)s
+            ORDER BY r.hybrid_score DESC
+            LIMIT %(limit)s
+        ''', params)
+        rows = cur.fetchall()
+        cur.close()
     
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    results = []
+    for row in rows:
+        result = {
+            "text": row["content"],
+            "metadata": row["metadata"],
+            "kb_id": row["kb_id"],
+            "hybrid_score": float(row["hybrid_score"]),
+        }
+        if row["distance"] is not None:
+            result["distance"] = row["distance"]
+            result["score"] = 1.0 / (1.0 + row["distance"])
+            result["source"] = "vector"
+        else:
+            result["score"] = float(row["bm25_score"])
+            result["source"] = "bm25"
+        results.append(result)
+    return results
+
+
+def search_keyword_pg(kb_ids: List[str], query: str, top_k: int = 5, vector_weight: float = 0.5,
+                      limit: Optional[int] = None, text_limit: Optional[int] = None) -> List[Dict]:
+    """
+    PostgreSQL 纯关键词召回（一条 SQL），查询向量不可用（嵌入超时/失败）时代替 search_hybrid_pg
+
+    每个知识库取前 top_k 条，hybrid_score 按只有关键词一路的 RRF 计算，与混合召回的分数可比。
+
+    Returns:
+        按 hybrid_score 降序的结果列表（带 kb_id）
+    """
+    tsquery = _tsquery_text(query)
+    if tsquery is None:
+        return []
+    params = {
+        "kb_ids": list(kb_ids),
+        "tsq": tsquery,
+        "rrf_k": RRF_K,
+        "bw": 1 - vector_weight,
+        "top_k": top_k,
+        "limit": limit or top_k * len(kb_ids),
+        "text_limit": text_limit or _NO_TEXT_LIMIT,
+    }
+    with timed_db("bm25_search", "document_chunks", kb_count=len(kb_ids)) as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            WITH kw AS (
+                SELECT c.id, c.score,
+                       %(bw)s::float8 / (%(rrf_k)s + row_number() OVER (
+                           PARTITION BY k.kb_id ORDER BY c.score DESC, c.id)) AS hybrid_score,
+                       k.kb_id
+                FROM unnest(%(kb_ids)s::text[]) AS k(kb_id)
+                CROSS JOIN LATERAL (
+                    SELECT d.id, ts_rank(d.content_tsv, %(tsq)s::tsquery) AS score
+                    FROM document_chunks d
+                    WHERE d.kb_id = k.kb_id
+                      AND d.content_tsv @@ %(tsq)s::tsquery
+                    ORDER BY score DESC, d.id
+                    LIMIT %(top_k)s
+                ) c
+                ORDER BY hybrid_score DESC, c.score DESC
+                LIMIT %(limit)s
+            )
+            SELECT kw.kb_id, kw.hybrid_score, kw.score,
+                   left(d.content, %(text_limit)s) AS content, d.metadata
+            FROM kw
+            JOIN document_chunks d ON d.id = kw.id
+            ORDER BY kw.hybrid_score DESC, kw.score DESC
+        ''', params)
+        rows = cur.fetchall()
+        cur.close()
+
+    return [{
+        "text": row["content"],
+        "metadata": row["metadata"],
+        "kb_id": row["kb_id"],
+        "hybrid_score": float(row["hybrid_score"]),
+        "score": float(row["score"]),
+        "source": "bm25",
+    } for row in rows]
+
+
+def backfill_content_tsv(batch_size: int = 500) -> int:
+    """
+    为历史数据补齐 content_tsv（按批处理，可重复执行；启动时由 init_vector_db 在后台调用）
+
+    每批用 FOR UPDATE SKIP LOCKED 选取，多个进程同时启动时各自处理不同的行。
+    补齐后递增涉及的知识库版本号，补齐前缓存的检索结果不再被命中。
+
+    Returns:
+        本次补齐的行数
+    """
+    from psycopg2.extras import execute_values
     
+    total = 0
+    kb_ids = set()
     try:
-        # 使用 PostgreSQL 的全文搜索功能
-        # 将查询转换为 tsquery 格式
-        cur.execute('''
-            SELECT content, metadata, 
-                   ts_rank(to_tsvector('chinese', content), 
-                           plainto_tsquery('chinese', %s)) as score
-            FROM document_chunks
-            WHERE kb_id = %s
-              AND to_tsvector('chinese', content) @@ plainto_tsquery('chinese', %s)
-            ORDER BY score DESC
-            LIMIT %s
-        ''', (query, kb_id, query, top_k))
-        
-        matches = []
-        for row in cur.fetchall():
-            matches.append({
-                "text": row["content"],
-                "metadata": row["metadata"],
-                "score": float(row["score"]),
-                "source": "bm25"
-            })
-        return matches
-    except Exception as e:
-        print(f"[BM25搜索错误] {e}")
-        return []
+        while True:
+            with timed_db("backfill_tsv", "document_chunks", batch_size=batch_size) as conn:
+                cur = conn.cursor()
+                cur.execute('''
+                    SELECT id, kb_id, content FROM document_chunks
+                    WHERE content_tsv IS NULL
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ''', (batch_size,))
+                rows = cur.fetchall()
+                if rows:
+                    # 没有任何词条的块写入空 tsvector，避免被反复选中
+                    execute_values(
+                        cur,
+                        '''
+                            UPDATE document_chunks AS d SET content_tsv = v.tsv::tsvector
+                            FROM (VALUES %s) AS v(id, tsv)
+                            WHERE d.id = v.id
+                        ''',
+                        [(row["id"], _tsvector_text(lexeme_positions(row["content"]))) for row in rows],
+                        page_size=batch_size
+                    )
+                conn.commit()
+                cur.close()
+            total += len(rows)
+            kb_ids.update(row["kb_id"] for row in rows if row["kb_id"])
+            if len(rows) < batch_size:
+                return total
+            print(f"[DB] content_tsv 已补齐 {total} 行")
     finally:
-        cur.close()
-        conn.close()
+        for kb_id in kb_ids:
+            _bump_generation(kb_id)
+
 
+# ========== 本地关键词倒排索引 ==========
 
-def search_bm25_chroma(kb_id: str, query: str, top_k: int = 20) -> List[Dict]:
-    """ChromaDB 的 BM25 检索（简单关键词匹配）"""
+def _keyword_index(kb_id: str):
+    """知识库的倒排索引（与所用的本地向量存储放在同一目录下）"""
+    return get_keyword_index(LOCAL_VECTOR_STORE_PATH if USE_NUMPY_STORE else CHROMA_DB_PATH, kb_id)
+
+
+def _add_to_keyword_index(kb_id: str, doc_id: str, ids: List[str], texts: List[str], is_new_kb: bool):
+    """增量更新倒排索引（新知识库直接建立；升级前已有数据的知识库留待首次检索时全量构建）"""
+    index = _keyword_index(kb_id)
+    if index.exists() or is_new_kb:
+        try:
+            index.add_chunks(doc_id, list(zip(ids, texts)))
+        except Exception as e:
+            print(f"[关键词索引] 写入失败，删除后将在下次检索时重建: {e}")
+            index.drop()
+
+
+def _delete_from_keyword_index(kb_id: str, doc_id: str):
+    index = _keyword_index(kb_id)
+    try:
+        index.delete_document(doc_id)
+    except Exception as e:
+        print(f"[关键词索引] 删除失败，删除后将在下次检索时重建: {e}")
+        index.drop()
+
+
+def _delete_chunks_from_keyword_index(kb_id: str, chunk_ids: List[str]):
+    index = _keyword_index(kb_id)
+    try:
+        index.delete_chunks(chunk_ids)
+    except Exception as e:
+        print(f"[关键词索引] 删除失败，删除后将在下次检索时重建: {e}")
+        index.drop()
+
+
+def _ensure_keyword_index(kb_id: str, load_items):
+    """
+    获取知识库的倒排索引；索引文件不存在时全量构建一次
+    
+    Args:
+        load_items: 返回 [(chunk_id, doc_id, text), ...] 的函数
+    """
+    index = _keyword_index(kb_id)
+    if index.exists():
+        return index
+    with _keyword_index_build_lock:
+        if not index.exists():
+            items = list(load_items())
+            index.rebuild(items)
+            print(f"[关键词索引] 知识库 {kb_id} 已构建: {len(items)} 块")
+    return index
+
+
+def _chroma_keyword_items(collection):
+    """从 ChromaDB 集合读取全部块，用于首次构建倒排索引"""
+    results = collection.get(include=["documents", "metadatas"])
+    items = []
+    for i, chunk_id in enumerate(results["ids"]):
+        doc = results["documents"][i] if results["documents"] else None
+        if not doc:
+            continue
+        metadata = (results["metadatas"][i] if results["metadatas"] else None) or {}
+        items.append((chunk_id, metadata.get("doc_id") or chunk_id.rsplit("_", 1)[0], doc))
+    return items
+
+
+# ========== 本地模式两阶段检索：候选只含 (chunk_id, 分数)，正文按需批量读取 ==========
+
+def _local_vector_candidates(kb_id: str, query_embedding: Vector, n: int) -> List[Tuple[str, float]]:
+    """本地向量候选 [(chunk_id, 距离)]，按距离升序"""
+    if USE_NUMPY_STORE:
+        return get_vector_store(kb_id).search(query_embedding, n)
     collection = get_or_create_collection(f"kb_{kb_id}")
     if collection is None:
         return []
-    
+    query_embeddings = _chroma_embeddings([query_embedding])
     try:
-        # 获取所有文档
-        results = collection.get(include=["documents", "metadatas"])
-        if not results["documents"]:
-            return []
-        
-        # 简单关键词匹配
-        query_keywords = set(query.lower().split())
-        matches = []
-        
-        for i, doc in enumerate(results["documents"]):
-            if not doc:
-                continue
-            content_lower = doc.lower()
-            score = sum(1 for kw in query_keywords if kw in content_lower)
-            
-            if score > 0:
-                matches.append({
-                    "text": doc,
-                    "metadata": results["metadatas"][i] if results["metadatas"] else {},
-                    "score": score,
-                    "source": "bm25"
-                })
-        
-        # 按分数排序
-        matches.sort(key=lambda x: x["score"], reverse=True)
-        return matches[:top_k]
-    except Exception as e:
-        print(f"[BM25搜索错误] {e}")
+        results = collection.query(query_embeddings=query_embeddings, n_results=n, include=["distances"])
+    except (ValueError, TypeError):
+        if isinstance(query_embeddings, list):
+            raise
+        results = collection.query(query_embeddings=[to_list(query_embedding)], n_results=n,
+                                   include=["distances"])
+    if not results["ids"] or not results["ids"][0]:
         return []
+    return list(zip(results["ids"][0], results["distances"][0]))
 
 
-def search_bm25(kb_id: str, query: str, top_k: int = 20) -> List[Dict]:
-    """BM25 关键词检索统一接口"""
-    if USE_POSTGRES:
-        return search_bm25_pg(kb_id, query, top_k)
+def _local_keyword_candidates(kb_id: str, query: str, n: int) -> List[Tuple[str, float]]:
+    """本地 BM25 候选 [(chunk_id, 分数)]，按分数降序"""
+    if USE_NUMPY_STORE:
+        load_items = get_vector_store(kb_id).iter_chunks
     else:
-        return search_bm25_chroma(kb_id, query, top_k)
+        collection = get_or_create_collection(f"kb_{kb_id}")
+        if collection is None:
+            return []
+        load_items = lambda: _chroma_keyword_items(collection)
+    return _ensure_keyword_index(kb_id, load_items).search(query, n)
+
+
+def _local_fetch(kb_id: str, chunk_ids: List[str], text_limit: Optional[int] = None) -> Dict:
+    """批量读取块的正文与元数据 {chunk_id: (正文, 元数据)}，可只取前 text_limit 个字符"""
+    if not chunk_ids:
+        return {}
+    if USE_NUMPY_STORE:
+        return get_vector_store(kb_id).get(chunk_ids, text_limit)
+    collection = get_or_create_collection(f"kb_{kb_id}")
+    if collection is None:
+        return {}
+    results = collection.get(ids=chunk_ids, include=["documents", "metadatas"])
+    found = {}
+    for i, chunk_id in enumerate(results["ids"]):
+        text = results["documents"][i] or ""
+        found[chunk_id] = (
+            text[:text_limit] if text_limit else text,
+            results["metadatas"][i] if results["metadatas"] else {}
+        )
+    return found
+
+
+def fetch_candidates(entries: List[Dict], text_limit: Optional[int] = None) -> List[Dict]:
+    """
+    为胜出的候选读取正文与元数据（本地模式每个知识库一次批量读取），读不到的候选（已被删除）丢弃
+    """
+    ids_by_kb = {}
+    for entry in entries:
+        ids_by_kb.setdefault(entry["kb_id"], []).append(entry["chunk_id"])
+    found = {kb_id: _local_fetch(kb_id, ids, text_limit) for kb_id, ids in ids_by_kb.items()}
+    
+    results = []
+    for entry in entries:
+        chunk = found[entry["kb_id"]].get(entry.pop("chunk_id"))
+        if chunk is None:
+            continue
+        entry["text"], entry["metadata"] = chunk
+        results.append(entry)
+    return results
 
 
 # ========== 统一接口 ==========
 
-def add_document_chunks(kb_id: str, doc_id: str, chunks: List[Dict], embeddings: List[List[float]]):
-    """添加文档块到向量数据库"""
-    if USE_POSTGRES:
-        add_chunks_to_pg(kb_id, doc_id, chunks, embeddings)
-    else:
-        add_chunks_to_chroma(kb_id, doc_id, chunks, embeddings)
+def _bump_generation(kb_id: str):
+    """
+    写入/删除完成后递增知识库版本号（必须在数据变更之后执行，
+    否则并发检索可能把旧数据缓存到新版本号下）
+    """
+    try:
+        bump_kb_generation(kb_id)
+    except Exception as e:
+        print(f"[知识库版本] 更新失败 {kb_id}: {e}")
 
 
-def search_knowledge_base(kb_id: str, query_embedding: List[float], top_k: int = 5) -> List[Dict]:
-    """搜索知识库（纯向量检索，保持向后兼容）"""
-    if USE_POSTGRES:
-        return search_pg(kb_id, query_embedding, top_k)
-    else:
-        return search_chroma(kb_id, query_embedding, top_k)
+def add_document_chunks(kb_id: str, doc_id: str, chunks: List[Dict], embeddings: List[Vector]):
+    """添加文档块到向量数据库"""
+    try:
+        if USE_POSTGRES:
+            add_chunks_to_pg(kb_id, doc_id, chunks, embeddings)
+        elif USE_NUMPY_STORE:
+            add_chunks_to_local(kb_id, doc_id, chunks, embeddings)
+        else:
+            add_chunks_to_chroma(kb_id, doc_id, chunks, embeddings)
+    finally:
+        # 失败时也可能已写入部分数据
+        _bump_generation(kb_id)
 
 
-def search_knowledge_base_hybrid(kb_id: str, query: str, query_embedding: List[float], 
-                                   top_k: int = 5, vector_weight: float = 0.5) -> List[Dict]:
+def _rrf_fuse(vector_hits: List[Tuple], bm25_hits: List[Tuple], top_k: int,
+              vector_weight: float) -> List[Tuple]:
     """
-    混合召回：向量检索 + BM25 关键词检索
+    按块 ID 做加权 RRF 融合 (Reciprocal Rank Fusion)
     
     Args:
-        kb_id: 知识库 ID
-        query: 查询文本
-        query_embedding: 查询向量
-        top_k: 返回结果数
-        vector_weight: 向量检索权重 (0-1)，默认 0.5 表示均等权重
+        vector_hits / bm25_hits: 按各自相关性排好序的 [(chunk_id, 分数), ...]
     
     Returns:
-        融合排序后的结果列表
-    """
-    # 1. 向量检索
-    vector_results = search_knowledge_base(kb_id, query_embedding, top_k=20)
-    for r in vector_results:
-        r["source"] = "vector"
-        # 将距离转换为分数（距离越小分数越高）
-        r["score"] = 1.0 / (1.0 + r.get("distance", 0))
-    
-    # 2. BM25 关键词检索
-    bm25_results = search_bm25(kb_id, query, top_k=20)
-    
-    # 3. RRF 融合排序 (Reciprocal Rank Fusion)
-    k = 60  # RRF 常数
-    doc_scores = {}
-    
-    # 合并所有文档 ID
-    all_docs = {}
-    
-    for rank, doc in enumerate(vector_results):
-        doc_id = doc.get("metadata", {}).get("doc_id", "") + "_" + str(doc.get("metadata", {}).get("chunk_index", 0))
-        all_docs[doc_id] = doc
-        score = vector_weight * (1.0 / (k + rank + 1))
-        doc_scores[doc_id] = doc_scores.get(doc_id, 0) + score
-    
-    for rank, doc in enumerate(bm25_results):
-        doc_id = doc.get("metadata", {}).get("doc_id", "") + "_" + str(doc.get("metadata", {}).get("chunk_index", 0))
-        all_docs[doc_id] = doc
-        score = (1 - vector_weight) * (1.0 / (k + rank + 1))
-        doc_scores[doc_id] = doc_scores.get(doc_id, 0) + score
-    
-    # 按融合分数排序
-    sorted_docs = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)
-    
-    # 构建最终结果
-    results = []
-    for doc_id, score in sorted_docs[:top_k]:
-        doc = all_docs[doc_id]
-        doc["hybrid_score"] = score
-        results.append(doc)
-    
-    return results
+        融合分数最高的 top_k 个 [(chunk_id, hybrid_score), ...]
+    """
+    scores = {}
+    for rank, (chunk_id, _) in enumerate(vector_hits):
+        scores[chunk_id] = scores.get(chunk_id, 0) + vector_weight * (1.0 / (RRF_K + rank + 1))
+    for rank, (chunk_id, _) in enumerate(bm25_hits):
+        scores[chunk_id] = scores.get(chunk_id, 0) + (1 - vector_weight) * (1.0 / (RRF_K + rank + 1))
+    return heapq.nlargest(top_k, scores.items(), key=lambda x: x[1])
+
+
+# ========== 多知识库检索 ==========
+
+def _run_per_kb(leg: str, kb_ids: List[str], fn) -> Dict[str, List[Tuple]]:
+    """本地模式按知识库并发执行一路候选检索，超时或失败的知识库不出现在结果中"""
+    done = get_retrieval_executor().run({f"{leg}:{kb_id}": partial(fn, kb_id) for kb_id in kb_ids})
+    return {kb_id: done[f"{leg}:{kb_id}"] for kb_id in kb_ids if f"{leg}:{kb_id}" in done}
+
+
+def vector_candidates(kb_ids: List[str], query_embedding: Vector, n: int) -> Dict[str, List[Tuple]]:
+    """
+    本地模式向量候选 {kb_id: [(chunk_id, 距离), ...]}，只含 ID 与距离，不读取正文
+
+    各知识库并发检索，超时的知识库缺席（PostgreSQL 见 search_hybrid_pg / search_pg_multi）。
+    """
+    return _run_per_kb("vector", kb_ids,
+                       lambda kb_id: _local_vector_candidates(kb_id, query_embedding, n))
+
+
+def keyword_candidates(kb_ids: List[str], query: str, n: int) -> Dict[str, List[Tuple]]:
+    """本地模式关键词 (BM25) 候选 {kb_id: [(chunk_id, 分数), ...]}，不需要查询向量"""
+    return _run_per_kb("bm25", kb_ids, lambda kb_id: _local_keyword_candidates(kb_id, query, n))
+
+
+def fuse_candidates(vector_hits: Dict[str, List[Tuple]], keyword_hits: Dict[str, List[Tuple]],
+                    top_k: int, vector_weight: float, limit: int) -> List[Dict]:
+    """
+    按知识库分别对两路候选做 RRF 融合，再全局按融合分数取前 limit 条
+
+    某一路缺席（超时/失败）的知识库只用另一路的候选排序。
+
+    Returns:
+        候选条目（含 kb_id、chunk_id 与分数，尚未读取正文），交给 fetch_candidates
+    """
+    entries = []
+    for kb_id in dict.fromkeys(list(vector_hits) + list(keyword_hits)):
+        kb_vector_hits = vector_hits.get(kb_id, [])
+        kb_keyword_hits = keyword_hits.get(kb_id, [])
+        distances = dict(kb_vector_hits)
+        bm25_scores = dict(kb_keyword_hits)
+        for chunk_id, hybrid_score in _rrf_fuse(kb_vector_hits, kb_keyword_hits, top_k, vector_weight):
+            entry = {"kb_id": kb_id, "chunk_id": chunk_id, "hybrid_score": hybrid_score}
+            if chunk_id in distances:
+                entry["distance"] = distances[chunk_id]
+                # 将距离转换为分数（距离越小分数越高）
+                entry["score"] = 1.0 / (1.0 + distances[chunk_id])
+                entry["source"] = "vector"
+            else:
+                entry["score"] = bm25_scores[chunk_id]
+                entry["source"] = "bm25"
+            entries.append(entry)
+    entries.sort(key=lambda x: x["hybrid_score"], reverse=True)
+    return entries[:limit]
 
 
 def delete_document_vectors(kb_id: str, doc_id: str):
     """删除文档的向量"""
+    try:
+        if USE_POSTGRES:
+            delete_doc_from_pg(kb_id, doc_id)
+        elif USE_NUMPY_STORE:
+            delete_doc_from_local(kb_id, doc_id)
+        else:
+            delete_doc_from_chroma(kb_id, doc_id)
+    finally:
+        _bump_generation(kb_id)
+
+
+def get_document_chunk_indexes(kb_id: str, doc_id: str) -> Optional[Dict[str, Optional[int]]]:
+    """
+    文档已入库的块 {content_hash: chunk_index}
+
+    Returns:
+        按 content_hash 索引的块序号；文档中存在没有 content_hash 的块（旧版本入库）时返回 None，
+        此时无法判断哪些块未变化，调用方应整篇重新入库
+    """
     if USE_POSTGRES:
-        delete_doc_from_pg(kb_id, doc_id)
+        chunks = get_chunk_indexes_pg(kb_id, doc_id)
+    elif USE_NUMPY_STORE:
+        chunks = get_chunk_indexes_local(kb_id, doc_id)
     else:
-        delete_doc_from_chroma(kb_id, doc_id)
+        chunks = get_chunk_indexes_chroma(kb_id, doc_id)
+    if any(h is None for h, _ in chunks):
+        return None
+    return dict(chunks)
+
+
+# 每次删除/更新的块数（SQLite 单条语句的参数个数有上限）
+_DELETE_BATCH = 500
+
+
+def delete_document_chunks(kb_id: str, doc_id: str, chunk_hashes: Iterable[str]):
+    """按 content_hash 删除文档的部分块"""
+    chunk_hashes = list(chunk_hashes)
+    if not chunk_hashes:
+        return
+    try:
+        for start in range(0, len(chunk_hashes), _DELETE_BATCH):
+            batch = chunk_hashes[start:start + _DELETE_BATCH]
+            if USE_POSTGRES:
+                delete_chunks_from_pg(kb_id, doc_id, batch)
+            elif USE_NUMPY_STORE:
+                delete_chunks_from_local(kb_id, [_hash_chunk_id(doc_id, h) for h in batch])
+            else:
+                delete_chunks_from_chroma(kb_id, [_hash_chunk_id(doc_id, h) for h in batch])
+    finally:
+        _bump_generation(kb_id)
+
+
+def update_document_chunk_indexes(kb_id: str, doc_id: str, chunk_indexes: Dict[str, int]):
+    """
+    更新未变化的块在新版本中的序号 {content_hash: chunk_index}
+
+    增量更新复用原向量的块保留了旧的 chunk_index，前面插入或删除内容后需要改为新序号。
+    """
+    if not chunk_indexes:
+        return
+    items = list(chunk_indexes.items())
+    try:
+        for start in range(0, len(items), _DELETE_BATCH):
+            batch = dict(items[start:start + _DELETE_BATCH])
+            if USE_POSTGRES:
+                update_chunk_indexes_pg(kb_id, doc_id, batch)
+            elif USE_NUMPY_STORE:
+                get_vector_store(kb_id).update_chunk_indexes(
+                    {_hash_chunk_id(doc_id, h): index for h, index in batch.items()})
+            else:
+                update_chunk_indexes_chroma(kb_id, {_hash_chunk_id(doc_id, h): index for h, index in batch.items()})
+    finally:
+        _bump_generation(kb_id)
 
 
 def delete_knowledge_base_vectors(kb_id: str):
     """删除整个知识库的向量"""
-    if USE_POSTGRES:
-        import psycopg2
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute('DELETE FROM document_chunks WHERE kb_id = %s', (kb_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
-    else:
-        # 删除 ChromaDB 集合
-        client = get_chroma_client()
-        if client:
-            try:
-                client.delete_collection(name=f"kb_{kb_id}")
-            except:
-                pass
+    try:
+        if USE_POSTGRES:
+            with timed_db("delete", "document_chunks", kb_id=kb_id) as conn:
+                cur = conn.cursor()
+                cur.execute('DELETE FROM document_chunks WHERE kb_id = %s', (kb_id,))
+                conn.commit()
+                cur.close()
+        elif USE_NUMPY_STORE:
+            drop_vector_store(kb_id)
+            _keyword_index(kb_id).drop()
+        else:
+            # 删除 ChromaDB 集合
+            client = get_chroma_client()
+            if client:
+                try:
+                    client.delete_collection(name=f"kb_{kb_id}")
+                except:
+                    pass
+            _keyword_index(kb_id).drop()
+    finally:
+        # 版本号行保留（不重置为 0），旧版本号下的缓存永远不会再被命中
+        _bump_generation(kb_id)
@@ -1,29 +1,108 @@
 """
 检索模块 - 整合知识库和历史会话检索
 """
+import copy
 import os
-from typing import List, Dict, Optional
+import threading
+from array import array
+from functools import partial
+from typing import List, Dict, Optional, Tuple
 
 # 加载环境变量
 from dotenv import load_dotenv
 load_dotenv()
 
-from embedding import get_embedding
-from knowledge_base import search_knowledge_base, search_knowledge_base_hybrid
-from database import get_session_messages, USE_POSTGRES
+from config import (
+    QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL,
+    RAG_RESULT_CACHE_SIZE, RAG_RESULT_CACHE_TTL, RAG_CONTEXT_TOKENS
+)
+from embedding import get_query_embedding, get_embedding_backend
+from embedding_cache import LRUCache, normalize_text, text_hash
+from knowledge_base import (
+    HYBRID_CANDIDATES, vector_candidates, keyword_candidates, fuse_candidates, fetch_candidates,
+    search_hybrid_pg, search_pg_multi, search_keyword_pg
+)
+from retrieval_executor import get_retrieval_executor, RetrievalBudget
+from text_splitter import count_tokens, truncate_tokens
+from database import get_session_messages, get_kb_generations, USE_POSTGRES
+from vectors import Vector, to_format
+
+# 查询向量缓存：同一条用户消息会先后被 /api/rag/search 和 /api/chat 检索
+_query_embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE, ttl=QUERY_EMBEDDING_CACHE_TTL)
+
+# 预算模式下为向量/BM25 分路完成后的融合与读取正文预留的时间（毫秒）
+FETCH_RESERVE_MS = 50
+
+# 检索结果缓存：键中带各知识库的版本号，文档增删后旧条目不会再被命中（TTL 只是兜底）
+_result_cache = LRUCache(RAG_RESULT_CACHE_SIZE, ttl=RAG_RESULT_CACHE_TTL)
+
+
+def embed_query(query: str) -> Vector:
+    """获取查询向量（优先读取带 TTL 的查询向量缓存）"""
+    key = (get_embedding_backend().model, normalize_text(query))
+    cached = _query_embedding_cache.get(key)
+    if cached is not None:
+        return to_format(cached)
+    
+    query_embedding = get_query_embedding(query)
+    if query_embedding:
+        # 缓存中保存 float32 副本，返回给调用方的向量可被自由修改
+        _query_embedding_cache.put(key, array("f", query_embedding))
+    return query_embedding
+
+
+def get_query_embedding_cache_stats() -> Dict:
+    """查询向量缓存命中统计"""
+    return _query_embedding_cache.get_stats()
+
+
+def get_rag_result_cache_stats() -> Dict:
+    """检索结果缓存命中统计"""
+    return _result_cache.get_stats()
+
+
+def _result_cache_key(kb_ids: List[str], query: str, top_k: int, use_hybrid: bool,
+                      vector_weight: float, text_limit: Optional[int]):
+    """
+    检索结果缓存键
+
+    版本号必须在检索开始前读取：检索期间发生的写入会递增版本号，
+    本次结果只会落在旧版本号下，不会被之后的请求读到。
+    读取版本号失败时返回 None（本次不使用缓存）。
+    """
+    if RAG_RESULT_CACHE_SIZE <= 0:
+        return None
+    try:
+        generations = get_kb_generations(kb_ids)
+    except Exception as e:
+        print(f"[检索缓存] 读取知识库版本号失败: {e}")
+        return None
+    return (
+        get_embedding_backend().model,
+        tuple((kb_id, generations[kb_id]) for kb_id in kb_ids),
+        text_hash(query),
+        top_k,
+        use_hybrid,
+        vector_weight if use_hybrid else None,
+        text_limit,
+    )
 
 
 def search_knowledge_bases(kb_ids: List[str], query: str, top_k: int = 5, 
-                            use_hybrid: bool = True, vector_weight: float = 0.5) -> List[Dict]:
+                            use_hybrid: bool = True, vector_weight: float = 0.5,
+                            text_limit: Optional[int] = None,
+                            budget: Optional[RetrievalBudget] = None) -> List[Dict]:
     """
     在多个知识库中检索相关内容
     
     Args:
         kb_ids: 知识库 ID 列表
         query: 查询文本
-        top_k: 每个知识库返回的最大结果数
+        top_k: 每个知识库返回的最大结果数（全局最多返回 top_k * len(kb_ids) 条）
         use_hybrid: 是否使用混合召回（向量+BM25），默认 True
         vector_weight: 向量检索权重 (0-1)，默认 0.5
+        text_limit: 正文只取前多少个字符（只对最终结果读取正文），None 表示完整正文
+        budget: 请求级时间预算，预算耗尽时放弃未完成的分路，用已就绪的候选融合
     
     Returns:
         检索结果列表，按相关性排序
@@ -31,38 +110,114 @@ def search_knowledge_bases(kb_ids: List[str], query: str, top_k: int = 5,
     if not kb_ids:
         return []
     
-    # 获取查询向量
-    query_embedding = get_embedding(query)
+    # 知识库内容未变更时直接返回缓存结果（副本，调用方可自由修改）
+    cache_key = _result_cache_key(kb_ids, query, top_k, use_hybrid, vector_weight, text_limit)
+    if cache_key is not None:
+        cached = _result_cache.get(cache_key)
+        if cached is not None:
+            return copy.deepcopy(cached)
+    
+    if USE_POSTGRES:
+        all_results, complete = _search_pg(kb_ids, query, top_k, use_hybrid, vector_weight, text_limit, budget)
+    else:
+        all_results, complete = _search_local(kb_ids, query, top_k, use_hybrid, vector_weight, text_limit, budget)
+    if use_hybrid:
+        print(f"[混合召回] 知识库 {kb_ids}: 返回 {len(all_results)} 条结果")
+    
+    for r in all_results:
+        r["source"] = "knowledge_base"
+    # 有分路超时或失败时结果不完整，不写入缓存
+    if cache_key is not None and complete:
+        _result_cache.put(cache_key, copy.deepcopy(all_results))
+    return all_results
+
+
+def _embed_query_leg(query: str):
+    # 获取查询向量（先查缓存，未命中时与并发请求的查询合并为一次嵌入调用）
+    query_embedding = embed_query(query)
     if not query_embedding:
-        return []
+        raise ValueError("查询向量为空")
+    return query_embedding
+
+
+def _search_pg(kb_ids: List[str], query: str, top_k: int, use_hybrid: bool, vector_weight: float,
+               text_limit: Optional[int], budget: Optional[RetrievalBudget]) -> Tuple[List[Dict], bool]:
+    """
+    PostgreSQL 检索：嵌入完成后用一条 SQL 完成候选、融合与读取正文
+
+    嵌入一路超时或失败时，混合召回退化为一条纯关键词 SQL（结果不完整，不写入缓存）。
+
+    Returns:
+        (结果列表, 是否完整)
+    """
+    executor = get_retrieval_executor()
+    limit = top_k * len(kb_ids)
+    done = executor.run({"embedding": partial(_embed_query_leg, query)},
+                        budget=budget, reserve_ms=FETCH_RESERVE_MS)
+    query_embedding = done.get("embedding")
+    if query_embedding:
+        if use_hybrid:
+            search = partial(search_hybrid_pg, kb_ids, query, query_embedding, top_k,
+                             vector_weight, limit, text_limit)
+        else:
+            search = partial(search_pg_multi, kb_ids, query_embedding, top_k, limit, text_limit)
+        leg = "vector"
+    elif use_hybrid:
+        search = partial(search_keyword_pg, kb_ids, query, top_k, vector_weight, limit, text_limit)
+        leg = "bm25"
+    else:
+        return [], False
+    done = executor.run({leg: search}, budget=budget)
+    if leg not in done:
+        print(f"[检索错误] 知识库 {kb_ids}: {leg} 查询未完成")
+        return [], False
+    return done[leg], leg == "vector"
+
+
+def _search_local(kb_ids: List[str], query: str, top_k: int, use_hybrid: bool, vector_weight: float,
+                  text_limit: Optional[int], budget: Optional[RetrievalBudget]) -> Tuple[List[Dict], bool]:
+    """
+    本地模式检索：向量路与 BM25 路并发取候选，融合截断后才读取胜出块的正文
+
+    Returns:
+        (结果列表, 是否完整)
+    """
+    embedded = threading.Event()
     
-    all_results = []
-    for kb_id in kb_ids:
-        try:
-            if use_hybrid:
-                # 混合召回：向量 + BM25
-                results = search_knowledge_base_hybrid(kb_id, query, query_embedding, 
-                                                        top_k=top_k, vector_weight=vector_weight)
-                print(f"[混合召回] 知识库 {kb_id}: 返回 {len(results)} 条结果")
-            else:
-                # 纯向量召回
-                results = search_knowledge_base(kb_id, query_embedding, top_k)
-            
-            for r in results:
-                r["kb_id"] = kb_id
-                r["source"] = "knowledge_base"
-            all_results.extend(results)
-        except Exception as e:
-            print(f"[检索错误] 知识库 {kb_id}: {e}")
+    def vector_leg():
+        query_embedding = _embed_query_leg(query)
+        embedded.set()
+        return vector_candidates(kb_ids, query_embedding, HYBRID_CANDIDATES if use_hybrid else top_k)
     
+    # 向量路（嵌入 + 向量候选）与 BM25 路（无需查询向量）并发执行，各自超时；
+    # 两路都只产生 (块 ID, 分数) 候选，融合截断后才读取胜出块的正文
+    legs = {"vector": vector_leg}
     if use_hybrid:
-        # 混合召回已按融合分数排序，只需取 Top-K
-        all_results.sort(key=lambda x: x.get("hybrid_score", 0), reverse=True)
-    else:
-        # 纯向量召回按距离排序
-        all_results.sort(key=lambda x: x.get("distance", float('inf')))
+        legs["bm25"] = partial(keyword_candidates, kb_ids, query, HYBRID_CANDIDATES)
+    done = get_retrieval_executor().run(legs, budget=budget, reserve_ms=FETCH_RESERVE_MS)
+    vector_hits = done.get("vector", {})
+    keyword_hits = done.get("bm25", {})
+    if budget is not None and "vector" in budget.exhausted and not embedded.is_set():
+        # 区分预算耗在嵌入接口还是向量检索上
+        budget.exhausted[budget.exhausted.index("vector")] = "embedding"
     
-    return all_results[:top_k * len(kb_ids)]
+    limit = top_k * len(kb_ids)
+    try:
+        if use_hybrid:
+            # 混合召回：向量 + BM25，按知识库做 RRF 融合
+            entries = fuse_candidates(vector_hits, keyword_hits, top_k, vector_weight, limit)
+        else:
+            # 纯向量召回
+            entries = [{"kb_id": kb_id, "chunk_id": chunk_id, "distance": distance}
+                       for kb_id, hits in vector_hits.items() for chunk_id, distance in hits]
+            entries.sort(key=lambda x: x["distance"])
+            entries = entries[:limit]
+        all_results = fetch_candidates(entries, text_limit)
+    except Exception as e:
+        print(f"[检索错误] 知识库 {kb_ids}: {e}")
+        return [], False
+    complete = set(vector_hits) == set(kb_ids) and (not use_hybrid or set(keyword_hits) == set(kb_ids))
+    return all_results, complete
 
 
 def search_history_sessions(user_id: str, query: str, top_k: int = 3) -> List[Dict]:
@@ -117,6 +272,61 @@ def search_history_sessions(user_id: str, query: str, top_k: int = 3) -> List[Di
     return matches[:top_k]
 
 
+def search_rag_sources(query: str, kb_ids: Optional[List[str]] = None, user_id: Optional[str] = None,
+                       kb_top_k: int = 5, history_top_k: int = 3,
+                       text_limit: Optional[int] = None,
+                       budget: Optional[RetrievalBudget] = None):
+    """
+    并发检索知识库与历史会话（两路各自超时，超时的一路返回空列表）
+    
+    Args:
+        budget: 请求级时间预算（如聊天接口），到期后直接返回已就绪的结果
+    
+    Returns:
+        (知识库结果, 历史会话结果)
+    """
+    legs = {}
+    if kb_ids:
+        legs["knowledge_base"] = partial(search_knowledge_bases, kb_ids, query, kb_top_k,
+                                         text_limit=text_limit, budget=budget)
+    if user_id:
+        legs["history"] = partial(search_history_sessions, user_id, query, history_top_k)
+    executor = get_retrieval_executor()
+    # 知识库一路内部的向量/BM25 子分路各自超时，外层再留出融合与读取正文的时间
+    done = executor.run(legs, timeouts={"knowledge_base": executor.leg_timeout_ms * 2}, budget=budget)
+    return done.get("knowledge_base", []), done.get("history", [])
+
+
+# 预算剩余不足该 token 数时不再放入截断的片段
+MIN_SNIPPET_TOKENS = 50
+
+
+def fit_kb_context(kb_results: List[Dict], max_tokens: int = RAG_CONTEXT_TOKENS) -> List[Tuple[Dict, str, int]]:
+    """
+    按 token 预算选取知识库片段（按检索排名依次放入）
+
+    块的 token 数取自入库时记录的 metadata.token_count（旧版本入库的块现场计算）；
+    剩余预算放不下整块时截断该块后停止。
+
+    Returns:
+        [(检索结果, 放入上下文的正文, token 数), ...]
+    """
+    selected = []
+    remaining = max_tokens
+    for r in kb_results:
+        text = r["text"]
+        tokens = (r.get("metadata") or {}).get("token_count")
+        if tokens is None:
+            tokens = count_tokens(text)
+        if tokens > remaining:
+            if remaining >= MIN_SNIPPET_TOKENS:
+                selected.append((r, truncate_tokens(text, remaining), remaining))
+            break
+        selected.append((r, text, tokens))
+        remaining -= tokens
+    return selected
+
+
 def build_rag_context(
     query: str,
     kb_ids: Optional[List[str]] = None,
@@ -141,29 +351,27 @@ def build_rag_context(
         "query": query,
         "knowledge_base_results": [],
         "history_results": [],
-        "context_text": ""
+        "context_text": "",
+        "context_tokens": 0  # 知识库片段的 token 数
     }
     
-    # 知识库检索
-    if kb_ids:
-        kb_results = search_knowledge_bases(kb_ids, query, kb_top_k)
-        context["knowledge_base_results"] = kb_results
-    
-    # 历史会话检索
-    if user_id:
-        history_results = search_history_sessions(user_id, query, history_top_k)
-        context["history_results"] = history_results
+    # 知识库与历史会话并发检索
+    kb_results, history_results = search_rag_sources(query, kb_ids, user_id, kb_top_k, history_top_k)
+    context["knowledge_base_results"] = kb_results
+    context["history_results"] = history_results
     
     # 构建上下文文本
     context_parts = []
     
     if context["knowledge_base_results"]:
         context_parts.append("以下是与用户问题相关的知识库内容：")
-        for i, r in enumerate(context["knowledge_base_results"], 1):
+        # 按 token 预算放入片段
+        for i, (r, text, tokens) in enumerate(fit_kb_context(context["knowledge_base_results"]), 1):
             source = r.get("metadata", {}).get("filename", "未知来源")
             context_parts.append(f"[{i}] 来源：{source}")
-            context_parts.append(f"内容：{r['text'][:500]}...")  # 限制长度
+            context_parts.append(f"内容：{text}" + ("..." if text is not r["text"] else ""))
             context_parts.append("")
+            context["context_tokens"] += tokens
     
     if context["history_results"]:
         context_parts.append("以下是用户的历史相关对话：")
@@ -0,0 +1,162 @@
+"""
+检索执行器 - 在有界线程池上并发执行检索分路
+向量 / 关键词 / 各知识库 / 历史会话各为一路，每路独立超时，
+超时或失败的分路被丢弃，调用方融合已完成的结果（总耗时约等于最慢的一路）
+
+分路内部可以再次扇出（如知识库一路内部的向量/BM25 子分路）。所有分路都提交到线程池、
+调用方只做有超时的等待，因此线程池被占满时只会导致排队的分路超时，不会死锁。
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Optional
+
+from config import RAG_MAX_WORKERS, RAG_LEG_TIMEOUT_MS
+from logger import log_info, log_warning
+
+
+class RetrievalBudget:
+    """
+    一次请求的检索时间预算
+
+    所有阶段（含嵌套子分路）共享同一截止时间；预算耗尽时放弃仍未完成的阶段，
+    调用方带着已就绪的结果继续，并记录是哪些阶段被放弃。
+    """
+
+    def __init__(self, budget_ms: float):
+        self.budget_ms = budget_ms
+        self.start = time.monotonic()
+        self.deadline = self.start + budget_ms / 1000.0
+        self.exhausted = []  # 因预算耗尽被放弃的阶段
+
+    def remaining_ms(self, reserve_ms: float = 0.0) -> float:
+        """剩余预算（毫秒），reserve_ms 为留给后续步骤的时间"""
+        return max(0.0, (self.deadline - time.monotonic()) * 1000.0 - reserve_ms)
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self.start) * 1000.0
+
+
+_budget_lock = threading.Lock()
+_budget_stats = {"requests": 0, "exhausted": 0, "stages": {}}
+
+
+def record_budget(budget: RetrievalBudget, **kwargs):
+    """请求结束时汇总预算使用情况：累计按阶段的预算耗尽次数并写日志（预算耗尽时记 WARNING）"""
+    stages = sorted(set(budget.exhausted))
+    with _budget_lock:
+        _budget_stats["requests"] += 1
+        if stages:
+            _budget_stats["exhausted"] += 1
+        for stage in stages:
+            _budget_stats["stages"][stage] = _budget_stats["stages"].get(stage, 0) + 1
+    log = log_warning if stages else log_info
+    log(
+        f"[RAG] 检索耗时 {budget.elapsed_ms():.0f}ms / 预算 {budget.budget_ms:.0f}ms"
+        + (f"，预算耗尽放弃: {', '.join(stages)}" if stages else ""),
+        type="rag_budget",
+        budget_ms=budget.budget_ms,
+        elapsed_ms=round(budget.elapsed_ms(), 1),
+        exhausted_stages=stages,
+        **kwargs
+    )
+
+
+def get_rag_budget_stats() -> Dict:
+    """检索预算统计：请求数、预算耗尽的请求数与各阶段被放弃的次数"""
+    with _budget_lock:
+        requests = _budget_stats["requests"]
+        return {
+            "requests": requests,
+            "exhausted": _budget_stats["exhausted"],
+            "exhausted_rate": round(_budget_stats["exhausted"] / requests, 4) if requests else 0.0,
+            "stages": dict(_budget_stats["stages"]),
+        }
+
+
+class RetrievalExecutor:
+    """有界线程池 + 分路超时，带按分路类型的完成/超时/失败统计"""
+
+    def __init__(self, max_workers: int = RAG_MAX_WORKERS, leg_timeout_ms: float = RAG_LEG_TIMEOUT_MS):
+        self.max_workers = max(1, max_workers)
+        self.leg_timeout_ms = leg_timeout_ms
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="retrieval")
+        self._lock = threading.Lock()
+        self._stats = {}  # 分路类型 -> {"ok", "timeout", "error"}
+
+    def _record(self, name: str, outcome: str):
+        kind = name.split(":", 1)[0]  # "bm25:<kb_id>" 按 "bm25" 统计
+        with self._lock:
+            counts = self._stats.setdefault(kind, {"ok": 0, "timeout": 0, "error": 0})
+            counts[outcome] += 1
+
+    def run(self, legs: Dict[str, Callable], timeout_ms: Optional[float] = None,
+            timeouts: Optional[Dict[str, float]] = None,
+            budget: Optional[RetrievalBudget] = None, reserve_ms: float = 0.0) -> Dict:
+        """
+        并发执行各分路
+
+        Args:
+            legs: {分路名: 无参可调用对象}，分路名形如 "vector" 或 "bm25:<kb_id>"
+            timeout_ms: 每路超时（毫秒，从调用时刻算起），默认 RAG_LEG_TIMEOUT_MS
+            timeouts: 个别分路的超时覆盖 {分路名: 毫秒}
+            budget: 请求级时间预算，每路超时不超过剩余预算；因预算耗尽而放弃的分路记入 budget
+            reserve_ms: 从剩余预算中为分路完成后的步骤（融合、读取正文）预留的时间
+
+        Returns:
+            {分路名: 结果}；超时或抛出异常的分路不出现在结果中
+        """
+        if not legs:
+            return {}
+        start = time.monotonic()
+        default_ms = self.leg_timeout_ms if timeout_ms is None else timeout_ms
+        timeouts = timeouts or {}
+
+        budget_ms = budget.remaining_ms(reserve_ms) if budget is not None else None
+
+        futures = [(name, self._pool.submit(fn)) for name, fn in legs.items()]
+
+        results = {}
+        for name, future in futures:
+            leg_ms = timeouts.get(name, default_ms)
+            limited_by_budget = budget_ms is not None and budget_ms < leg_ms
+            if limited_by_budget:
+                leg_ms = budget_ms
+            remaining = start + leg_ms / 1000.0 - time.monotonic()
+            try:
+                results[name] = future.result(timeout=max(0.0, remaining))
+                self._record(name, "ok")
+            except FutureTimeoutError:
+                # 尚未开始的分路直接取消；已在执行的无法中断，其结果被丢弃
+                future.cancel()
+                print(f"[检索执行器] 分路 {name} 超时（{leg_ms:.0f}ms）")
+                self._record(name, "timeout")
+                if limited_by_budget:
+                    budget.exhausted.append(name.split(":", 1)[0])
+            except Exception as e:
+                print(f"[检索执行器] 分路 {name} 失败: {e}")
+                self._record(name, "error")
+        return results
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            legs = {kind: dict(counts) for kind, counts in self._stats.items()}
+        return {
+            "max_workers": self.max_workers,
+            "leg_timeout_ms": self.leg_timeout_ms,
+            "queued": self._pool._work_queue.qsize(),
+            "legs": legs,
+        }
+
+
+_executor = RetrievalExecutor()
+
+
+def get_retrieval_executor() -> RetrievalExecutor:
+    """进程内共享的检索执行器"""
+    return _executor
+
+
+def get_retrieval_executor_stats() -> Dict:
+    """检索执行器统计"""
+    return _executor.get_stats()
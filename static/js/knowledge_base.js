@@ -160,7 +160,7 @@ class KnowledgeBaseManager {
         }
     }
 
-    // 上传文档
+    // 上传文档（服务端立即返回入库任务，解析/嵌入在后台进行）
     async uploadDocument(kbId, file) {
         try {
             const formData = new FormData();
@@ -186,6 +186,22 @@ class KnowledgeBaseManager {
         }
     }
 
+    // 轮询入库任务直到完成，onProgress 接收每次的任务状态
+    async waitForIngestion(jobId, onProgress, intervalMs = 1000) {
+        while (true) {
+            const resp = await fetch(`/api/ingestion-jobs/${jobId}`);
+            if (!resp.ok) {
+                const err = await resp.json().catch(() => ({}));
+                throw new Error(err.error || 'Failed to load ingestion job');
+            }
+            const job = await resp.json();
+            if (onProgress) onProgress(job);
+            if (job.status === 'done') return job;
+            if (job.status === 'failed') throw new Error(job.error || '文档处理失败');
+            await new Promise(resolve => setTimeout(resolve, intervalMs));
+        }
+    }
+
     // 获取文档列表
     async loadDocuments(kbId) {
         try {
@@ -359,7 +375,18 @@ class KnowledgeBaseManager {
                         btn.textContent = '上传中...';
                     }
                     try {
-                        await this.uploadDocument(kbId, file);
+                        const job = await this.uploadDocument(kbId, file);
+                        if (btn) btn.textContent = '处理中...';
+                        try {
+                            await this.waitForIngestion(job.job_id, (status) => {
+                                if (btn && status.chunks_total) {
+                                    btn.textContent = `处理中 ${status.chunks_stored}/${status.chunks_total}`;
+                                }
+                            });
+                        } catch (err) {
+                            alert('文档处理失败: ' + err.message);
+                            throw err;
+                        }
                         alert('文档上传成功！');
                         // 刷新文档列表
                         await this.loadAndShowDocuments(kbId);
@@ -0,0 +1,30 @@
+"""
+测试环境：在导入应用模块之前把数据库、向量存储和暂存目录指向临时目录
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp = tempfile.mkdtemp(prefix="brainstorm-test-")
+os.environ.pop("DATABASE_URL", None)
+os.environ["DB_PATH"] = os.path.join(_tmp, "brainstorm.db")
+os.environ["LOCAL_VECTOR_STORE"] = "numpy"
+os.environ["LOCAL_VECTOR_STORE_PATH"] = os.path.join(_tmp, "vector_store")
+os.environ["CHROMA_DB_PATH"] = os.path.join(_tmp, "chroma")
+os.environ["EMBEDDING_BACKEND"] = "local"
+os.environ["INGESTION_SPOOL_DIR"] = os.path.join(_tmp, "spool")
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def db():
+    """初始化临时 SQLite 数据库（整个测试会话共用）"""
+    import database
+    database.init_db()
+    # SQLite 模式下知识库与文档表在首次创建知识库时建立
+    database.create_knowledge_base("user_test", "测试知识库")
+    return database
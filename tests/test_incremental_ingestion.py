@@ -0,0 +1,97 @@
+"""增量重新入库：按块 content_hash 复用未变化的块、重新编号并删除已不存在的块"""
+import uuid
+
+import pytest
+
+import ingestion
+import knowledge_base
+from knowledge_base import content_hash, iter_document_chunks, get_document_chunk_indexes
+
+A, B, C, X = "甲段落：需求分析", "乙段落：方案设计", "丙段落：测试计划", "新段落：上线回顾"
+
+
+@pytest.fixture(autouse=True)
+def paragraph_chunks(monkeypatch):
+    """每个段落一块，便于精确控制块内容"""
+    def iter_chunks(segments):
+        for paragraph in "".join(segments).split("\n\n"):
+            if paragraph:
+                yield paragraph, len(paragraph)
+
+    monkeypatch.setattr(knowledge_base, "iter_chunks", iter_chunks)
+
+
+@pytest.fixture
+def embedded(monkeypatch):
+    """记录每次入库实际嵌入的文本"""
+    texts = []
+    original = ingestion.get_embeddings_batched
+
+    def counting(batch):
+        texts.extend(batch)
+        return original(batch)
+
+    monkeypatch.setattr(ingestion, "get_embeddings_batched", counting)
+    return texts
+
+
+def ingest(db, tmp_path, kb_id, paragraphs):
+    job_id = uuid.uuid4().hex
+    file_path = tmp_path / f"{job_id}.txt"
+    file_path.write_text("\n\n".join(paragraphs), encoding="utf-8")
+    db.create_ingestion_job(job_id, kb_id, f"doc_{uuid.uuid4().hex[:8]}", "plan.txt", "text/plain", str(file_path))
+    ingestion.run_job(job_id)
+    return db.get_ingestion_job(job_id)
+
+
+def test_repeated_chunks_get_occurrence_suffix(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text("\n\n".join([A, B, A, A]), encoding="utf-8")
+    chunks = list(iter_document_chunks(str(path), "doc.txt", "text/plain"))
+    assert [c["metadata"]["content_hash"] for c in chunks] == [
+        content_hash(A), content_hash(B), f"{content_hash(A)}:1", f"{content_hash(A)}:2"]
+    assert [c["metadata"]["chunk_index"] for c in chunks] == [0, 1, 2, 3]
+    assert knowledge_base._chunk_id("doc_1", chunks[2], 2) == f"doc_1_{content_hash(A)[:16]}_1"
+
+
+def test_reupload_reuses_unchanged_chunks_and_renumbers(db, tmp_path, embedded):
+    kb_id = f"kb_{uuid.uuid4().hex[:8]}"
+    first = ingest(db, tmp_path, kb_id, [A, B, C])
+    assert first["status"] == "done"
+    assert embedded == [A, B, C]
+
+    embedded.clear()
+    second = ingest(db, tmp_path, kb_id, [X, A, C, A])
+    assert second["status"] == "done", second["error"]
+    assert second["doc_id"] == first["doc_id"]
+    assert embedded == [X, A]  # 第二次出现的 A 是新块（A:1）
+    assert get_document_chunk_indexes(kb_id, first["doc_id"]) == {
+        content_hash(X): 0, content_hash(A): 1, content_hash(C): 2, f"{content_hash(A)}:1": 3}
+    document = db.get_document_by_filename(kb_id, "plan.txt")
+    assert (document["id"], document["chunk_count"]) == (first["doc_id"], 4)
+
+
+def test_identical_file_is_not_reprocessed(db, tmp_path, embedded):
+    kb_id = f"kb_{uuid.uuid4().hex[:8]}"
+    first = ingest(db, tmp_path, kb_id, [A, B])
+    embedded.clear()
+    second = ingest(db, tmp_path, kb_id, [A, B])
+    assert second["status"] == "done"
+    assert second["doc_id"] == first["doc_id"]
+    assert embedded == []
+    assert second["chunks_stored"] == 2
+
+
+def test_failed_reupload_keeps_previous_version(db, tmp_path, monkeypatch):
+    kb_id = f"kb_{uuid.uuid4().hex[:8]}"
+    first = ingest(db, tmp_path, kb_id, [A, B, C])
+    before = get_document_chunk_indexes(kb_id, first["doc_id"])
+
+    def broken(batch):
+        raise RuntimeError("embedding down")
+
+    monkeypatch.setattr(ingestion, "get_embeddings_batched", broken)
+    failed = ingest(db, tmp_path, kb_id, [X, A])
+    assert failed["status"] == "failed"
+    assert get_document_chunk_indexes(kb_id, first["doc_id"]) == before
+    assert db.get_document_by_filename(kb_id, "plan.txt")["chunk_count"] == 3
@@ -0,0 +1,149 @@
+"""文档入库任务：状态流转（queued → processing → done / failed）、同名文档互斥与重启恢复"""
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+import pytest
+
+import ingestion
+
+
+def wait_for(db, job_id, statuses=("done", "failed"), timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = db.get_ingestion_job(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"任务 {job_id} 未结束: {db.get_ingestion_job(job_id)}")
+
+
+def new_job(db, tmp_path, kb_id=None, filename="notes.txt", text="头脑风暴记录\n" * 20, create_file=True):
+    job_id = uuid.uuid4().hex
+    file_path = tmp_path / f"{job_id}.txt"
+    if create_file:
+        file_path.write_text(text, encoding="utf-8")
+    kb_id = kb_id or f"kb_{uuid.uuid4().hex[:8]}"
+    db.create_ingestion_job(job_id, kb_id, f"doc_{uuid.uuid4().hex[:8]}", filename, "text/plain", str(file_path))
+    return job_id
+
+
+def set_updated_at(db, job_id, seconds_ago):
+    with db.get_db() as conn:
+        conn.execute("UPDATE ingestion_jobs SET updated_at = ? WHERE id = ?",
+                     (db.get_beijing_time() - timedelta(seconds=seconds_ago), job_id))
+        conn.commit()
+
+
+def test_claim_states(db, tmp_path):
+    first = new_job(db, tmp_path, kb_id="kb_claim")
+    second = new_job(db, tmp_path, kb_id="kb_claim")
+    assert db.claim_ingestion_job(first) == "claimed"
+    assert db.claim_ingestion_job(first) == "taken"
+    # 同一知识库的同名文档已有任务在执行
+    assert db.claim_ingestion_job(second) == "busy"
+    assert db.get_ingestion_job(second)["status"] == "queued"
+    db.update_ingestion_job(first, status="done")
+    assert db.claim_ingestion_job(second) == "claimed"
+    db.update_ingestion_job(second, status="done")
+    assert db.claim_ingestion_job("missing") == "taken"
+
+
+def test_only_stale_jobs_are_requeued(db, tmp_path):
+    stale = new_job(db, tmp_path)
+    fresh = new_job(db, tmp_path)
+    for job_id in (stale, fresh):
+        db.claim_ingestion_job(job_id)
+    set_updated_at(db, stale, 600)
+    db.update_ingestion_job(stale, chunks_embedded=5, chunks_stored=5)
+    set_updated_at(db, stale, 600)
+
+    assert db.requeue_stale_ingestion_jobs(120) == [stale]
+    assert db.requeue_stale_ingestion_jobs(120) == []
+    job = db.get_ingestion_job(stale)
+    assert (job["status"], job["chunks_embedded"], job["chunks_stored"]) == ("queued", 0, 0)
+    assert db.get_ingestion_job(fresh)["status"] == "processing"
+
+    # 心跳刷新 updated_at 后不会被视为超时
+    set_updated_at(db, fresh, 600)
+    db.touch_ingestion_job(fresh)
+    assert db.requeue_stale_ingestion_jobs(120) == []
+    for job_id in (stale, fresh):
+        db.update_ingestion_job(job_id, status="done")
+
+
+def test_submit_document_runs_to_done(db, tmp_path):
+    source = tmp_path / "upload.txt"
+    source.write_text("机器学习笔记\n\n" * 30, encoding="utf-8")
+    status = ingestion.submit_document("kb_submit", "upload.txt", "text/plain",
+                                       lambda path: source.replace(path))
+    assert status["status"] in ("queued", "processing", "done")
+    job = wait_for(db, status["job_id"])
+    assert job["status"] == "done", job["error"]
+    assert job["chunks_total"] == job["chunks_stored"] > 0
+    assert db.get_document_by_filename("kb_submit", "upload.txt")["chunk_count"] == job["chunks_total"]
+
+
+def test_missing_file_fails_job(db, tmp_path):
+    job_id = new_job(db, tmp_path, create_file=False)
+    ingestion.run_job(job_id)
+    job = db.get_ingestion_job(job_id)
+    assert job["status"] == "failed"
+    assert "丢失" in job["error"]
+
+
+def test_processing_error_fails_job_and_cleans_up(db, tmp_path, monkeypatch):
+    def broken(texts):
+        raise RuntimeError("embedding down")
+
+    monkeypatch.setattr(ingestion, "get_embeddings_batched", broken)
+    job_id = new_job(db, tmp_path, kb_id="kb_error")
+    ingestion.run_job(job_id)
+    job = db.get_ingestion_job(job_id)
+    assert (job["status"], job["error"]) == ("failed", "embedding down")
+    assert db.get_document_by_filename("kb_error", "notes.txt") is None
+
+
+def test_busy_job_is_retried(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(ingestion, "_BUSY_RETRY_SECONDS", 0.1)
+    holder = new_job(db, tmp_path, kb_id="kb_busy")
+    waiting = new_job(db, tmp_path, kb_id="kb_busy")
+    assert db.claim_ingestion_job(holder) == "claimed"
+    ingestion.run_job(waiting)
+    time.sleep(0.3)
+    assert db.get_ingestion_job(waiting)["status"] == "queued"
+    db.update_ingestion_job(holder, status="done")
+    assert wait_for(db, waiting)["status"] == "done"
+
+
+def test_recovery_requeues_stale_and_queued_jobs(db, tmp_path):
+    stale = new_job(db, tmp_path)
+    db.claim_ingestion_job(stale)
+    set_updated_at(db, stale, 3600)
+    live = new_job(db, tmp_path)
+    db.claim_ingestion_job(live)  # 仍有心跳（其他 worker 正在执行）
+
+    assert ingestion.recover_ingestion_jobs() >= 1
+    assert wait_for(db, stale)["status"] == "done"
+    assert db.get_ingestion_job(live)["status"] == "processing"
+    db.update_ingestion_job(live, status="done")
+
+
+def test_heartbeat_touches_until_stopped(monkeypatch):
+    touched = []
+    monkeypatch.setattr(ingestion, "INGESTION_HEARTBEAT_INTERVAL", 0.02)
+    monkeypatch.setattr(ingestion, "touch_ingestion_job", touched.append)
+    stop = threading.Event()
+    thread = threading.Thread(target=ingestion._heartbeat, args=("job_hb", stop))
+    thread.start()
+    time.sleep(0.15)
+    stop.set()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert len(touched) >= 2 and set(touched) == {"job_hb"}
+
+
+@pytest.fixture(autouse=True)
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingestion, "INGESTION_SPOOL_DIR", str(tmp_path / "spool"))
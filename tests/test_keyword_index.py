@@ -0,0 +1,93 @@
+"""本地 BM25 倒排索引：打分与增量维护"""
+import math
+from collections import Counter
+
+import pytest
+
+from keyword_index import KeywordIndex, BM25_K1, BM25_B, get_keyword_index
+from tokenizer import tokenize, query_terms
+
+DOCS = {
+    "doc_a": [("a:0", "机器学习是人工智能的一个分支"), ("a:1", "深度学习 deep learning 使用神经网络")],
+    "doc_b": [("b:0", "机器翻译与自然语言处理"), ("b:1", "Python 机器学习库 scikit-learn")],
+}
+
+
+def brute_force_bm25(chunks, query):
+    """按定义直接计算 BM25，作为索引结果的对照"""
+    tokens = {chunk_id: tokenize(text) for chunk_id, text in chunks}
+    n = len(tokens)
+    avgdl = sum(len(t) for t in tokens.values()) / n
+    scores = {}
+    for term in query_terms(query):
+        df = sum(1 for t in tokens.values() if term in t)
+        if not df:
+            continue
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for chunk_id, t in tokens.items():
+            tf = Counter(t)[term]
+            if tf:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * len(t) / avgdl)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return scores
+
+
+def build(tmp_path, docs=DOCS):
+    index = KeywordIndex(str(tmp_path / "kb.db"))
+    for doc_id, items in docs.items():
+        index.add_chunks(doc_id, items)
+    return index
+
+
+def assert_matches(index, chunks, query):
+    expected = brute_force_bm25(chunks, query)
+    results = index.search(query, top_k=10)
+    assert dict(results) == pytest.approx(expected)
+    assert [score for _, score in results] == sorted(expected.values(), reverse=True)
+
+
+def test_scores_match_bm25_definition(tmp_path):
+    index = build(tmp_path)
+    chunks = [item for items in DOCS.values() for item in items]
+    assert_matches(index, chunks, "机器学习")
+    assert_matches(index, chunks, "Deep Learning 神经网络")
+
+
+def test_search_without_matches(tmp_path):
+    index = build(tmp_path)
+    assert index.search("量子") == []
+    assert index.search("") == []
+    assert KeywordIndex(str(tmp_path / "missing.db")).search("机器") == []
+
+
+def test_add_is_idempotent(tmp_path):
+    index = build(tmp_path)
+    index.add_chunks("doc_a", DOCS["doc_a"])
+    chunks = [item for items in DOCS.values() for item in items]
+    assert_matches(index, chunks, "机器学习")
+
+
+def test_delete_document_updates_statistics(tmp_path):
+    index = build(tmp_path)
+    assert sorted(index.delete_document("doc_b")) == ["b:0", "b:1"]
+    assert index.delete_document("doc_b") == []
+    assert_matches(index, DOCS["doc_a"], "机器学习")
+
+    rebuilt = KeywordIndex(str(tmp_path / "rebuilt.db"))
+    rebuilt.rebuild([(chunk_id, "doc_a", text) for chunk_id, text in DOCS["doc_a"]])
+    assert index.search("机器学习") == pytest.approx(rebuilt.search("机器学习"))
+
+
+def test_delete_chunks(tmp_path):
+    index = build(tmp_path)
+    assert index.delete_chunks(["b:1", "missing"]) == ["b:1"]
+    remaining = DOCS["doc_a"] + DOCS["doc_b"][:1]
+    assert_matches(index, remaining, "机器学习")
+
+
+def test_rebuild_empty_index_is_persisted(tmp_path):
+    index = get_keyword_index(str(tmp_path), "kb_empty")
+    index.rebuild([])
+    assert index.exists()
+    index.drop()
+    assert not index.exists()
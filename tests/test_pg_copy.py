@@ -0,0 +1,75 @@
+"""pgvector 批量写入：COPY 二进制格式编码（tsvector / vector / 行布局）"""
+import json
+import struct
+
+from knowledge_base import _tsvector_binary, _tsvector_text, _pg_copy_rows
+from tokenizer import lexeme_positions
+from vectors import to_pgvector_binary
+
+
+def decode_tsvector(data: bytes):
+    """按 tsvector_recv 的布局解码"""
+    (count,) = struct.unpack_from(">i", data, 0)
+    offset = 4
+    lexemes = {}
+    for _ in range(count):
+        end = data.index(b"\x00", offset)
+        lexeme = data[offset:end].decode("utf-8")
+        offset = end + 1
+        (npos,) = struct.unpack_from(">H", data, offset)
+        offset += 2
+        lexemes[lexeme] = list(struct.unpack_from(">%dH" % npos, data, offset))
+        offset += 2 * npos
+    assert offset == len(data)
+    return lexemes
+
+
+def test_tsvector_binary_round_trip():
+    lexemes = lexeme_positions("机器学习 python 机器")
+    assert decode_tsvector(_tsvector_binary(lexemes)) == lexemes
+
+
+def test_tsvector_binary_empty():
+    assert _tsvector_binary({}) == struct.pack(">i", 0)
+
+
+def test_tsvector_positions_stay_within_postgres_limits():
+    lexemes = lexeme_positions("词" + " a" * 20000)
+    decoded = decode_tsvector(_tsvector_binary(lexemes))
+    for positions in decoded.values():
+        assert positions == sorted(set(positions))
+        assert max(positions) <= 16383
+        assert len(positions) <= 256
+
+
+def test_tsvector_text_literal():
+    assert _tsvector_text({"机器": [1, 3], "python": [2]}) == "'机器':1,3 'python':2"
+
+
+def test_pgvector_binary_layout():
+    data = to_pgvector_binary([1.0, -2.5])
+    assert struct.unpack(">HH2f", data) == (2, 0, 1.0, -2.5)
+
+
+def test_copy_rows_layout():
+    rows = [("kb_1", "doc_1", "机器学习", [0.5, 0.25], {"chunk_index": 0})]
+    stream = b"".join(_pg_copy_rows(rows))
+    assert stream.startswith(b"PGCOPY\n\xff\r\n\x00")
+    assert stream.endswith(struct.pack(">h", -1))
+
+    offset = 19  # 11 字节签名 + int32 标志位 + int32 扩展头长度
+    (field_count,) = struct.unpack_from(">h", stream, offset)
+    offset += 2
+    fields = []
+    for _ in range(field_count):
+        (length,) = struct.unpack_from(">i", stream, offset)
+        offset += 4
+        fields.append(stream[offset:offset + length])
+        offset += length
+    assert offset == len(stream) - 2
+
+    kb_id, doc_id, text, embedding, metadata, tsv = fields
+    assert (kb_id, doc_id, text.decode("utf-8")) == (b"kb_1", b"doc_1", "机器学习")
+    assert embedding == to_pgvector_binary([0.5, 0.25])
+    assert metadata[:1] == b"\x01" and json.loads(metadata[1:]) == {"chunk_index": 0}
+    assert decode_tsvector(tsv) == lexeme_positions("机器学习")
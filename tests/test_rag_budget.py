@@ -0,0 +1,62 @@
+"""请求级检索时间预算：分路超时不超过剩余预算，预算耗尽的阶段计入统计"""
+import threading
+import time
+
+import pytest
+
+from retrieval_executor import RetrievalExecutor, RetrievalBudget, record_budget, get_rag_budget_stats
+
+
+@pytest.fixture
+def executor():
+    executor = RetrievalExecutor(max_workers=4, leg_timeout_ms=100)
+    release = threading.Event()
+    executor.release = release
+    yield executor
+    release.set()
+    executor._pool.shutdown(wait=True)
+
+
+def slow(executor, value="slow"):
+    def leg():
+        executor.release.wait(5)
+        return value
+    return leg
+
+
+def test_budget_caps_leg_timeout_and_records_exhausted_stage(executor):
+    budget = RetrievalBudget(1000)
+    start = time.monotonic()
+    results = executor.run({"vector": lambda: 1, "bm25:kb_1": slow(executor)},
+                           timeout_ms=5000, budget=budget, reserve_ms=950)
+    assert results == {"vector": 1}
+    assert time.monotonic() - start < 1.0
+    assert budget.exhausted == ["bm25"]
+
+
+def test_leg_timeout_within_budget_is_not_charged_to_budget(executor):
+    budget = RetrievalBudget(5000)
+    executor.run({"bm25:kb_1": slow(executor)}, timeout_ms=50, budget=budget)
+    assert budget.exhausted == []
+
+
+def test_budget_remaining_and_reserve():
+    budget = RetrievalBudget(200)
+    assert 0 < budget.remaining_ms() <= 200
+    assert budget.remaining_ms(reserve_ms=500) == 0.0
+    time.sleep(0.25)
+    assert budget.remaining_ms() == 0.0
+    assert budget.elapsed_ms() >= 250
+
+
+def test_record_budget_counts_exhausted_stages():
+    before = get_rag_budget_stats()
+    budget = RetrievalBudget(100)
+    budget.exhausted += ["bm25", "bm25", "vector"]
+    record_budget(budget)
+    record_budget(RetrievalBudget(100))
+    after = get_rag_budget_stats()
+    assert after["requests"] == before["requests"] + 2
+    assert after["exhausted"] == before["exhausted"] + 1
+    assert after["stages"]["bm25"] == before["stages"].get("bm25", 0) + 1
+    assert after["stages"]["vector"] == before["stages"].get("vector", 0) + 1
@@ -0,0 +1,74 @@
+"""嵌入请求自适应限流器：成功时加性增，限流时乘性减并暂停派发"""
+import time
+
+import pytest
+
+from embedding import AdaptiveRateLimiter, _is_throttled, _retry_after
+
+
+def make_limiter(**kwargs):
+    options = {"rate": 4.0, "min_rate": 0.5, "max_rate": 5.0, "max_in_flight": 8}
+    options.update(kwargs)
+    return AdaptiveRateLimiter(**options)
+
+
+def test_initial_rate_is_clamped():
+    assert make_limiter(rate=100.0).rate == 5.0
+    assert make_limiter(rate=0.1).rate == 0.5
+    assert make_limiter(max_in_flight=0).max_in_flight == 1
+
+
+def test_success_increases_rate_additively_up_to_max():
+    limiter = make_limiter()
+    limiter.limit = 2.0
+    limiter.on_success()
+    assert limiter.rate == pytest.approx(4.0 + AdaptiveRateLimiter._RATE_STEP)
+    assert limiter.limit == pytest.approx(2.5)
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.rate == 5.0
+    assert limiter.limit == 8.0
+
+
+def test_throttle_halves_rate_and_concurrency_and_pauses():
+    limiter = make_limiter()
+    limiter.on_throttle(retry_after=2.0)
+    assert limiter.rate == 2.0
+    assert limiter.limit == 4.0
+    assert limiter._tokens == 0.0
+    assert limiter._blocked_until - time.monotonic() == pytest.approx(2.0, abs=0.1)
+
+    for _ in range(10):
+        limiter.on_throttle()
+    assert limiter.rate == 0.5
+    assert limiter.limit == 1.0
+    stats = limiter.get_stats()
+    assert stats["throttled"] == 11
+    assert stats["concurrency_limit"] == 1
+
+
+def test_pause_defaults_to_one_token_interval():
+    limiter = make_limiter(rate=4.0)
+    limiter.on_throttle()
+    # 速率减半为 2/s，暂停 1 / 2 秒
+    assert limiter._blocked_until - time.monotonic() == pytest.approx(0.5, abs=0.1)
+
+
+def test_acquire_respects_concurrency_limit():
+    limiter = make_limiter(rate=5.0, max_in_flight=2)
+    limiter._tokens = 5.0
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter.get_stats()["in_flight"] == 2
+    limiter.release()
+    limiter.acquire()
+    assert limiter.get_stats()["requests"] == 3
+
+
+def test_throttle_detection():
+    assert _is_throttled(429, {})
+    assert _is_throttled(400, {"code": "Throttling.RateQuota"})
+    assert not _is_throttled(400, {"code": "InvalidParameter"})
+    assert _retry_after({"Retry-After": "3"}) == 3.0
+    assert _retry_after({"retry-after": "soon"}) == 0.0
+    assert _retry_after({}) == 0.0
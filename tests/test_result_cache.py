@@ -0,0 +1,75 @@
+"""检索结果缓存：键中带知识库版本号，文档变更后旧结果不再命中"""
+import pytest
+
+import retrieval
+
+
+@pytest.fixture
+def search_calls(db, monkeypatch):
+    calls = []
+
+    def fake_search(kb_ids, query, top_k, use_hybrid, vector_weight, text_limit, budget):
+        calls.append(list(kb_ids))
+        return [{"chunk_id": f"{kb_ids[0]}:{len(calls)}", "score": 1.0}], True
+
+    monkeypatch.setattr(retrieval, "_search_local", fake_search)
+    monkeypatch.setattr(retrieval, "_search_pg", fake_search)
+    retrieval._result_cache.clear()
+    return calls
+
+
+def test_repeated_query_is_cached(search_calls):
+    first = retrieval.search_knowledge_bases(["kb_cache_1"], "机器学习")
+    second = retrieval.search_knowledge_bases(["kb_cache_1"], "机器学习")
+    assert len(search_calls) == 1
+    assert first == second
+    retrieval.search_knowledge_bases(["kb_cache_1"], "机器学习", top_k=3)
+    assert len(search_calls) == 2
+
+
+def test_cached_results_are_copies(search_calls):
+    retrieval.search_knowledge_bases(["kb_cache_2"], "query")[0]["score"] = 0.0
+    assert retrieval.search_knowledge_bases(["kb_cache_2"], "query")[0]["score"] == 1.0
+
+
+def test_generation_bump_invalidates(search_calls, db):
+    retrieval.search_knowledge_bases(["kb_cache_3", "kb_cache_4"], "query")
+    db.bump_kb_generation("kb_cache_4")
+    retrieval.search_knowledge_bases(["kb_cache_3", "kb_cache_4"], "query")
+    assert len(search_calls) == 2
+    retrieval.search_knowledge_bases(["kb_cache_3"], "query")
+    db.bump_kb_generation("kb_cache_4")
+    retrieval.search_knowledge_bases(["kb_cache_3"], "query")
+    assert len(search_calls) == 3
+
+
+def test_document_writes_bump_generation(db):
+    from knowledge_base import add_document_chunks, delete_document_vectors
+
+    before = db.get_kb_generations(["kb_cache_5"])["kb_cache_5"]
+    chunks = [{"text": "机器学习", "metadata": {"chunk_index": 0, "content_hash": "h0"}}]
+    add_document_chunks("kb_cache_5", "doc_cache", chunks, [[1.0, 0.0, 0.0]])
+    delete_document_vectors("kb_cache_5", "doc_cache")
+    assert db.get_kb_generations(["kb_cache_5"])["kb_cache_5"] == before + 2
+
+
+def test_incomplete_results_are_not_cached(search_calls, monkeypatch):
+    def partial_search(*args):
+        search_calls.append(args[0])
+        return [], False
+
+    monkeypatch.setattr(retrieval, "_search_local", partial_search)
+    monkeypatch.setattr(retrieval, "_search_pg", partial_search)
+    retrieval.search_knowledge_bases(["kb_cache_6"], "query")
+    retrieval.search_knowledge_bases(["kb_cache_6"], "query")
+    assert len(search_calls) == 2
+
+
+def test_generation_read_failure_bypasses_cache(search_calls, monkeypatch):
+    def broken(kb_ids):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(retrieval, "get_kb_generations", broken)
+    retrieval.search_knowledge_bases(["kb_cache_7"], "query")
+    retrieval.search_knowledge_bases(["kb_cache_7"], "query")
+    assert len(search_calls) == 2
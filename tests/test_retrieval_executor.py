@@ -0,0 +1,82 @@
+"""检索执行器：分路并发与分路超时"""
+import threading
+import time
+
+import pytest
+
+from retrieval_executor import RetrievalExecutor
+
+
+@pytest.fixture
+def executor():
+    executor = RetrievalExecutor(max_workers=4, leg_timeout_ms=100)
+    release = threading.Event()
+    executor.release = release
+    yield executor
+    release.set()
+    executor._pool.shutdown(wait=True)
+
+
+def slow(executor, value="slow"):
+    def leg():
+        executor.release.wait(5)
+        return value
+    return leg
+
+
+def fail():
+    raise RuntimeError("boom")
+
+
+def test_slow_and_failing_legs_are_dropped(executor):
+    start = time.monotonic()
+    results = executor.run({"vector": lambda: 1, "bm25:kb_1": slow(executor), "bm25:kb_2": fail})
+    assert results == {"vector": 1}
+    assert time.monotonic() - start < 1.0
+    assert executor.get_stats()["legs"] == {
+        "vector": {"ok": 1, "timeout": 0, "error": 0},
+        "bm25": {"ok": 0, "timeout": 1, "error": 1},
+    }
+
+
+def test_per_leg_timeout_override(executor):
+    def leg():
+        time.sleep(0.2)
+        return "late"
+
+    results = executor.run({"vector": leg, "history": leg}, timeout_ms=50, timeouts={"history": 1000})
+    assert results == {"history": "late"}
+
+
+def test_empty_legs():
+    assert RetrievalExecutor(max_workers=1).run({}) == {}
+
+
+
+def test_rrf_fuse_weights_ranks():
+    from knowledge_base import _rrf_fuse, RRF_K
+
+    vector_hits = [("a", 0.1), ("b", 0.2)]
+    bm25_hits = [("b", 9.0), ("c", 5.0)]
+    fused = dict(_rrf_fuse(vector_hits, bm25_hits, top_k=10, vector_weight=0.7))
+    assert fused["a"] == pytest.approx(0.7 / (RRF_K + 1))
+    assert fused["b"] == pytest.approx(0.7 / (RRF_K + 2) + 0.3 / (RRF_K + 1))
+    assert fused["c"] == pytest.approx(0.3 / (RRF_K + 2))
+    assert [chunk_id for chunk_id, _ in _rrf_fuse(vector_hits, bm25_hits, 2, 0.7)] == ["b", "a"]
+
+
+def test_fuse_candidates_handles_missing_leg_and_limit():
+    from knowledge_base import fuse_candidates
+
+    entries = fuse_candidates(
+        {"kb_1": [("v1", 0.5), ("v2", 1.0)]},
+        {"kb_1": [("v2", 3.0)], "kb_2": [("k1", 7.0)]},
+        top_k=5, vector_weight=0.5, limit=3,
+    )
+    assert [(e["kb_id"], e["chunk_id"]) for e in entries] == [("kb_1", "v2"), ("kb_1", "v1"), ("kb_2", "k1")]
+    assert entries[0]["source"] == "vector" and entries[0]["score"] == pytest.approx(0.5)
+    assert entries[2] == {"kb_id": "kb_2", "chunk_id": "k1", "hybrid_score": entries[2]["hybrid_score"],
+                          "score": 7.0, "source": "bm25"}
+    hybrid = [e["hybrid_score"] for e in entries]
+    assert hybrid == sorted(hybrid, reverse=True)
+    assert len(fuse_candidates({"kb_1": [("v1", 0.5), ("v2", 1.0)]}, {}, 5, 0.5, limit=1)) == 1
@@ -0,0 +1,83 @@
+"""
+启动初始化：PDF 并行解析的子进程会以 __mp_main__ 重新导入 `python app.py`，
+初始化与任务恢复只能在主进程执行一次
+"""
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("pypdf")
+
+from conftest import ROOT
+
+SEED = textwrap.dedent('''
+    import sys
+    from database import init_db, create_knowledge_base, create_ingestion_job
+    init_db()
+    kb_id = create_knowledge_base("user_test", "测试知识库")
+    create_ingestion_job("job_recover", kb_id, "doc_recover", "notes.txt", "text/plain", sys.argv[1])
+''')
+
+# 以 __main__ 运行 app.py（等同 `python app.py`），app.run 替换为并行解析一个大 PDF
+DRIVER = textwrap.dedent('''
+    import runpy, sys
+    import flask
+
+    pdf_path, app_path = sys.argv[1:3]
+
+    def run(self, *args, **kwargs):
+        import ingestion
+        from database import get_ingestion_job
+        from extraction import iter_document_text
+        pages = sum(1 for _ in iter_document_text(pdf_path, "application/pdf"))
+        ingestion._executor.shutdown(wait=True)
+        print("PAGES", pages)
+        print("JOB", get_ingestion_job("job_recover")["status"])
+
+    flask.Flask.run = run
+    sys.argv = [app_path]
+    runpy.run_path(app_path, run_name="__main__")
+''')
+
+
+def test_parallel_pdf_does_not_rerun_startup(tmp_path):
+    from pypdf import PdfWriter
+
+    pdf_path = tmp_path / "large.pdf"
+    writer = PdfWriter()
+    for _ in range(48):
+        writer.add_blank_page(width=595, height=842)
+    with open(pdf_path, "wb") as f:
+        writer.write(f)
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    txt_path = spool / "notes.txt"
+    txt_path.write_text("头脑风暴记录\n" * 50, encoding="utf-8")
+
+    env = dict(os.environ)
+    env.pop("DATABASE_URL", None)
+    env.update({
+        "PYTHONPATH": os.pathsep.join([ROOT, env.get("PYTHONPATH", "")]),
+        "DB_PATH": str(tmp_path / "app.db"),
+        "LOCAL_VECTOR_STORE_PATH": str(tmp_path / "vector_store"),
+        "INGESTION_SPOOL_DIR": str(spool),
+        "EXTRACTION_WORKERS": "2",
+        "EXTRACTION_PARALLEL_MIN_PAGES": "32",
+        "EXTRACTION_PAGES_PER_TASK": "4",
+    })
+    subprocess.run([sys.executable, "-c", SEED, str(txt_path)], env=env, cwd=ROOT,
+                   check=True, capture_output=True, timeout=120)
+
+    result = subprocess.run([sys.executable, "-c", DRIVER, str(pdf_path), os.path.join(ROOT, "app.py")],
+                            env=env, cwd=ROOT, capture_output=True, text=True, timeout=300)
+    output = result.stdout + result.stderr
+    assert result.returncode == 0, output
+    assert "PAGES 48" in output
+    assert "JOB done" in output
+    assert output.count("开始初始化数据库") == 1
+    assert output.count("已恢复 1 个未完成的任务") == 1
+    assert "[PDF提取错误]" not in output
@@ -0,0 +1,77 @@
+"""文本分块：按 token 计长的递归分隔符分块（流式）"""
+import pytest
+
+import text_splitter
+from text_splitter import iter_chunks, split_text, count_tokens, truncate_tokens
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    """固定使用估算的 token 数，结果不依赖 tiktoken 是否可用"""
+    monkeypatch.setattr(text_splitter, "_get_encoding", lambda: None)
+
+
+def paragraphs(n, sentence="机器学习模型需要大量数据进行训练。", per_paragraph=3):
+    return [f"第{i}段" + sentence * per_paragraph for i in range(n)]
+
+
+def test_estimated_token_count():
+    assert count_tokens("") == 0
+    assert count_tokens("机器学习") == 4
+    assert count_tokens("abcdefgh") == 2
+    assert count_tokens("机器 learning") == 2 + 3
+
+
+def test_chunks_respect_size_and_report_tokens():
+    text = "\n\n".join(paragraphs(40))
+    chunks = list(iter_chunks([text], chunk_size=120, chunk_overlap=20))
+    assert len(chunks) > 1
+    for chunk, tokens in chunks:
+        assert tokens == count_tokens(chunk)
+        assert tokens <= 120
+
+
+def test_short_paragraphs_are_merged():
+    assert split_text("第一段\n\n第二段\n\n第三段", chunk_size=100, chunk_overlap=10) == ["第一段\n\n第二段\n\n第三段"]
+
+
+def test_adjacent_chunks_overlap():
+    sentences = [f"句子{i:03d}。" for i in range(200)]
+    chunks = split_text("".join(sentences), chunk_size=60, chunk_overlap=15)
+    assert len(chunks) > 2
+    for previous, current in zip(chunks, chunks[1:]):
+        first_sentence = current.split("。")[0] + "。"
+        assert first_sentence in previous
+        overlap = previous[previous.index(first_sentence):]
+        assert count_tokens(overlap) <= 15
+
+
+def test_text_without_separators_is_split_by_characters():
+    text = "字" * 1000
+    chunks = split_text(text, chunk_size=100, chunk_overlap=0)
+    assert "".join(chunks) == text
+    assert all(count_tokens(chunk) <= 100 for chunk in chunks)
+
+
+def test_streaming_matches_whole_text(monkeypatch):
+    monkeypatch.setattr(text_splitter, "_STREAM_WINDOW", 500)
+    parts = paragraphs(60)
+    text = "\n\n".join(parts)
+    segments = [part + "\n\n" for part in parts[:-1]] + [parts[-1]]
+    streamed = list(iter_chunks(segments, chunk_size=150, chunk_overlap=30))
+    monkeypatch.setattr(text_splitter, "_STREAM_WINDOW", 10 ** 9)
+    assert streamed == list(iter_chunks([text], chunk_size=150, chunk_overlap=30))
+
+
+def test_empty_input():
+    assert list(iter_chunks([])) == []
+    assert split_text("   \n\n  ") == []
+
+
+def test_truncate_tokens():
+    text = "机器学习" * 10
+    assert truncate_tokens(text, 0) == ""
+    assert truncate_tokens(text, 100) == text
+    truncated = truncate_tokens(text, 10)
+    assert text.startswith(truncated)
+    assert 0 < count_tokens(truncated) <= 10
@@ -0,0 +1,65 @@
+"""上传大小限制：接收过程中超过上限立即返回 413，小文件留在内存，大文件转存磁盘"""
+import io
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+
+import app as app_module
+from app import SizeLimitedSpooledFile
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+def test_spooled_file_rolls_over_to_disk():
+    f = SizeLimitedSpooledFile(limit=100, max_size=10)
+    f.write(b"x" * 8)
+    assert not f._rolled
+    f.write(b"x" * 8)
+    assert f._rolled
+    assert f.written == 16
+    f.seek(0)
+    assert f.read() == b"x" * 16
+
+
+def test_spooled_file_rejects_writes_over_limit():
+    f = SizeLimitedSpooledFile(limit=100, max_size=10)
+    f.write(b"x" * 100)
+    with pytest.raises(RequestEntityTooLarge):
+        f.write(b"x")
+
+
+@pytest.fixture
+def client(db, tmp_path, monkeypatch):
+    import ingestion
+    monkeypatch.setattr(app_module, "MAX_FILE_SIZE", 64 * 1024)
+    monkeypatch.setattr(app_module, "UPLOAD_SPOOL_MEMORY", 1024)
+    monkeypatch.setattr(ingestion, "INGESTION_SPOOL_DIR", str(tmp_path / "spool"))
+    app_module.app.config["TESTING"] = True
+    return app_module.app.test_client()
+
+
+def upload(client, size):
+    return client.post("/api/knowledge-bases/kb_upload/documents", data={
+        "visitor_id": "user_test",
+        "file": (io.BytesIO(b"a" * size), "notes.txt", "text/plain"),
+    }, content_type="multipart/form-data")
+
+
+def test_oversized_document_is_rejected(client, tmp_path):
+    response = upload(client, 200 * 1024)
+    assert response.status_code == 413
+    assert "0.1MB" in response.get_json()["error"]
+    assert not list((tmp_path / "spool").glob("*"))
+
+
+def test_document_within_limit_is_queued(client, db):
+    response = upload(client, 32 * 1024)
+    assert response.status_code == 202
+    body = response.get_json()
+    assert body["success"] and body["filename"] == "notes.txt"
+    deadline = time.monotonic() + 30
+    while db.get_ingestion_job(body["job_id"])["status"] not in ("done", "failed"):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    assert db.get_ingestion_job(body["job_id"])["status"] == "done"
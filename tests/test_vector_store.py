@@ -0,0 +1,111 @@
+"""内置向量存储：memmap 矩阵 + SQLite 块表"""
+import os
+import sqlite3
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import vector_store
+from vector_store import VectorStore
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def add_doc(store, doc_id, vectors, prefix=None):
+    prefix = prefix or doc_id
+    chunk_ids = [f"{prefix}:{i}" for i in range(len(vectors))]
+    store.add(doc_id, chunk_ids, [f"text {cid}" for cid in chunk_ids],
+              [{"chunk_index": i} for i in range(len(vectors))], vectors)
+    return chunk_ids
+
+
+def test_search_returns_cosine_distances(tmp_path):
+    store = VectorStore(str(tmp_path / "kb"))
+    add_doc(store, "doc_a", [[1, 0, 0], [0, 1, 0], [1, 1, 0]])
+    results = store.search([2, 0, 0], top_k=2)
+    assert [chunk_id for chunk_id, _ in results] == ["doc_a:0", "doc_a:2"]
+    assert results[0][1] == pytest.approx(0.0, abs=1e-6)
+    assert results[1][1] == pytest.approx(1 - unit(1, 1, 0)[0], abs=1e-6)
+    assert store.search([0, 0, 0]) == []
+    assert store.search([1, 0]) == []
+    assert store.count() == 3
+
+
+def test_reopen_maps_persisted_vectors(tmp_path):
+    path = str(tmp_path / "kb")
+    add_doc(VectorStore(path), "doc_a", [[1, 0], [0, 1]])
+    reopened = VectorStore(path)
+    assert reopened.dim == 2
+    assert reopened.search([0, 1], top_k=1)[0][0] == "doc_a:1"
+    assert reopened.get(["doc_a:1"]) == {"doc_a:1": ("text doc_a:1", {"chunk_index": 1})}
+    assert reopened.get(["doc_a:1"], text_limit=4)["doc_a:1"][0] == "text"
+
+
+def test_delete_compacts_and_keeps_ids_aligned(tmp_path):
+    path = str(tmp_path / "kb")
+    store = VectorStore(path)
+    add_doc(store, "doc_a", [[1, 0, 0], [0, 1, 0]])
+    add_doc(store, "doc_b", [[0, 0, 1], [1, 1, 1]])
+    assert store.delete_document("doc_a") == 2
+    # 删除比例超过阈值，已压缩为 2 行
+    assert store._rows == 2
+    assert os.path.getsize(os.path.join(path, "vectors.bin")) == 2 * 3 * 4
+    assert store.search([0, 0, 1], top_k=1)[0][0] == "doc_b:0"
+    assert VectorStore(path).search([1, 1, 1], top_k=1)[0][0] == "doc_b:1"
+
+    # 删除后同一 chunk_id 可以重新写入
+    add_doc(store, "doc_a", [[1, 0, 0]])
+    assert store.search([1, 0, 0], top_k=1)[0][0] == "doc_a:0"
+    assert store.delete_chunks(["doc_b:0", "missing"]) == 1
+    assert sorted(store.document_chunks("doc_b")) == ["doc_b:1"]
+
+
+def test_int8_quantized_search(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "LOCAL_VECTOR_DTYPE", vector_store.DTYPE_INT8)
+    path = str(tmp_path / "kb")
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(50, 16)).astype(np.float32)
+    store = VectorStore(path)
+    add_doc(store, "doc_a", vectors)
+    assert store.dtype == vector_store.DTYPE_INT8
+    assert os.path.getsize(os.path.join(path, "vectors.bin")) == 50 * 16
+    assert os.path.getsize(os.path.join(path, "scales.bin")) == 50 * 4
+    chunk_id, distance = VectorStore(path).search(vectors[7], top_k=1)[0]
+    assert chunk_id == "doc_a:7"
+    assert distance == pytest.approx(0.0, abs=0.02)
+
+
+def test_failed_insert_truncates_appended_vectors(tmp_path):
+    path = str(tmp_path / "kb")
+    store = VectorStore(path)
+    add_doc(store, "doc_a", [[1, 0], [0, 1]])
+    with pytest.raises(sqlite3.IntegrityError):
+        add_doc(store, "doc_b", [[1, 1], [1, -1]], prefix="doc_a")  # chunk_id 重复
+    assert os.path.getsize(os.path.join(path, "vectors.bin")) == 2 * 2 * 4
+    add_doc(store, "doc_c", [[-1, 0]])
+    assert store.search([-1, 0], top_k=1)[0][0] == "doc_c:0"
+    assert VectorStore(path).search([-1, 0], top_k=1)[0][0] == "doc_c:0"
+
+
+def test_load_truncates_unrecorded_tail(tmp_path):
+    path = str(tmp_path / "kb")
+    add_doc(VectorStore(path), "doc_a", [[1, 0], [0, 1]])
+    with open(os.path.join(path, "vectors.bin"), "ab") as f:
+        f.write(np.ones(2, dtype=np.float32).tobytes())  # 模拟块表提交前崩溃
+    store = VectorStore(path)
+    assert store._rows == 2
+    assert os.path.getsize(os.path.join(path, "vectors.bin")) == 2 * 2 * 4
+
+
+def test_update_chunk_indexes_and_drop(tmp_path):
+    store = VectorStore(str(tmp_path / "kb"))
+    add_doc(store, "doc_a", [[1, 0], [0, 1]])
+    assert store.update_chunk_indexes({"doc_a:0": 5, "missing": 1}) == 1
+    assert store.document_chunks("doc_a")["doc_a:0"]["chunk_index"] == 5
+    store.drop()
+    assert store.count() == 0
+    assert not os.path.exists(store.path)
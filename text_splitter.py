@@ -0,0 +1,173 @@
+"""
+文本分块 - 递归分隔符分块，长度按 token 计算
+分隔符层级：段落 → 换行 → 句号 → 逗号 → 空格 → 字符；分隔符保留在前一片段末尾（中文标点跟随所在句子）
+流式处理：文本段按窗口累积，在最后一个高层级分隔符处切开，只保留窗口剩余部分
+token 计数使用 tiktoken（编码器只加载一次）；tiktoken 不可用时按 CJK 字数 + 其余字符 / 4 估算
+"""
+import re
+import threading
+from collections import deque
+from typing import Iterable, Iterator, List, Tuple
+
+from config import CHUNK_SIZE_TOKENS, CHUNK_OVERLAP_TOKENS, TOKEN_ENCODING
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+SEPARATORS = ["\n\n", "\n", "。", "，", " ", ""]
+
+# 流式分块时累积到该字符数后切分一次
+_STREAM_WINDOW = 20000
+
+_CJK_RE = re.compile("[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af\u3000-\u303f\uff00-\uffef]")
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """tiktoken 编码器（进程内只加载一次；加载失败时返回 None，改用估算）"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                if tiktoken is not None:
+                    try:
+                        _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+                    except Exception as e:
+                        print(f"[分块] tiktoken 编码 {TOKEN_ENCODING} 加载失败，token 数改为估算: {e}")
+                _encoding_loaded = True
+    return _encoding
+
+
+def _estimate_tokens(text: str) -> int:
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens(text: str) -> int:
+    """文本的 token 数"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """截取文本前 max_tokens 个 token（不会截断多字节字符）"""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is None:
+        while text and _estimate_tokens(text) > max_tokens:
+            text = text[:int(len(text) * 0.9)]
+        return text
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode_bytes(tokens[:max_tokens]).decode("utf-8", errors="ignore")
+
+
+def _pieces(text: str, separator: str) -> List[str]:
+    """按分隔符切开，分隔符留在前一片段末尾"""
+    parts = text.split(separator)
+    pieces = [part + separator for part in parts[:-1]]
+    pieces.append(parts[-1])
+    return [piece for piece in pieces if piece]
+
+
+def _char_pieces(text: str, step: int) -> List[str]:
+    return [text[i:i + step] for i in range(0, len(text), step)]
+
+
+def _atoms(text: str, chunk_size: int, chunk_overlap: int, level: int = 0) -> Iterator[Tuple[str, int]]:
+    """
+    把文本切成不超过 chunk_size 个 token 的最小合并单元 (片段, token 数)
+
+    每个片段优先用高层级分隔符切分，仍然过长的片段再用下一层级切分。
+    """
+    separator = SEPARATORS[level]
+    if separator:
+        pieces = _pieces(text, separator)
+    else:
+        # 没有任何分隔符的超长片段：按字符切成小段，合并时仍可形成重叠
+        pieces = _char_pieces(text, max(1, chunk_overlap or chunk_size))
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if tokens <= chunk_size or len(piece) == 1:
+            yield piece, tokens
+        elif separator:
+            yield from _atoms(piece, chunk_size, chunk_overlap, level + 1)
+        else:
+            yield from _atoms(piece, chunk_size, max(1, len(piece) // 2), level)
+
+
+def _merge(atoms: Iterable[Tuple[str, int]], chunk_size: int, chunk_overlap: int) -> Iterator[Tuple[str, int]]:
+    """贪心合并片段为不超过 chunk_size 个 token 的块，相邻块重叠不超过 chunk_overlap 个 token"""
+    window = deque()
+    total = 0
+    for text, tokens in atoms:
+        if window and total + tokens > chunk_size:
+            chunk = "".join(piece for piece, _ in window).strip()
+            if chunk:
+                yield chunk, count_tokens(chunk)
+            # 保留末尾不超过 chunk_overlap 的片段作为下一块的开头
+            while window and (total > chunk_overlap or total + tokens > chunk_size):
+                total -= window.popleft()[1]
+        window.append((text, tokens))
+        total += tokens
+    chunk = "".join(piece for piece, _ in window).strip()
+    if chunk:
+        yield chunk, count_tokens(chunk)
+
+
+def _cut_point(text: str) -> int:
+    """流式切分位置：最后一个（尽量高层级的）分隔符之后"""
+    for separator in SEPARATORS[:-1]:
+        index = text.rfind(separator)
+        if index > 0:
+            return index + len(separator)
+    return len(text)
+
+
+def _stream_atoms(segments: Iterable[str], chunk_size: int, chunk_overlap: int) -> Iterator[Tuple[str, int]]:
+    buffer, size = [], 0
+    for segment in segments:
+        buffer.append(segment)
+        size += len(segment)
+        if size < _STREAM_WINDOW:
+            continue
+        text = "".join(buffer)
+        cut = _cut_point(text)
+        yield from _atoms(text[:cut], chunk_size, chunk_overlap)
+        rest = text[cut:]
+        buffer, size = [rest], len(rest)
+    text = "".join(buffer)
+    if text:
+        yield from _atoms(text, chunk_size, chunk_overlap)
+
+
+def iter_chunks(segments: Iterable[str], chunk_size: int = CHUNK_SIZE_TOKENS,
+                chunk_overlap: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Tuple[str, int]]:
+    """
+    流式分块
+
+    Args:
+        segments: 文本段（如逐页提取的文本）
+        chunk_size: 每块最多的 token 数
+        chunk_overlap: 相邻块重叠的 token 数
+
+    Yields:
+        (块文本, token 数)
+    """
+    yield from _merge(_stream_atoms(segments, chunk_size, chunk_overlap), chunk_size, chunk_overlap)
+
+
+def split_text(text: str, chunk_size: int = CHUNK_SIZE_TOKENS, chunk_overlap: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    """将文本分割成块"""
+    return [chunk for chunk, _ in iter_chunks([text], chunk_size, chunk_overlap)]
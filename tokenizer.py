@@ -0,0 +1,56 @@
+"""
+关键词检索分词 - 无需词典的 CJK 二元切分
+中日韩文字按相邻两字切分（单字成词时保留单字），英文/数字按连续字母数字切分并转小写
+"""
+import re
+import unicodedata
+from typing import Dict, List
+
+# CJK 统一表意文字（含扩展 A、兼容区）、日文假名、韩文音节
+_CJK_RANGES = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af"
+_TOKEN_RE = re.compile(f"[{_CJK_RANGES}]+|[0-9a-z]+")
+
+# 超长的字母数字串（哈希、base64 等）对检索没有帮助
+MAX_TOKEN_LENGTH = 64
+
+# PostgreSQL tsvector 位置上限（14 位）与单个词条最多保留的位置数
+_MAX_POSITION = 16383
+_MAX_POSITIONS_PER_LEXEME = 256
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    分词：NFKC 规范化（全角转半角）+ 小写，CJK 连续段做二元切分
+
+    >>> tokenize("机器学习 Python3")
+    ['机器', '器学', '学习', 'python3']
+    """
+    if not text:
+        return []
+    tokens = []
+    for match in _TOKEN_RE.finditer(unicodedata.normalize("NFKC", text).lower()):
+        run = match.group()
+        if run[0].isascii():
+            if len(run) <= MAX_TOKEN_LENGTH:
+                tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def lexeme_positions(text: str) -> Dict[str, List[int]]:
+    """分词并记录每个词条的位置（从 1 开始），用于构造 tsvector"""
+    positions = {}
+    for i, token in enumerate(tokenize(text), 1):
+        pos = positions.setdefault(token, [])
+        if len(pos) < _MAX_POSITIONS_PER_LEXEME:
+            pos.append(min(i, _MAX_POSITION))
+    # 位置超出上限后会被截断为相同值，tsvector 要求同一词条的位置严格递增
+    return {lex: sorted(set(pos)) for lex, pos in positions.items()}
+
+
+def query_terms(query: str) -> List[str]:
+    """查询词条（去重且保持顺序）"""
+    return list(dict.fromkeys(tokenize(query)))
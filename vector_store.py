@@ -0,0 +1,395 @@
+"""
+内置向量存储 - 本地模式下 ChromaDB 的轻量替代
+每个知识库一个目录：
+- vectors.bin：按行追加的 L2 归一化向量矩阵（float32，或 int8 量化 + scales.bin 每行缩放系数）
+- chunks.db：SQLite 块表（行号、chunk_id、doc_id、正文、元数据、删除标记）
+检索时以 np.memmap 映射矩阵，分块做向量化点积（暴力检索，延迟可预期）
+"""
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import LOCAL_VECTOR_STORE_PATH, LOCAL_VECTOR_DTYPE
+
+DTYPE_FLOAT32 = "float32"
+DTYPE_INT8 = "int8"
+
+# 分块计算点积，int8 矩阵转换为 float32 的临时内存有上限
+_SEARCH_BLOCK_ROWS = 16384
+
+# 删除标记超过该比例时压缩重写
+_COMPACT_RATIO = 0.3
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS chunks (
+        row INTEGER PRIMARY KEY,
+        chunk_id TEXT NOT NULL UNIQUE,
+        doc_id TEXT NOT NULL,
+        text TEXT NOT NULL,
+        metadata TEXT NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(doc_id);
+'''
+
+
+class VectorStore:
+    """单个知识库的向量存储（线程安全）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db_path = os.path.join(path, "chunks.db")
+        self._vectors_path = os.path.join(path, "vectors.bin")
+        self._scales_path = os.path.join(path, "scales.bin")
+        self.dim: Optional[int] = None
+        self.dtype: Optional[str] = None
+        self._rows = 0
+        self._matrix = None      # np.memmap (rows, dim)
+        self._scales = None      # np.memmap (rows,)，仅 int8
+        self._deleted = None     # np.ndarray[bool] (rows,)
+        self._generation = 0     # 每次压缩（行号重排）加 1
+        self._load()
+
+    # ---------- 存储 ----------
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._db_path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def _np_dtype(self):
+        return np.int8 if self.dtype == DTYPE_INT8 else np.float32
+
+    def _load(self):
+        """读取元数据并映射向量文件；截掉崩溃残留的、块表中没有记录的尾部向量"""
+        if not os.path.exists(self._db_path):
+            return
+        conn = self._connect()
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+            if "dim" not in meta:
+                return
+            self.dim = int(meta["dim"])
+            self.dtype = meta.get("dtype", DTYPE_FLOAT32)
+            row = conn.execute("SELECT MAX(row) FROM chunks").fetchone()
+            rows = (row[0] + 1) if row and row[0] is not None else 0
+            deleted = np.zeros(rows, dtype=bool)
+            for (r,) in conn.execute("SELECT row FROM chunks WHERE deleted = 1"):
+                deleted[r] = True
+        finally:
+            conn.close()
+
+        self._truncate(rows)
+        self._deleted = deleted
+        self._remap(rows)
+
+    def _truncate(self, rows: int):
+        """截掉 vectors.bin / scales.bin 中超出 rows 行的部分（块表未提交的向量）"""
+        row_bytes = self.dim * np.dtype(self._np_dtype()).itemsize
+        if os.path.exists(self._vectors_path) and os.path.getsize(self._vectors_path) > rows * row_bytes:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(rows * row_bytes)
+        if self.dtype == DTYPE_INT8 and os.path.exists(self._scales_path) \
+                and os.path.getsize(self._scales_path) > rows * 4:
+            with open(self._scales_path, "r+b") as f:
+                f.truncate(rows * 4)
+
+    def _remap(self, rows: int):
+        self._rows = rows
+        if rows == 0:
+            self._matrix = None
+            self._scales = None
+            return
+        self._matrix = np.memmap(self._vectors_path, dtype=self._np_dtype(), mode="r", shape=(rows, self.dim))
+        if self.dtype == DTYPE_INT8:
+            self._scales = np.memmap(self._scales_path, dtype=np.float32, mode="r", shape=(rows,))
+
+    def _encode(self, vectors: np.ndarray) -> Tuple[bytes, Optional[bytes]]:
+        """归一化后编码为存储格式，返回 (向量字节, int8 缩放系数字节)"""
+        if self.dtype == DTYPE_INT8:
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+            return quantized.tobytes(), scales.astype(np.float32).tobytes()
+        return vectors.astype(np.float32).tobytes(), None
+
+    # ---------- 写入 ----------
+
+    def add(self, doc_id: str, chunk_ids: List[str], texts: List[str], metadatas: List[Dict],
+            embeddings: Sequence[Sequence[float]]):
+        """追加一个文档的所有块（向量先落盘，再提交块表）"""
+        if not chunk_ids:
+            return
+        vectors = np.vstack([np.asarray(e, dtype=np.float32) for e in embeddings])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors = vectors / norms
+
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            conn = self._connect()
+            try:
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                    self.dtype = LOCAL_VECTOR_DTYPE if LOCAL_VECTOR_DTYPE == DTYPE_INT8 else DTYPE_FLOAT32
+                    with conn:
+                        conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                         [("dim", str(self.dim)), ("dtype", self.dtype)])
+                    self._deleted = np.zeros(0, dtype=bool)
+                if vectors.shape[1] != self.dim:
+                    raise ValueError(f"向量维度 {vectors.shape[1]} 与知识库维度 {self.dim} 不一致")
+
+                data, scales = self._encode(vectors)
+                start = self._rows
+                try:
+                    with open(self._vectors_path, "ab") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    if scales is not None:
+                        with open(self._scales_path, "ab") as f:
+                            f.write(scales)
+                            f.flush()
+                            os.fsync(f.fileno())
+
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO chunks (row, chunk_id, doc_id, text, metadata) VALUES (?, ?, ?, ?, ?)",
+                            [(start + i, chunk_ids[i], doc_id, texts[i],
+                              json.dumps(metadatas[i], ensure_ascii=False))
+                             for i in range(len(chunk_ids))]
+                        )
+                except Exception:
+                    # 块表没有提交：截掉刚追加的向量，否则之后追加的行号与向量错位
+                    self._truncate(start)
+                    raise
+            finally:
+                conn.close()
+            self._deleted = np.concatenate([self._deleted, np.zeros(len(chunk_ids), dtype=bool)])
+            self._remap(start + len(chunk_ids))
+
+    def delete_document(self, doc_id: str) -> int:
+        """标记删除文档的所有块；删除比例过高时压缩。返回删除的块数"""
+        return self._mark_deleted("doc_id = ?", [doc_id])
+
+    def delete_chunks(self, chunk_ids: List[str]) -> int:
+        """按 chunk_id 标记删除块；删除比例过高时压缩。返回删除的块数"""
+        if not chunk_ids:
+            return 0
+        return self._mark_deleted(f"chunk_id IN ({','.join('?' * len(chunk_ids))})", list(chunk_ids))
+
+    def update_chunk_indexes(self, chunk_indexes: Dict[str, int]) -> int:
+        """更新块元数据中的 chunk_index {chunk_id: 新序号}，向量不变。返回更新的块数"""
+        if not chunk_indexes or not os.path.exists(self._db_path):
+            return 0
+        with self._lock:
+            conn = self._connect()
+            try:
+                chunk_ids = list(chunk_indexes)
+                rows = conn.execute(
+                    "SELECT chunk_id, metadata FROM chunks "
+                    f"WHERE chunk_id IN ({','.join('?' * len(chunk_ids))}) AND deleted = 0",
+                    chunk_ids
+                ).fetchall()
+                updates = []
+                for chunk_id, metadata in rows:
+                    metadata = json.loads(metadata)
+                    metadata["chunk_index"] = chunk_indexes[chunk_id]
+                    updates.append((json.dumps(metadata, ensure_ascii=False), chunk_id))
+                with conn:
+                    conn.executemany("UPDATE chunks SET metadata = ? WHERE chunk_id = ? AND deleted = 0", updates)
+            finally:
+                conn.close()
+            return len(updates)
+
+    def _mark_deleted(self, where: str, params: List) -> int:
+        if self.dim is None:
+            return 0
+        with self._lock:
+            conn = self._connect()
+            try:
+                rows = [r for (r,) in conn.execute(
+                    f"SELECT row FROM chunks WHERE {where} AND deleted = 0", params)]
+                if not rows:
+                    return 0
+                with conn:
+                    # chunk_id 加上行号后缀释放出来，同一 ID 的块之后可以重新写入
+                    conn.execute(f"UPDATE chunks SET deleted = 1, chunk_id = chunk_id || '#' || row "
+                                 f"WHERE {where} AND deleted = 0", params)
+            finally:
+                conn.close()
+            self._deleted[rows] = True
+            if self._deleted.sum() > self._rows * _COMPACT_RATIO:
+                self._compact()
+            return len(rows)
+
+    def _compact(self):
+        """重写向量文件与块表，去掉已删除的行"""
+        keep = np.flatnonzero(~self._deleted)
+        tmp_vectors = self._vectors_path + ".tmp"
+        np.ascontiguousarray(self._matrix[keep]).tofile(tmp_vectors)
+        if self.dtype == DTYPE_INT8:
+            np.ascontiguousarray(self._scales[keep]).tofile(self._scales_path + ".tmp")
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM chunks WHERE deleted = 1")
+                # 按原顺序重新编号为 0..n-1（先整体移到负数区间，避免主键冲突）
+                conn.execute("UPDATE chunks SET row = -row - 1")
+                conn.executemany("UPDATE chunks SET row = ? WHERE row = ?",
+                                 [(i, -int(old) - 1) for i, old in enumerate(keep)])
+            self._matrix = None
+            self._scales = None
+            os.replace(tmp_vectors, self._vectors_path)
+            if self.dtype == DTYPE_INT8:
+                os.replace(self._scales_path + ".tmp", self._scales_path)
+        finally:
+            conn.close()
+        self._deleted = np.zeros(len(keep), dtype=bool)
+        self._generation += 1
+        self._remap(len(keep))
+
+    # ---------- 读取 ----------
+
+    def search(self, query_embedding: Sequence[float], top_k: int = 5) -> List[Tuple[str, float]]:
+        """
+        余弦相似度暴力检索
+
+        Returns:
+            [(chunk_id, 余弦距离), ...]，按距离升序
+        """
+        with self._lock:
+            matrix, scales, deleted, rows = self._matrix, self._scales, self._deleted, self._rows
+            generation = self._generation
+        if matrix is None or rows == 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0 or query.shape[0] != self.dim:
+            return []
+        query = query / norm
+
+        scores = np.empty(rows, dtype=np.float32)
+        for start in range(0, rows, _SEARCH_BLOCK_ROWS):
+            block = matrix[start:start + _SEARCH_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32, copy=False) @ query
+        if scales is not None:
+            scores *= scales
+        scores[deleted[:rows]] = -np.inf
+
+        k = min(top_k, rows)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = [int(r) for r in top if np.isfinite(scores[r])]
+        if not top:
+            return []
+
+        ids = self._chunk_ids_for_rows(top)
+        if self._generation != generation:
+            # 检索期间发生了压缩，行号已重排，按新矩阵重新检索
+            return self.search(query_embedding, top_k)
+        return [(ids[r], float(1.0 - scores[r])) for r in top if r in ids]
+
+    def _chunk_ids_for_rows(self, rows: List[int]) -> Dict[int, str]:
+        conn = self._connect()
+        try:
+            placeholders = ",".join("?" * len(rows))
+            return dict(conn.execute(
+                f"SELECT row, chunk_id FROM chunks WHERE row IN ({placeholders}) AND deleted = 0", rows
+            ).fetchall())
+        finally:
+            conn.close()
+
+    def get(self, chunk_ids: List[str], text_limit: Optional[int] = None) -> Dict[str, Tuple[str, Dict]]:
+        """按 chunk_id 批量读取 {chunk_id: (正文, 元数据)}，可只取正文前 text_limit 个字符"""
+        if not chunk_ids or not os.path.exists(self._db_path):
+            return {}
+        conn = self._connect()
+        try:
+            placeholders = ",".join("?" * len(chunk_ids))
+            text_expr = "substr(text, 1, ?)" if text_limit else "text"
+            params = ([text_limit] if text_limit else []) + list(chunk_ids)
+            rows = conn.execute(
+                f"SELECT chunk_id, {text_expr}, metadata FROM chunks "
+                f"WHERE chunk_id IN ({placeholders}) AND deleted = 0",
+                params
+            ).fetchall()
+        finally:
+            conn.close()
+        return {chunk_id: (text, json.loads(metadata)) for chunk_id, text, metadata in rows}
+
+    def document_chunks(self, doc_id: str) -> Dict[str, Dict]:
+        """文档的所有未删除块 {chunk_id: 元数据}"""
+        if not os.path.exists(self._db_path):
+            return {}
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT chunk_id, metadata FROM chunks WHERE doc_id = ? AND deleted = 0", (doc_id,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return {chunk_id: json.loads(metadata) for chunk_id, metadata in rows}
+
+    def iter_chunks(self):
+        """遍历所有未删除的块 (chunk_id, doc_id, 正文)，用于构建关键词索引"""
+        if not os.path.exists(self._db_path):
+            return
+        conn = self._connect()
+        try:
+            yield from conn.execute("SELECT chunk_id, doc_id, text FROM chunks WHERE deleted = 0 ORDER BY row")
+        finally:
+            conn.close()
+
+    def count(self) -> int:
+        """未删除的块数"""
+        with self._lock:
+            return int(self._rows - self._deleted.sum()) if self._deleted is not None else 0
+
+    def drop(self):
+        """删除整个知识库的存储"""
+        with self._lock:
+            self._matrix = None
+            self._scales = None
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.dim = None
+            self.dtype = None
+            self._deleted = None
+            self._rows = 0
+
+
+# 已打开的知识库存储（进程内复用 memmap）
+_stores: Dict[str, VectorStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_vector_store(kb_id: str) -> VectorStore:
+    """获取知识库的向量存储（单例）"""
+    store = _stores.get(kb_id)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(kb_id)
+            if store is None:
+                store = VectorStore(os.path.join(LOCAL_VECTOR_STORE_PATH, kb_id))
+                _stores[kb_id] = store
+    return store
+
+
+def drop_vector_store(kb_id: str):
+    """删除知识库的向量存储"""
+    with _stores_lock:
+        store = _stores.pop(kb_id, None)
+    (store or VectorStore(os.path.join(LOCAL_VECTOR_STORE_PATH, kb_id))).drop()
@@ -0,0 +1,92 @@
+"""
+向量表示与编解码工具
+支持 Python float 列表与紧凑的 float32 连续缓冲区（array('f')）两种形式
+"""
+import struct
+import sys
+from array import array
+from typing import List, Sequence, Union
+
+from config import EMBEDDING_VECTOR_FORMAT
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+# 向量类型：float 列表或 float32 缓冲区
+Vector = Union[List[float], array]
+
+FORMAT_LIST = "list"
+FORMAT_FLOAT32 = "float32"
+
+
+def use_float32(vector_format: str = None) -> bool:
+    """是否使用 float32 紧凑表示（默认读取 EMBEDDING_VECTOR_FORMAT）"""
+    return (vector_format or EMBEDDING_VECTOR_FORMAT) == FORMAT_FLOAT32
+
+
+def to_float32(vector: Sequence[float]) -> array:
+    """转换为 float32 连续缓冲区（1536 维约 6KB）"""
+    if isinstance(vector, array) and vector.typecode == "f":
+        return vector
+    return array("f", vector)
+
+
+def to_list(vector: Sequence[float]) -> List[float]:
+    """转换为 Python float 列表"""
+    if isinstance(vector, list):
+        return vector
+    if isinstance(vector, array):
+        return vector.tolist()
+    return list(vector)
+
+
+def to_format(vector: Sequence[float], vector_format: str = None) -> Vector:
+    """按配置的向量格式返回一份独立副本"""
+    if use_float32(vector_format):
+        return array("f", vector)
+    return vector.tolist() if isinstance(vector, array) else list(vector)
+
+
+def unpack_float32(data: bytes) -> array:
+    """float32 字节串解码为 array('f')"""
+    vec = array("f")
+    vec.frombytes(data)
+    return vec
+
+
+def to_pgvector_text(vector: Sequence[float]) -> str:
+    """
+    编码为 pgvector 文本字面量 '[x, y, ...]'
+
+    配合 %s::vector 使用，由 vector_in 直接解析，避免 psycopg2 把列表
+    展开为 ARRAY[...] 再经 numeric[] 转换。
+    """
+    return str(to_list(vector))
+
+
+def to_pgvector_binary(vector: Sequence[float]) -> bytes:
+    """
+    编码为 pgvector 二进制格式（vector_recv）
+
+    布局：int16 维度 + int16 保留位 + 维度个大端 float4，用于 COPY ... (FORMAT binary)。
+    """
+    vec = array("f", vector)
+    if sys.byteorder == "little":
+        vec.byteswap()
+    return struct.pack(">HH", len(vec), 0) + vec.tobytes()
+
+
+def as_numpy(vector: Sequence[float]):
+    """返回 float32 NumPy 数组（array('f') 零拷贝）"""
+    if isinstance(vector, array) and vector.typecode == "f":
+        return np.frombuffer(vector, dtype=np.float32)
+    return np.asarray(vector, dtype=np.float32)
+
+
+def as_numpy_matrix(vectors: Sequence[Sequence[float]]):
+    """多个向量拼接为 (n, dim) 的 float32 矩阵"""
+    return np.vstack([as_numpy(v) for v in vectors])